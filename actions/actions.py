@@ -3,18 +3,29 @@
 import os
 import re
 import shlex
-import subprocess
 import sys
 
 from charms import layer
 
 from etcdctl import EtcdCtl
+from etcdctl import etcd_version
+from etcd_databag import EtcdDatabag
+from etcd_gateway import EtcdGateway
+from etcd_gateway import split_endpoints
+import etcd_benchmark
+import etcd_disk
+import etcd_maintenance
+import etcd_metrics
+import etcd_snapshot
+
+from charmhelpers.core import unitdata
 
 from charmhelpers.core.hookenv import (
     action_get,
     action_set,
     action_fail,
-    action_name
+    action_name,
+    local_unit,
 )
 
 
@@ -30,16 +41,16 @@ def action_fail_now(*args, **kw):
 
 
 def requires_etcd_version(version_regex, human_version=None):
-    '''Decorator that enforces a specific version of etcdctl be present.
+    '''Decorator that enforces a specific version of etcd be present.
 
     The decorated function will only be executed if the required version
-    of etcdctl is present. Otherwise, action_fail() will be called and
+    of etcd is present. Otherwise, action_fail() will be called and
     the process will exit immediately.
 
     '''
     def wrap(f):
         def wrapped_f(*args):
-            version = CTL.version()
+            version = etcd_version()
             if not re.match(version_regex, version):
                 required_version = human_version or version_regex
                 action_fail_now(
@@ -54,16 +65,24 @@ requires_etcd_v2 = requires_etcd_version(r'2\..*', human_version='2.x')
 requires_etcd_v3 = requires_etcd_version(r'3\..*', human_version='3.x')
 
 
+def format_alarms(alarms):
+    '''Format Alarm records the way `etcdctl alarm list` prints them.
+
+    '''
+    return '\n'.join('memberID:{} alarm:{}'.format(a.member_id, a.alarm)
+                     for a in alarms)
+
+
 @requires_etcd_v3
 def alarm_disarm():
     '''Call `etcdctl alarm disarm`.
 
     '''
     try:
-        output = CTL.run('alarm disarm')
-        action_set(dict(output=output))
-    except subprocess.CalledProcessError as e:
-        action_fail_now(e.output)
+        alarms = CTL.alarm_disarm()
+        action_set(dict(output=format_alarms(alarms)))
+    except EtcdCtl.CommandFailed as e:
+        action_fail_now(str(e))
 
 
 @requires_etcd_v3
@@ -72,10 +91,10 @@ def alarm_list():
 
     '''
     try:
-        output = CTL.run('alarm list')
-        action_set(dict(output=output))
-    except subprocess.CalledProcessError as e:
-        action_fail_now(e.output)
+        alarms = CTL.alarm_list()
+        action_set(dict(output=format_alarms(alarms)))
+    except EtcdCtl.CommandFailed as e:
+        action_fail_now(str(e))
 
 
 @requires_etcd_v3
@@ -85,27 +104,18 @@ def compact():
     '''
     def get_latest_revision():
         try:
-            output = CTL.run('endpoint status --write-out json')
-        except subprocess.CalledProcessError as e:
+            return CTL.endpoint_status()[0].revision
+        except (EtcdCtl.CommandFailed, IndexError) as e:
             action_fail_now(
                 'Failed to determine latest revision for '
                 'compaction: {}'.format(e))
 
-        m = re.search(r'"revision":(\d*)', output)
-        if not m:
-            action_fail_now(
-                "Failed to get revision from 'endpoint status' "
-                "output: {}".format(output))
-        return m.group(1)
-
     revision = action_get('revision') or get_latest_revision()
-    physical = 'true' if action_get('physical') else 'false'
-    command = 'compact {} --physical={}'.format(revision, physical)
     try:
-        output = CTL.run(command)
+        output = CTL.compact(revision, physical=bool(action_get('physical')))
         action_set(dict(output=output))
-    except subprocess.CalledProcessError as e:
-        action_fail_now(e.output)
+    except EtcdCtl.CommandFailed as e:
+        action_fail_now(str(e))
 
 
 @requires_etcd_v3
@@ -114,31 +124,271 @@ def defrag():
 
     '''
     try:
-        output = CTL.run('defrag')
+        output = CTL.defrag()
         action_set(dict(output=output))
-    except subprocess.CalledProcessError as e:
-        action_fail_now(e.output)
+    except EtcdCtl.CommandFailed as e:
+        action_fail_now(str(e))
+
+
+@requires_etcd_v3
+def defrag_cluster():
+    '''Defragment every member in turn, followers first and the leader last.
+
+    '''
+    try:
+        results = etcd_maintenance.rolling_defrag(
+            CTL, float(action_get('max-in-use-ratio')))
+        failure = None
+    except etcd_maintenance.MaintenanceFailed as e:
+        results, failure = e.results, str(e)
+
+    lines = []
+    summary = {}
+    reclaimed = 0
+    for result in results:
+        prefix = 'members.{}.'.format(result['name'])
+        summary[prefix + 'db-size'] = result['db_size']
+        summary[prefix + 'db-size-in-use'] = result['db_size_in_use']
+        if 'skipped' in result:
+            summary[prefix + 'skipped'] = result['skipped']
+            lines.append('{}: skipped, {}'.format(result['name'],
+                                                  result['skipped']))
+        elif 'reclaimed' in result:
+            summary[prefix + 'db-size-after'] = result['db_size_after']
+            summary[prefix + 'reclaimed'] = result['reclaimed']
+            reclaimed += result['reclaimed']
+            lines.append('{}: reclaimed {}'.format(
+                result['name'],
+                etcd_snapshot.human_size(result['reclaimed'])))
+    summary['reclaimed'] = reclaimed
+    summary['output'] = '\n'.join(
+        lines + ['Reclaimed {} in total'.format(
+            etcd_snapshot.human_size(reclaimed))])
+    action_set(summary)
+    if failure:
+        action_fail_now(failure)
+
+
+@requires_etcd_v3
+def benchmark():
+    '''Run a mix of puts, ranges, txns and watches and report the latency.
+
+    '''
+    try:
+        mix = etcd_benchmark.parse_mix(action_get('operations'))
+    except ValueError as e:
+        action_fail_now('Invalid operations: {}'.format(e))
+    workload = {'operations': ','.join('{}={}'.format(name, mix[name])
+                                       for name in sorted(mix))}
+    for param in ('key-size', 'value-size', 'keys', 'concurrency',
+                  'duration'):
+        workload[param] = int(action_get(param))
+        if workload[param] < 1:
+            action_fail_now('{} must be at least 1'.format(param))
+
+    endpoints = split_endpoints(action_get('endpoints') or '')
+    if not endpoints:
+        try:
+            for member in CTL.member_list().values():
+                endpoints.extend(split_endpoints(member.client_urls))
+        except EtcdCtl.CommandFailed as e:
+            action_fail_now('Failed to list members: {}'.format(e))
+    if not endpoints:
+        action_fail_now('No member has published a client URL yet')
+    previous = etcd_benchmark.baseline(workload)
+    try:
+        result = etcd_benchmark.run(
+            endpoints, etcd_benchmark.client_gateway(), mix,
+            workload['key-size'], workload['value-size'], workload['keys'],
+            workload['concurrency'], workload['duration'])
+    except (EtcdGateway.Unavailable, EtcdGateway.RequestFailed,
+            ValueError) as e:
+        action_fail_now('Benchmark failed: {}'.format(e))
+    entry = etcd_benchmark.record(workload, result, etcd_version())
+
+    lines = ['{} ops/s over {}s against {}'.format(
+        result['ops-per-sec'], result['elapsed'], ','.join(endpoints))]
+    results = {'ops-per-sec': result['ops-per-sec'],
+               'elapsed': result['elapsed'],
+               'charm-revision': entry['charm-revision'] or 'unknown',
+               'snap-revision': entry['snap-revision'] or 'unknown'}
+    for operation, stats in sorted(result['operations'].items()):
+        lines.append('{}: {} ops/s errors={} p50={}ms p95={}ms p99={}ms '
+                     'p999={}ms'.format(operation, stats['ops-per-sec'],
+                                        stats['errors'], stats['p50'],
+                                        stats['p95'], stats['p99'],
+                                        stats['p999']))
+        prefix = 'operations.{}.'.format(operation)
+        for key in ('count', 'errors', 'ops-per-sec'):
+            results[prefix + key] = stats[key]
+        for key in ('p50', 'p95', 'p99', 'p999'):
+            results[prefix + key + '-ms'] = stats[key]
+    if previous:
+        lines.append('Previous run of this workload, charm revision {} and '
+                     'snap revision {}: {} ops/s'.format(
+                         previous['charm-revision'] or 'unknown',
+                         previous['snap-revision'] or 'unknown',
+                         previous['result']['ops-per-sec']))
+        results['previous.ops-per-sec'] = previous['result']['ops-per-sec']
+        for operation, stats in previous['result']['operations'].items():
+            results['previous.{}.p99-ms'.format(operation)] = stats['p99']
+    results['output'] = '\n'.join(lines)
+    action_set(results)
+
+
+def disk_benchmark():
+    '''Measure the fsync latency of the disk the WAL is written to.
+
+    '''
+    seconds = int(action_get('seconds'))
+    if seconds < 1:
+        action_fail_now('seconds must be at least 1')
+    bag = EtcdDatabag()
+    path = action_get('path') or bag.wal_path or bag.etcd_data_dir
+    try:
+        result = etcd_disk.fsync_benchmark(path, seconds)
+    except OSError as e:
+        action_fail_now('Disk benchmark failed: {}'.format(e))
+    # The preflight reuses the measurement, so a unit blocked on a disk
+    # that has since been fixed can proceed.
+    etcd_disk.remember(result)
+    level, message = etcd_disk.verdict(result, *etcd_disk.thresholds())
+
+    results = {'path': path, 'writes': result['writes'],
+               'write-size': result['write-size'],
+               'writes-per-sec': result['writes-per-sec'],
+               'verdict': level or 'ok'}
+    for key in ('p50', 'p95', 'p99', 'p999', 'max'):
+        results['fsync.{}-ms'.format(key)] = result[key]
+    results['output'] = '\n'.join(filter(None, [
+        '{} fdatasynced writes of {} bytes in {}, {} writes/s'.format(
+            result['writes'], result['write-size'], path,
+            result['writes-per-sec']),
+        'fsync p50={}ms p95={}ms p99={}ms p999={}ms max={}ms'.format(
+            result['p50'], result['p95'], result['p99'], result['p999'],
+            result['max']),
+        message]))
+    action_set(results)
 
 
 def health():
-    '''Call etcdctl cluster-health
+    '''Probe every cluster member concurrently and report their health.
 
     '''
+    health = CTL.cluster_health()
+    results = dict(output='\n'.join(health['units'] + [health['status']]))
+    for member in health['members']:
+        prefix = 'members.{}.'.format(member.name)
+        results[prefix + 'healthy'] = member.healthy
+        if member.healthy:
+            results[prefix + 'endpoint'] = member.endpoint
+            results[prefix + 'latency-ms'] = member.latency_ms
+            results[prefix + 'raft-term'] = member.raft_term
+            results[prefix + 'leader'] = member.leader
+            results[prefix + 'db-size'] = member.db_size
+        else:
+            results[prefix + 'error'] = member.error
+    action_set(results)
+
+
+def charm_metrics():
+    '''Report the wall time percentiles of the commands run by the charm.
+
+    '''
+    summary = etcd_metrics.summary()
+    lines = []
+    results = {}
+    for label in sorted(summary):
+        stats = summary[label]
+        lines.append('{}: count={} errors={} p50={}ms p95={}ms p99={}ms '
+                     'max={}ms'.format(label, stats['count'],
+                                       stats['errors'], stats['p50'],
+                                       stats['p95'], stats['p99'],
+                                       stats['max']))
+        prefix = 'commands.{}.'.format(re.sub(r'[^a-z0-9]+', '-',
+                                              label.lower()).strip('-'))
+        results[prefix + 'count'] = stats['count']
+        results[prefix + 'errors'] = stats['errors']
+        results[prefix + 'endpoints'] = ','.join(stats['endpoints'])
+        for key in ('p50', 'p95', 'p99', 'max'):
+            results[prefix + key + '-ms'] = stats[key]
+    results['output'] = '\n'.join(lines) or 'No commands recorded yet.'
+    if action_get('reset'):
+        etcd_metrics.reset()
+    action_set(results)
+
+
+def snapshot():
+    '''Stream a consistent snapshot into a compressed, hashed archive.
+
+    '''
+    keys_version = action_get('keys-version')
+    data_dir = layer.options('etcd')['etcd_data_dir']
+    legacy_dir = os.path.join(data_dir, '{}.etcd'.format(
+        local_unit().replace('/', '')))
+    if os.path.isdir(legacy_dir):
+        data_dir = legacy_dir
+    if action_get('format') == 'repository':
+        snapshot_to_repository(keys_version)
+        return
     try:
-        output = CTL.cluster_health(True)
-        action_set(dict(output=output))
-    except subprocess.CalledProcessError as e:
-        action_fail_now(e.output)
+        result = etcd_snapshot.save(action_get('target'),
+                                    action_get('compression') or 'gzip',
+                                    keys_version, data_dir, CTL)
+    except (ValueError, OSError, EtcdCtl.CommandFailed) as e:
+        action_fail_now('Snapshot failed: {}'.format(e))
+    action_set({
+        'snapshot.path': result['path'],
+        'snapshot.size': etcd_snapshot.human_size(result['size']),
+        'snapshot.bytes': result['size'],
+        'snapshot.sha256': result['sha256'],
+        'snapshot.source': result['source'],
+        'snapshot.version': CTL.version(),
+        'copy.cmd': 'juju scp {}:{} .'.format(local_unit(), result['path']),
+    })
+
+
+def snapshot_to_repository(keys_version):
+    '''Save a snapshot into a deduplicated snapshot repository.
+
+    '''
+    if keys_version != 'v3':
+        action_fail_now('Snapshot repositories only hold v3 snapshots')
+    try:
+        result = etcd_snapshot.save_to_store(action_get('target'), CTL)
+    except (ValueError, OSError, EtcdCtl.CommandFailed) as e:
+        action_fail_now('Snapshot failed: {}'.format(e))
+    action_set({
+        'snapshot.manifest': result['manifest'],
+        'snapshot.size': etcd_snapshot.human_size(result['size']),
+        'snapshot.bytes': result['size'],
+        'snapshot.sha256': result['sha256'],
+        'snapshot.source': result['source'],
+        'snapshot.chunks': result['chunks'],
+        'snapshot.new-chunks': result['new_chunks'],
+        'snapshot.new-bytes': result['new_bytes'],
+        'snapshot.version': CTL.version(),
+    })
 
 
 if __name__ == '__main__':
     ACTIONS = {
         'alarm-disarm': alarm_disarm,
         'alarm-list': alarm_list,
+        'benchmark': benchmark,
+        'charm-metrics': charm_metrics,
         'compact': compact,
         'defrag': defrag,
+        'defrag-cluster': defrag_cluster,
+        'disk-benchmark': disk_benchmark,
         'health': health,
+        'snapshot': snapshot,
     }
 
     action = action_name()
-    ACTIONS[action]()
+    try:
+        ACTIONS[action]()
+    finally:
+        # Keep the timings of the commands this action ran.
+        etcd_metrics.flush()
+        unitdata.kv().flush()
@@ -19,16 +19,25 @@ from charmhelpers.core.host import service_stop
 from etcd_lib import get_ingress_address
 from etcdctl import EtcdCtl
 from etcd_databag import EtcdDatabag
+from etcd_metrics import flush as flush_metrics
+from etcd_metrics import timed_check_call
+from etcd_metrics import timed_check_output
+from etcd_restore import V2
+from etcd_restore import V3
+from etcd_restore import stage_archive
+from etcd_restore import staging_dir
+from etcd_restore import swap_member
+from etcd_snapshot_store import load_manifest
+from etcd_snapshot_store import reassemble
 from shlex import split
 from subprocess import check_call
-from subprocess import check_output
-from subprocess import CalledProcessError
 from subprocess import Popen
 from subprocess import PIPE
 from datetime import datetime
 from uuid import uuid4
 import hashlib
 import os
+import shutil
 import sys
 import time
 import yaml
@@ -51,6 +60,7 @@ ETCD_PORT = config('management_port')
 CLUSTER_ADDRESS = get_ingress_address('cluster')
 SKIP_BACKUP = action_get('skip-backup')
 SNAPSHOT_ARCHIVE = resource_get('snapshot')
+SNAPSHOT_MANIFEST = action_get('manifest')
 TARGET_PATH = action_get('target')
 
 
@@ -59,7 +69,13 @@ def preflight_check():
     if not is_leader():
         function_fail('This action can only be run on the leader unit')
         sys.exit(0)
-    if not SNAPSHOT_ARCHIVE:
+    if SNAPSHOT_MANIFEST:
+        try:
+            load_manifest(SNAPSHOT_MANIFEST)
+        except (OSError, ValueError) as e:
+            function_fail({'result.failed': 'Invalid manifest: {}'.format(e)})
+            sys.exit(0)
+    elif not SNAPSHOT_ARCHIVE:
         function_fail({'result.failed': 'Missing snapshot. See: README.md'})
         sys.exit(0)
 
@@ -83,43 +99,49 @@ def render_backup():
                         'backup.sha256sum': backup_sum})
 
 
-def unpack_resource():
-    ''' Grab the resource path, and unpack it into $PATH '''
-    cmd = "tar xvf {0} -C {1}".format(SNAPSHOT_ARCHIVE, ETCD_DATA_DIR)
-    check_call(split(cmd))
+def load_etcd_config():
+    ''' The rendered etcd v3 configuration. '''
+    with open('/var/snap/etcd/common/etcd.conf.yml') as configfile:
+        return yaml.safe_load(configfile)
 
 
-def is_v3_backup():
-    ''' See if the backup file contains a db file indicating a v3 backup '''
-    cmd = "tar -tvf {0} --wildcards '*/db'".format(SNAPSHOT_ARCHIVE)
+def live_data_dir():
+    ''' The data directory of the running member, restores are staged
+    inside it so the result can be renamed into place. '''
     try:
-        check_call(split(cmd))
-    except CalledProcessError:
-        return False
-    return True
-
-
-def restore_v3_backup():
-    ''' Apply a v3 backup '''
-    cmd = "mkdir -p /root/tmp/restore-v3"
-    check_call(split(cmd))
-
-    cmd = "tar xvf {0} -C /root/tmp/restore-v3".format(SNAPSHOT_ARCHIVE)
-    check_call(split(cmd))
-
-    configfile = open('/var/snap/etcd/common/etcd.conf.yml', "r")
-    config = yaml.safe_load(configfile)
+        return load_etcd_config()['data-dir']
+    except (OSError, KeyError, TypeError):
+        return ETCD_DATA_DIR
+
+
+def stage_backup():
+    ''' Stream the snapshot into a staging directory on the data
+    filesystem. Returns the backup version and the staging directory. '''
+    staging = staging_dir(live_data_dir())
+    if SNAPSHOT_MANIFEST:
+        log('Reassembling the snapshot of {}'.format(SNAPSHOT_MANIFEST))
+        os.makedirs(staging)
+        reassemble(SNAPSHOT_MANIFEST, os.path.join(staging, 'db'))
+        return V3, staging
+    return stage_archive(SNAPSHOT_ARCHIVE, staging), staging
+
+
+def restore_v3_backup(staging):
+    ''' Restore the staged v3 snapshot into a new member directory next to
+    it. etcd keeps running meanwhile. '''
+    config = load_etcd_config()
     # Use the insecure 4001 port we have open in our deployment
     environ = dict(os.environ, ETCDCTL_API="3")
     cmd = "/snap/bin/etcdctl --endpoints=http://localhost:4001 snapshot " \
-          "restore /root/tmp/restore-v3/db --skip-hash-check " \
-          "--data-dir='/root/tmp/restore-v3/etcd' " \
-          "--initial-cluster='{}' --initial-cluster-token='{}' " \
-          "--initial-advertise-peer-urls='{}' --name='{}'"
+          "restore {0}/db --skip-hash-check " \
+          "--data-dir='{0}/etcd' " \
+          "--initial-cluster='{1}' --initial-cluster-token='{2}' " \
+          "--initial-advertise-peer-urls='{3}' --name='{4}'"
 
     if 'initial-cluster' in config and config['initial-cluster']:
         # configuration contains initilization params
-        cmd = cmd.format(config['initial-cluster'],
+        cmd = cmd.format(staging,
+                         config['initial-cluster'],
                          config['initial-cluster-token'],
                          config['initial-advertise-peer-urls'],
                          config['name'])
@@ -129,24 +151,21 @@ def restore_v3_backup():
         initial_cluster = '{}=https://{}:2380'.format(config['name'], CLUSTER_ADDRESS)
         initial_cluster_token = CLUSTER_ADDRESS
         initial_urls = 'https://{}:2380'.format(CLUSTER_ADDRESS)
-        cmd = cmd.format(initial_cluster,
+        cmd = cmd.format(staging,
+                         initial_cluster,
                          initial_cluster_token,
                          initial_urls,
                          config['name'])
 
-    configfile.close()
-    check_call(split(cmd), env=environ)
-
-    # Make sure we do not have anything left from any old deployments
-    cmd = "rm -rf {}/member".format(config['data-dir'])
-    check_call(split(cmd))
+    timed_check_call(split(cmd), env=environ)
 
-    cmd = "cp -r /root/tmp/restore-v3/etcd/member {}".format(config['data-dir'])
-    check_call(split(cmd))
 
-    # Clean up
-    cmd = "rm -rf /root/tmp/restore-v3"
-    check_call(split(cmd))
+def swap_in_member(source, data_dir, wal_dir=None):
+    ''' Rename the restored member into place, etcd must be stopped. '''
+    rollback = swap_member(source, data_dir, wal_dir)
+    if rollback:
+        log('Previous member kept in {}'.format(rollback))
+        action_set({'rollback.path': rollback})
 
 
 def start_etcd_forked():
@@ -176,7 +195,8 @@ def probe_forked_etcd():
 
     while b"http://localhost" not in output:
         try:
-            output = check_output(split('/snap/bin/etcd.etcdctl member list'))
+            output = timed_check_output(
+                split('/snap/bin/etcd.etcdctl member list'))
             loop = loop + 1
         except:
             log('Still waiting on forked etcd instance...')
@@ -191,7 +211,7 @@ def reconfigure_client_advertise():
     ''' Reconfigure the backup to use host network addresses for client advertise
         instead of the assumed localhost addressing '''
     cmd = "/snap/bin/etcd.etcdctl member list"
-    members = check_output(split(cmd))
+    members = timed_check_output(split(cmd))
     member_id = members.split(b':')[0].decode('utf-8')
 
     raw_update = "/snap/bin/etcd.etcdctl member update {0} http://{1}:{2}"
@@ -227,11 +247,11 @@ def dismantle_cluster():
     for name, data in etcdctl.member_list(endpoint).items():
         if name != my_name:
             log('Disconnecting {}'.format(name), hookenv.DEBUG)
-            etcdctl.unregister(data['unit_id'], endpoint)
+            etcdctl.unregister(data.unit_id, endpoint)
 
     etcd_conf.cluster_state = 'new'
     conf_path = os.path.join(etcd_conf.etcd_conf_dir, "etcd.conf.yml")
-    render('etcd3.conf', conf_path, etcd_conf.__dict__, owner='root',
+    render('etcd3.conf', conf_path, etcd_conf.context(), owner='root',
            group='root')
 
 
@@ -246,16 +266,24 @@ if __name__ == '__main__':
     log('Performing etcd snapshot restore')
     preflight_check()
     render_backup()
+    version, staging = stage_backup()
     dismantle_cluster()
-    service_stop(opts['etcd_daemon_process'])
-    if is_v3_backup():
-        restore_v3_backup()
+    if version == V3:
+        restore_v3_backup(staging)
+        config = load_etcd_config()
+        service_stop(opts['etcd_daemon_process'])
+        swap_in_member(os.path.join(staging, 'etcd'), config['data-dir'],
+                       config.get('wal-dir'))
     else:
-        unpack_resource()
+        service_stop(opts['etcd_daemon_process'])
+        swap_in_member(os.path.join(staging, V2), ETCD_DATA_DIR)
         pid = start_etcd_forked()
         probe_forked_etcd()
         reconfigure_client_advertise()
         pkill_etcd(pid)
+    shutil.rmtree(staging, ignore_errors=True)
     service_start(opts['etcd_daemon_process'])
     rebuild_cluster()
+    flush_metrics()
+    unitdata.kv().flush()
     _run_atexit()
@@ -0,0 +1,278 @@
+''' A load generator measuring what the cluster can sustain.
+
+The benchmark action runs a weighted mix of puts, ranges, txns and watches
+for a fixed duration from a number of worker threads, each holding its own
+gateway connection to one of the member client URLs and authenticating with
+the client TLS credentials, as a real client would. Every operation is timed
+and the throughput and p50/p95/p99/p999 latency of each operation type is
+reported.
+
+A watch is timed from the put on a watched key until the event arrives, so
+it measures the notification latency rather than setting up the stream.
+
+The workload runs under a prefix of its own, which is deleted afterwards.
+Runs are kept in unitdata with the charm and snap revisions they ran
+against, so tuning changes and upgrades can be compared with earlier runs.
+'''
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import charm_dir
+from charms import layer
+
+from etcd_gateway import EtcdGateway
+from etcd_metrics import percentile
+from etcdctl import snap_revision
+
+import base64
+import bisect
+import os
+import random
+import threading
+import time
+
+RESULTS_KEY = 'etcd.benchmark'
+# Runs kept, oldest are dropped first
+HISTORY = 20
+PREFIX = '/charm-benchmark/'
+OPERATIONS = ('put', 'range', 'txn', 'watch')
+PERCENTILES = (('p50', 50), ('p95', 95), ('p99', 99), ('p999', 99.9))
+DEFAULT_MIX = 'put=40,range=40,txn=10,watch=10'
+
+
+def parse_mix(text):
+    ''' Parse a mix such as "put=40,range=40,txn=10,watch=10" into a dict of
+    operation to weight. Raises ValueError for unknown operations and
+    weights that are not integers or are negative. '''
+    mix = {}
+    for item in (text or DEFAULT_MIX).split(','):
+        name, _, weight = item.strip().partition('=')
+        if name not in OPERATIONS:
+            raise ValueError('unknown operation {!r}, expected one of '
+                             '{}'.format(name, ', '.join(OPERATIONS)))
+        try:
+            weight = int(weight)
+        except ValueError:
+            raise ValueError('{} needs a weight, eg {}=10'.format(name, name))
+        if weight < 0:
+            raise ValueError('{} weight must not be negative'.format(name))
+        if weight:
+            mix[name] = weight
+    if not mix:
+        raise ValueError('the mix must include at least one operation')
+    return mix
+
+
+def encode(data):
+    ''' The gateway takes keys and values as base64. '''
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return base64.b64encode(data).decode('ascii')
+
+
+def prefix_end(prefix):
+    ''' The range_end covering every key under prefix. '''
+    data = prefix.encode('utf-8')
+    return data[:-1] + bytes([data[-1] + 1])
+
+
+def keyspace(prefix, keys, key_size):
+    ''' The names of keys keys of key_size bytes under prefix. '''
+    digits = max(len(str(keys - 1)), key_size - len(prefix))
+    return ['{}{:0{}d}'.format(prefix, index, digits)
+            for index in range(keys)]
+
+
+def put(gateway, key, value):
+    gateway.call('kv/put', {'key': encode(key), 'value': value})
+
+
+def get(gateway, key, value):
+    gateway.call('kv/range', {'key': encode(key)})
+
+
+def txn(gateway, key, value):
+    ''' A compare and swap, succeeding whether or not the key exists. '''
+    gateway.call('kv/txn', {
+        'compare': [{'key': encode(key), 'target': 'VERSION',
+                     'result': 'GREATER', 'version': '-1'}],
+        'success': [{'request_put': {'key': encode(key), 'value': value}}],
+        'failure': [{'request_range': {'key': encode(key)}}],
+    })
+
+
+def watch(gateway, key, value):
+    ''' Watch key, put it, and return the seconds until the event arrives.
+    The stream runs on a connection of its own. '''
+    stream = gateway.stream('watch', {'create_request': {'key': encode(key)}})
+    try:
+        next(stream)
+        start = time.time()
+        put(gateway, key, value)
+        for message in stream:
+            if message.get('events'):
+                return time.time() - start
+        raise EtcdGateway.Unavailable('watch on {} closed'.format(key))
+    finally:
+        stream.close()
+
+
+RUNNERS = {'put': put, 'range': get, 'txn': txn, 'watch': watch}
+
+
+def worker(connect, endpoint, mix, keys, value, deadline, samples, errors):
+    ''' Run operations picked at random by weight until deadline, appending
+    the seconds each took to samples and counting failures in errors. '''
+    names = sorted(mix)
+    cumulative = []
+    for name in names:
+        cumulative.append((cumulative[-1] if cumulative else 0) + mix[name])
+    rng = random.Random()
+    gateway = connect(endpoint)
+    try:
+        while time.time() < deadline:
+            pick = rng.randrange(cumulative[-1])
+            operation = names[bisect.bisect_right(cumulative, pick)]
+            key = keys[rng.randrange(len(keys))]
+            start = time.time()
+            try:
+                seconds = RUNNERS[operation](gateway, key, value)
+            except (EtcdGateway.Unavailable, EtcdGateway.RequestFailed):
+                errors[operation] = errors.get(operation, 0) + 1
+                continue
+            samples.setdefault(operation, []).append(
+                time.time() - start if seconds is None else seconds)
+    finally:
+        gateway.close()
+
+
+def summarise(samples, errors, elapsed):
+    ''' Returns the throughput and latency percentiles, in milliseconds, of
+    every operation type as a dict of operation to stats. '''
+    result = {}
+    for operation in sorted(set(samples) | set(errors)):
+        times = sorted(samples.get(operation, []))
+        stats = {'count': len(times),
+                 'errors': errors.get(operation, 0),
+                 'ops-per-sec': round(len(times) / elapsed, 1)}
+        for name, pct in PERCENTILES:
+            value = percentile(times, pct)
+            stats[name] = None if value is None else round(value * 1000, 3)
+        result[operation] = stats
+    return result
+
+
+def run(endpoints, connect, mix=None, key_size=32, value_size=256,
+        keys=1000, concurrency=8, duration=30, prefix=PREFIX):
+    ''' Run the workload against endpoints and return its summary.
+
+    @params endpoints - client URLs the workers are spread across
+    @params connect - returns a gateway for an endpoint
+    @params mix - operation weights, see parse_mix()
+    @params key_size, value_size - bytes per key and value
+    @params keys - the number of keys the operations are spread across
+    @params concurrency - the number of workers, each with a connection
+    @params duration - seconds to run for
+    '''
+    mix = mix or parse_mix(DEFAULT_MIX)
+    names = keyspace(prefix, keys, key_size)
+    value = encode(os.urandom(value_size))
+
+    # Ranges and txns find every key in place
+    gateway = connect(endpoints[0])
+    try:
+        for key in names:
+            put(gateway, key, value)
+    finally:
+        gateway.close()
+
+    samples = [{} for _ in range(concurrency)]
+    errors = [{} for _ in range(concurrency)]
+    start = time.time()
+    threads = []
+    for index in range(concurrency):
+        endpoint = endpoints[index % len(endpoints)]
+        threads.append(threading.Thread(target=worker, args=(
+            connect, endpoint, mix, names, value, start + duration,
+            samples[index], errors[index])))
+    try:
+        for thread in threads:
+            thread.start()
+    finally:
+        for thread in threads:
+            if thread.is_alive():
+                thread.join()
+        elapsed = max(time.time() - start, 0.001)
+        cleanup(connect(endpoints[0]), prefix)
+
+    merged_samples, merged_errors = {}, {}
+    for index in range(concurrency):
+        for operation, times in samples[index].items():
+            merged_samples.setdefault(operation, []).extend(times)
+        for operation, count in errors[index].items():
+            merged_errors[operation] = \
+                merged_errors.get(operation, 0) + count
+    operations = summarise(merged_samples, merged_errors, elapsed)
+    return {
+        'operations': operations,
+        'ops-per-sec': round(sum(s['count'] for s in operations.values()) /
+                             elapsed, 1),
+        'elapsed': round(elapsed, 1),
+    }
+
+
+def cleanup(gateway, prefix=PREFIX):
+    ''' Delete every key the workload wrote. '''
+    try:
+        gateway.call('kv/deleterange', {
+            'key': encode(prefix), 'range_end': encode(prefix_end(prefix))})
+    finally:
+        gateway.close()
+
+
+def client_gateway(timeout=10):
+    ''' Returns a function connecting to an endpoint with the client TLS
+    credentials. '''
+    opts = layer.options('tls-client')
+
+    def connect(endpoint):
+        return EtcdGateway(endpoint, opts['ca_certificate_path'],
+                           opts['client_certificate_path'],
+                           opts['client_key_path'], timeout=timeout)
+    return connect
+
+
+def charm_revision():
+    ''' The revision of the charm, or its build version when deployed from
+    a local build, or None. '''
+    for name in ('revision', 'version'):
+        try:
+            with open(os.path.join(charm_dir(), name)) as fp:
+                return fp.read().strip() or None
+        except OSError:
+            continue
+    return None
+
+
+def runs():
+    ''' The runs recorded so far, oldest first. '''
+    return list(unitdata.kv().get(RESULTS_KEY) or [])
+
+
+def record(workload, result, version=None):
+    ''' Keep a run, with the revisions it ran against, in unitdata and
+    return it. '''
+    entry = {'started': int(time.time()),
+             'charm-revision': charm_revision(),
+             'snap-revision': snap_revision(),
+             'etcd-version': version,
+             'workload': workload,
+             'result': result}
+    unitdata.kv().set(RESULTS_KEY, (runs() + [entry])[-HISTORY:])
+    return entry
+
+
+def baseline(workload):
+    ''' The latest recorded run of the same workload, or None. '''
+    for previous in reversed(runs()):
+        if previous['workload'] == workload:
+            return previous
+    return None
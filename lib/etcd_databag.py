@@ -1,4 +1,3 @@
-from charms import layer
 from charmhelpers.core.hookenv import unit_get
 from charmhelpers.core.hookenv import config
 from charmhelpers.core.hookenv import is_leader
@@ -7,17 +6,42 @@ from charmhelpers.core import unitdata
 from charms.reactive import is_state
 from etcd_lib import get_ingress_address
 from etcd_lib import get_bind_address
+from etcd_lib import layer_options
+from etcd_maintenance import config_compaction
+from etcd_tuning import config_tuning
+import etcd_rtt
 
 import string
 import random
 import os
 
+# Where the optional wal storage is mounted, and the wal directory on it
+WAL_MOUNT = '/media/etcd-wal'
+WAL_PATH = WAL_MOUNT + '/wal'
+
+
+class cached_property:
+    ''' Compute an attribute on first access and store it on the instance.
+    Later reads (and assignments) go straight to the instance __dict__. '''
+
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.func.__name__] = self.func(instance)
+        return value
+
 
 class EtcdDatabag:
     '''
     This class represents a configuration object to ease configuration of an
-    etcd unit during deployment and reconfiguration. The full dict of data
-    when expanded looks like the following:
+    etcd unit during deployment and reconfiguration. Every datapoint is
+    computed lazily on first access, so building a bag is free and only the
+    hook tools a handler actually needs are called. The full dict of data
+    when expanded with context() looks like the following:
 
     {'public_address': '127.0.0.1',
      'cluster_bind_address': '127.0.0.1',
@@ -31,43 +55,118 @@ class EtcdDatabag:
      'server_certificate': '/etc/ssl/etcd/server.crt',
      'server_key': '/etc/ssl/etcd/server.key',
      'token': '8XG27B',
-     'cluster_state': 'existing'}
+     'cluster_state': 'existing',
+     'wal_path': '',
+     'tuning': {'snapshot-count': 10000, 'heartbeat-interval': 100, ...}}
     '''
 
     def __init__(self):
         self.db = unitdata.kv()
-        self.cluster_bind_address = self.get_bind_address('cluster')
-        self.db_bind_address = self.get_bind_address('db')
-        self.port = config('port')
-        self.management_port = config('management_port')
-        # Live polled properties
-        self.public_address = unit_get('public-address')
-        self.cluster_address = get_ingress_address('cluster')
-        self.db_address = get_ingress_address('db')
-        self.unit_name = os.getenv('JUJU_UNIT_NAME').replace('/', '')
-
-        # Pull the TLS certificate paths from layer data
-        tls_opts = layer.options('tls-client')
-        ca_path = tls_opts['ca_certificate_path']
-        crt_path = tls_opts['server_certificate_path']
-        key_path = tls_opts['server_key_path']
-
-        # Pull the static etcd configuration from layer-data
-        etcd_opts = layer.options('etcd')
-        self.etcd_conf_dir = etcd_opts['etcd_conf_dir']
+
+    def context(self):
+        ''' Return every datapoint of the bag as a dict, suitable for
+        rendering templates. '''
+        for name, attr in vars(EtcdDatabag).items():
+            if isinstance(attr, cached_property):
+                getattr(self, name)
+        return {k: v for k, v in self.__dict__.items() if k != 'db'}
+
+    @cached_property
+    def cluster_bind_address(self):
+        return self.get_bind_address('cluster')
+
+    @cached_property
+    def db_bind_address(self):
+        return self.get_bind_address('db')
+
+    @cached_property
+    def port(self):
+        return config('port')
+
+    @cached_property
+    def management_port(self):
+        return config('management_port')
+
+    # Plain HTTP /metrics listener for Prometheus, 0 when disabled
+    @cached_property
+    def metrics_port(self):
+        return config('metrics_port') or 0
+
+    @cached_property
+    def public_address(self):
+        return unit_get('public-address')
+
+    @cached_property
+    def cluster_address(self):
+        return get_ingress_address('cluster')
+
+    @cached_property
+    def db_address(self):
+        return get_ingress_address('db')
+
+    @cached_property
+    def unit_name(self):
+        return os.getenv('JUJU_UNIT_NAME').replace('/', '')
+
+    # Pull the TLS certificate paths from layer data
+    @cached_property
+    def ca_certificate(self):
+        return layer_options('tls-client')['ca_certificate_path']
+
+    @cached_property
+    def server_certificate(self):
+        return layer_options('tls-client')['server_certificate_path']
+
+    @cached_property
+    def server_key(self):
+        return layer_options('tls-client')['server_key_path']
+
+    # Pull the static etcd configuration from layer-data
+    @cached_property
+    def etcd_conf_dir(self):
+        return layer_options('etcd')['etcd_conf_dir']
+
+    @cached_property
+    def etcd_data_dir(self):
         # This getter determines the current context of the storage path
         # depending on if durable storage is mounted.
-        self.etcd_data_dir = self.storage_path()
-        self.etcd_daemon = etcd_opts['etcd_daemon_process']
-
-        self.ca_certificate = ca_path
-        self.server_certificate = crt_path
-        self.server_key = key_path
-
-        # Cluster concerns
-        self.cluster = self.db.get('etcd.cluster', '')
-        self.token = self.cluster_token()
-        self.cluster_state = self.db.get('etcd.cluster-state', 'existing')
+        return self.storage_path()
+
+    @cached_property
+    def wal_path(self):
+        # A dedicated wal directory, set once wal storage is mounted.
+        if is_state('wal.volume.attached'):
+            return WAL_PATH
+        return ''
+
+    @cached_property
+    def etcd_daemon(self):
+        return layer_options('etcd')['etcd_daemon_process']
+
+    # Server tuning from the performance_profile and performance_overrides,
+    # with the timeouts the leader derived from peer RTT when rtt_tuning is on
+    @cached_property
+    def tuning(self):
+        measured = etcd_rtt.published() if etcd_rtt.enabled() else None
+        return config_tuning(measured)[0]
+
+    # Auto compaction of the key history, empty when disabled
+    @cached_property
+    def compaction(self):
+        return config_compaction()[0]
+
+    # Cluster concerns
+    @cached_property
+    def cluster(self):
+        return self.db.get('etcd.cluster', '')
+
+    @cached_property
+    def token(self):
+        return self.cluster_token()
+
+    @cached_property
+    def cluster_state(self):
+        return self.db.get('etcd.cluster-state', 'existing')
 
     def set_cluster(self, value):
         ''' Set the cluster string for peer registration '''
@@ -101,7 +200,7 @@ class EtcdDatabag:
         attach durable storage, which is mounted in /media. We need a common
         method to determine which storage path we are concerned with '''
 
-        etcd_opts = layer.options('etcd')
+        etcd_opts = layer_options('etcd')
 
         if is_state('data.volume.attached'):
             return "/media/etcd/data"
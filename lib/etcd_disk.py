@@ -0,0 +1,110 @@
+''' Measure the fsync latency of the disk etcd writes its WAL to.
+
+etcd fdatasyncs every WAL append before acknowledging a proposal, so a disk
+with slow syncs shows up as leader elections and failed proposals rather
+than as plain slowness. Before a unit first starts etcd, it appends
+WRITE_SIZE byte records with an fdatasync after each to a file in the
+directory the WAL goes to, like the fio job the etcd documentation
+suggests, and blocks when the p99 is above disk_fsync_p99_blocked.
+Above disk_fsync_p99_warning the unit still joins but says so in its
+status.
+
+Measurements are kept in unitdata per path, so the check runs once rather
+than on every hook. The disk-benchmark action measures again and replaces
+the kept measurement, so a unit blocked on a disk that has since been
+fixed proceeds once the action has run.
+'''
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import config
+
+from etcd_metrics import percentile
+
+import os
+import time
+
+RESULTS_KEY = 'etcd.disk-preflight'
+TEST_FILE = '.charm-fsync-test'
+# The size of a typical WAL record, and the data the fio job writes
+WRITE_SIZE = 2300
+MAX_BYTES = 22 * 1024 * 1024
+PERCENTILES = (('p50', 50), ('p95', 95), ('p99', 99), ('p999', 99.9))
+
+
+def fsync_benchmark(path, seconds=10, write_size=WRITE_SIZE,
+                    max_bytes=MAX_BYTES):
+    ''' Append write_size byte records with an fdatasync after each to a
+    file in path, for seconds or until max_bytes are written, and return
+    the latency percentiles and the maximum in milliseconds. '''
+    os.makedirs(path, exist_ok=True)
+    test_file = os.path.join(path, TEST_FILE)
+    data = os.urandom(write_size)
+    times = []
+    fd = os.open(test_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        start = time.time()
+        written = 0
+        while written < max_bytes and time.time() - start < seconds:
+            before = time.time()
+            os.write(fd, data)
+            os.fdatasync(fd)
+            times.append(time.time() - before)
+            written += write_size
+        elapsed = max(time.time() - start, 0.001)
+    finally:
+        os.close(fd)
+        os.remove(test_file)
+
+    times.sort()
+    result = {'path': path, 'checked': int(time.time()),
+              'writes': len(times), 'write-size': write_size,
+              'writes-per-sec': round(len(times) / elapsed, 1),
+              'max': round(times[-1] * 1000, 3) if times else None}
+    for name, pct in PERCENTILES:
+        value = percentile(times, pct)
+        result[name] = None if value is None else round(value * 1000, 3)
+    return result
+
+
+def thresholds():
+    ''' The (warning, blocked) p99 thresholds in milliseconds, 0 when
+    disabled. '''
+    return (float(config('disk_fsync_p99_warning') or 0),
+            float(config('disk_fsync_p99_blocked') or 0))
+
+
+def verdict(result, warning, blocked):
+    ''' Returns ('blocked' or 'warning', message) when the measured p99 is
+    above a threshold, or (None, None). '''
+    p99 = result.get('p99')
+    if p99 is None:
+        return None, None
+    for level, threshold in (('blocked', blocked), ('warning', warning)):
+        if threshold and p99 > threshold:
+            return level, 'Disk fsync p99 {}ms above {}ms on {}'.format(
+                p99, threshold, result['path'])
+    return None, None
+
+
+def measured(path):
+    ''' The kept measurement of path, or None. '''
+    return (unitdata.kv().get(RESULTS_KEY) or {}).get(path)
+
+
+def remember(result):
+    ''' Keep a measurement, replacing the previous one of its path. '''
+    db = unitdata.kv()
+    results = db.get(RESULTS_KEY) or {}
+    results[result['path']] = result
+    db.set(RESULTS_KEY, results)
+    return result
+
+
+def preflight(path, seconds=None):
+    ''' The kept measurement of path, measuring it first if there is none.
+    '''
+    result = measured(path)
+    if result is None:
+        if seconds is None:
+            seconds = config('disk_preflight_seconds')
+        result = remember(fsync_benchmark(path, seconds))
+    return result
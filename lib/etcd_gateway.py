@@ -0,0 +1,216 @@
+''' A minimal client for the etcd v3 JSON gateway.
+
+The gateway speaks the same v3 API as etcdctl, but over plain HTTP/1.1 so a
+single keep-alive connection (and a single TLS handshake) can be reused for
+every call made during a hook. Only the standard library is used here so the
+module can also be imported by scripts running outside of a hook context.
+'''
+from http.client import HTTPConnection
+from http.client import HTTPException
+from http.client import HTTPSConnection
+from http.client import RemoteDisconnected
+from urllib.parse import urlparse
+
+import json
+import ssl
+
+# gRPC status codes of failures that concern the endpoint rather than the
+# request, so another member may serve it: DEADLINE_EXCEEDED,
+# RESOURCE_EXHAUSTED and UNAVAILABLE. etcd reports timeouts, a lost leader,
+# learners refusing an RPC and members that are "not capable" with these.
+ENDPOINT_CODES = (4, 8, 14)
+# HTTP statuses of a member or proxy that cannot serve any request
+ENDPOINT_STATUSES = (502, 503, 504)
+
+
+class EtcdGateway:
+    ''' A persistent connection to the JSON gateway of one etcd endpoint. '''
+
+    class Unavailable(Exception):
+        ''' The endpoint could not be reached, callers may fall back to
+        etcdctl. '''
+        pass
+
+    class RequestFailed(Exception):
+        ''' The endpoint was reached but rejected the request. code is the
+        gRPC status code of the failure and status the HTTP status, when
+        known. '''
+
+        def __init__(self, message, code=None, status=None):
+            super().__init__(message)
+            self.code = code
+            self.status = status
+
+        @property
+        def endpoint_specific(self):
+            ''' Whether the failure concerns this endpoint rather than the
+            request, which may then succeed on another member. '''
+            return (self.code in ENDPOINT_CODES or
+                    (self.code is None and self.status in ENDPOINT_STATUSES))
+
+    def __init__(self, endpoint, ca_path=None, cert_path=None, key_path=None,
+                 timeout=5):
+        ''' @params endpoint - a URL such as https://10.0.0.1:2379
+        @params ca_path, cert_path, key_path - TLS material used for https
+        endpoints.
+        @params timeout - socket timeout in seconds for dial and reads.
+        '''
+        url = urlparse(endpoint)
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            raise ValueError('Unsupported etcd endpoint {}'.format(endpoint))
+        self.endpoint = endpoint
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port or (2379 if url.scheme == 'https' else 80)
+        self.timeout = timeout
+        self.ca_path = ca_path
+        self.cert_path = cert_path
+        self.key_path = key_path
+        self._conn = None
+        self._prefix = None
+        self._version = None
+
+    def _connect(self, timeout=None):
+        timeout = timeout or self.timeout
+        if self.scheme == 'https':
+            context = ssl.create_default_context(cafile=self.ca_path)
+            if self.cert_path and self.key_path:
+                context.load_cert_chain(self.cert_path, self.key_path)
+            return HTTPSConnection(self.host, self.port, timeout=timeout,
+                                   context=context)
+        return HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def close(self):
+        ''' Drop the underlying connection. '''
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _request(self, method, path, body=None, timeout=None):
+        ''' Issue a request on the shared connection, reconnecting once if
+        the server closed an idle keep-alive connection under us.
+
+        @params timeout - the socket timeout in seconds of this request,
+        defaults to the timeout of the gateway
+        '''
+        timeout = timeout or self.timeout
+        payload = None
+        headers = {}
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+
+        while True:
+            reused = self._conn is not None
+            try:
+                if not reused:
+                    self._conn = self._connect(timeout)
+                elif self._conn.sock is not None:
+                    # The connection is shared, a previous request may
+                    # have left a different timeout on it
+                    self._conn.sock.settimeout(timeout)
+                self._conn.request(method, path, body=payload,
+                                   headers=headers)
+                response = self._conn.getresponse()
+                data = response.read()
+                return response.status, data
+            except (HTTPException, OSError) as e:
+                self.close()
+                # Only a keep-alive connection the server closed while idle
+                # is known not to have delivered the request. Anything else,
+                # such as a timeout waiting for the response, may have been
+                # applied, and resending a member add or a compaction could
+                # apply it twice.
+                if reused and isinstance(e, (RemoteDisconnected,
+                                             BrokenPipeError)):
+                    continue
+                raise EtcdGateway.Unavailable(
+                    '{}: {}'.format(self.endpoint, e)) from e
+
+    def _decode(self, path, status, data):
+        try:
+            result = json.loads(data.decode('utf-8')) if data else {}
+        except ValueError:
+            result = {'error': data.decode('utf-8', 'replace')}
+        if status == 200 and 'error' not in result:
+            return result
+        # Streams report errors as {"error": {"grpc_code": ...}}
+        error = result.get('error')
+        if isinstance(error, dict):
+            result = dict(error, code=error.get('grpc_code'))
+        message = result.get('message') or result.get('error') or status
+        code = result.get('code')
+        if not isinstance(code, int):
+            code = None
+        raise EtcdGateway.RequestFailed(
+            '{}{}: {}'.format(self.endpoint, path, message), code, status)
+
+    def version(self):
+        ''' Return the /version document, eg:
+        {'etcdserver': '3.4.13', 'etcdcluster': '3.4.0'} '''
+        if self._version is None:
+            status, data = self._request('GET', '/version')
+            self._version = self._decode('/version', status, data)
+        return self._version
+
+    def metrics(self):
+        ''' Return the Prometheus text exposition of /metrics. '''
+        status, data = self._request('GET', '/metrics')
+        if status != 200:
+            raise EtcdGateway.RequestFailed('{}/metrics: {}'.format(
+                self.endpoint, status), status=status)
+        return data.decode('utf-8')
+
+    def prefix(self):
+        ''' The gateway was served under /v3alpha in 3.2 and /v3beta in 3.3
+        before settling on /v3 in 3.4. '''
+        if self._prefix is None:
+            cluster = self.version().get('etcdcluster', '')
+            try:
+                major_minor = tuple(int(x) for x in cluster.split('.')[:2])
+            except ValueError:
+                # 'not_decided' until the cluster version is negotiated
+                major_minor = (3, 4)
+            if major_minor >= (3, 4):
+                self._prefix = '/v3'
+            elif major_minor == (3, 3):
+                self._prefix = '/v3beta'
+            else:
+                self._prefix = '/v3alpha'
+        return self._prefix
+
+    def call(self, rpc, body=None, timeout=None):
+        ''' POST a JSON body to an RPC path such as "cluster/member/list"
+        and return the decoded JSON response. '''
+        path = '{}/{}'.format(self.prefix(), rpc)
+        status, data = self._request('POST', path, body or {}, timeout)
+        return self._decode(path, status, data)
+
+    def stream(self, rpc, body=None, timeout=None):
+        ''' POST to a server streaming RPC such as "maintenance/snapshot"
+        and yield the result of each message. The gateway writes one JSON
+        document per line. A dedicated connection is used, so the shared one
+        stays available while the stream is consumed. '''
+        path = '{}/{}'.format(self.prefix(), rpc)
+        payload = json.dumps(body or {}).encode('utf-8')
+        conn = self._connect(timeout)
+        try:
+            conn.request('POST', path, body=payload,
+                         headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            if response.status != 200:
+                self._decode(path, response.status, response.read())
+            for line in response:
+                if line.strip():
+                    message = self._decode(path, 200, line)
+                    yield message.get('result', message)
+        except (HTTPException, OSError) as e:
+            raise EtcdGateway.Unavailable(
+                '{}: {}'.format(self.endpoint, e)) from e
+        finally:
+            conn.close()
+
+
+def split_endpoints(endpoints):
+    ''' Split a comma separated endpoint string into a list. '''
+    return [e.strip() for e in endpoints.split(',') if e.strip()]
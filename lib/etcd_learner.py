@@ -0,0 +1,98 @@
+''' Learner based member addition.
+
+On etcd 3.4 and later a unit joins the cluster as a raft learner: a member
+that receives the log but does not vote, so it cannot cost the cluster its
+quorum while it copies a large database. The unit tracks how many entries
+its applied index trails the raft leader's index by, and promotes itself to
+a voting member once the lag is within the learner_promotion_lag option.
+'''
+from charmhelpers.core.hookenv import config
+from charmhelpers.core.hookenv import leader_get
+from charmhelpers.core.hookenv import log
+from etcd_gateway import split_endpoints
+from etcdctl import EtcdCtl
+from etcdctl import known_endpoints
+
+import time
+
+# Seconds promote() waits for the learner to catch up in one hook, polling
+# at POLL_INTERVAL. Later hooks carry on where it left off.
+PROMOTION_TIMEOUT = 60
+POLL_INTERVAL = 2
+
+
+def promotion_lag():
+    ''' Raft entries a learner may trail the leader by to be promoted. '''
+    return max(0, int(config('learner_promotion_lag') or 0))
+
+
+def leader_status(local, etcdctl):
+    ''' The status of the raft leader local reports, read from the leader
+    itself. A learner refuses most RPCs, including MemberList, so the local
+    member is never asked: the leader is found among the address the
+    leadership data publishes and the members seen by the last member list.
+    Returns None when no candidate is the leader. '''
+    candidates = split_endpoints(leader_get('leader_address') or '')
+    candidates += [url for url in known_endpoints() if url not in candidates]
+    for url in candidates:
+        try:
+            status = etcdctl.endpoint_status(url)[0]
+        except (EtcdCtl.CommandFailed, IndexError):
+            continue
+        if status.member_id == local.leader:
+            return status
+    return None
+
+
+def statuses(etcdctl):
+    ''' Returns the status of the local member and of the raft leader, the
+    latter None when it cannot be read. '''
+    local = etcdctl.endpoint_status()[0]
+    if local.errors or int(local.leader, 16) == 0:
+        return local, None
+    return local, leader_status(local, etcdctl)
+
+
+def learner_lag(etcdctl=None):
+    ''' Returns whether the local member is a learner, and how many raft
+    entries its applied index trails the raft leader's index by, or None
+    when either status cannot be read. '''
+    etcdctl = etcdctl or EtcdCtl()
+    try:
+        local, leader = statuses(etcdctl)
+    except (EtcdCtl.CommandFailed, IndexError, ValueError):
+        return True, None
+    if leader is None:
+        return local.is_learner, None
+    return (local.is_learner,
+            max(0, leader.raft_index - local.raft_applied_index))
+
+
+def promote(timeout=PROMOTION_TIMEOUT, etcdctl=None):
+    ''' Promote the local learner once it has caught up, waiting up to
+    timeout seconds. Returns True when the member votes. '''
+    etcdctl = etcdctl or EtcdCtl()
+    threshold = promotion_lag()
+    deadline = time.time() + timeout
+    while True:
+        learner, lag = learner_lag(etcdctl)
+        if not learner:
+            return True
+        if lag is not None and lag <= threshold:
+            try:
+                local, leader = statuses(etcdctl)
+                etcdctl.member_promote(local.member_id,
+                                       leader.endpoint if leader else None)
+            except (EtcdCtl.CommandFailed, IndexError, ValueError) as e:
+                # etcd applies its own readiness check on top of ours
+                log('Learner promotion refused: {}'.format(e), 'WARNING')
+            else:
+                log('Promoted to a voting member with a lag of {}'.format(
+                    lag))
+                return True
+        else:
+            log('Learner lag is {}, waiting for {} or less'.format(
+                lag, threshold), 'DEBUG')
+        if time.time() >= deadline:
+            return False
+        time.sleep(POLL_INTERVAL)
@@ -1,20 +1,50 @@
+from charms import layer
 from charmhelpers.contrib.templating.jinja import render
 from charmhelpers.core.hookenv import (
+    local_unit,
     network_get,
+    related_units,
+    relation_get,
+    relation_ids,
+    relation_set,
     unit_private_ip,
 )
+from functools import lru_cache
 
+import grp
+import hashlib
 import json
+import os
+import pwd
+import tempfile
 
 GRAFANA_DASHBOARD_FILE = 'grafana_dashboard.json.j2'
+PEER_RELATION = 'cluster'
+
+
+@lru_cache(maxsize=None)
+def layer_options(section):
+    ''' Memoized layer.options(); the layer.yaml does not change during a
+    hook. '''
+    return layer.options(section)
+
+
+@lru_cache(maxsize=None)
+def cached_network_get(endpoint_name):
+    ''' Memoized network_get(). Every call is a round trip to the Juju agent
+    and the answer does not change during a hook. Returns None when
+    network-get is not available. '''
+    try:
+        return network_get(endpoint_name)
+    except NotImplementedError:
+        return None
 
 
 def get_ingress_addresses(endpoint_name):
     ''' Returns all ingress-addresses belonging to the named endpoint, if
     available. Falls back to private-address if necessary. '''
-    try:
-        data = network_get(endpoint_name)
-    except NotImplementedError:
+    data = cached_network_get(endpoint_name)
+    if data is None:
         return [unit_private_ip()]
 
     if 'ingress-addresses' in data:
@@ -37,9 +67,8 @@ def get_bind_address(endpoint_name):
         @param endpoint_name the endpoint from where taking the
         bind address
     '''
-    try:
-        data = network_get(endpoint_name)
-    except NotImplementedError:
+    data = cached_network_get(endpoint_name)
+    if data is None:
         return unit_private_ip()
 
     # Consider that network-get returns something like:
@@ -76,6 +105,93 @@ def get_bind_address(endpoint_name):
     return unit_private_ip()
 
 
+def peer_relation_id():
+    ''' Returns the relation id of the cluster peer relation, or None
+    before it is established. '''
+    ids = relation_ids(PEER_RELATION)
+    return ids[0] if ids else None
+
+
+def peer_units():
+    ''' Returns the names of the other units on the peer relation. '''
+    rid = peer_relation_id()
+    return sorted(related_units(rid)) if rid else []
+
+
+def get_peer_data(key):
+    ''' Returns a dict of unit name to the value every unit, including this
+    one, has published for key on the peer relation. Raw relation data is
+    used so any handler can read it, not only the interface's own. '''
+    rid = peer_relation_id()
+    if not rid:
+        return {}
+    data = {}
+    for unit in peer_units() + [local_unit()]:
+        value = relation_get(key, unit, rid)
+        if value:
+            data[unit] = value
+    return data
+
+
+def set_peer_data(settings):
+    ''' Publishes settings for this unit on the peer relation. Returns
+    False if the relation is not established yet. '''
+    rid = peer_relation_id()
+    if not rid:
+        return False
+    relation_set(rid, settings)
+    return True
+
+
+def file_hash(path):
+    ''' Return the sha256 hex digest of a file, or None if it is missing.
+    '''
+    try:
+        with open(path, 'rb') as fp:
+            return hashlib.sha256(fp.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def write_if_changed(path, content, owner='root', group='root', perms=0o444):
+    ''' Atomically replace path with content, unless it already holds
+    exactly that content. Returns True if the file was written.
+
+        @param content the str or bytes to write
+    '''
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    if file_hash(path) == hashlib.sha256(content).hexdigest():
+        return False
+
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    # Stage next to the target so the rename cannot cross filesystems.
+    fd, staging = tempfile.mkstemp(dir=directory,
+                                   prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(content)
+            fp.flush()
+            os.fchown(fp.fileno(), pwd.getpwnam(owner).pw_uid,
+                      grp.getgrnam(group).gr_gid)
+            os.fchmod(fp.fileno(), perms)
+            os.fsync(fp.fileno())
+        os.replace(staging, path)
+    except BaseException:
+        if os.path.exists(staging):
+            os.unlink(staging)
+        raise
+    return True
+
+
+def systemd_quote(value):
+    ''' Escape value for a double quoted argument of a systemd unit, so
+    spaces, quotes, backslashes and % specifiers are passed on verbatim. '''
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('%', '%%'))
+
+
 def render_grafana_dashboard(datasource):
     """Load grafana dashboard json model and insert prometheus datasource.
 
@@ -0,0 +1,420 @@
+''' Cluster wide keyspace maintenance.
+
+Defragmenting a member rewrites its whole backend and blocks its reads and
+writes meanwhile, so the cluster is defragmented one member at a time:
+followers first and the raft leader last, so leadership is disturbed at
+most once. Before each member the cluster must be healthy, with every member
+agreeing on a leader and within MAX_RAFT_LAG entries of it. Members whose
+database is mostly in use have little to reclaim and are skipped.
+
+The leader also watches the database size of every member against the
+backend quota. When a member raises the NOSPACE alarm, which leaves the
+cluster read only, or grows past quota_remediation_ratio of the quota, the
+leader compacts the history, defragments every member in turn and disarms
+the alarm, checking the outcome of each step before the next. So that no
+hook of the leader runs for the length of a rolling defrag, remediation
+takes one step per hook, each gated on a single health check, and keeps its
+progress in unitdata:
+
+    etcd.maintenance.remediation  {"step": "compact", "defrag" or "disarm",
+                                   "pending": [...], "sizes": {...},
+                                   "since": ...}
+'''
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import config
+from charmhelpers.core.hookenv import log
+from etcd_gateway import split_endpoints
+from etcd_restart import MAX_RAFT_LAG
+from etcd_tuning import GIB
+from etcd_tuning import parse_duration
+from etcdctl import EtcdCtl
+from etcdctl import invalidate_snapshots
+
+import re
+import time
+
+# Members using more than this share of their database file are skipped
+MAX_IN_USE_RATIO = 0.8
+# Seconds the cluster has to recover between members, polling at
+# GATE_INTERVAL
+GATE_TIMEOUT = 120
+GATE_INTERVAL = 2
+# Seconds a remediation step may wait, hook after hook, for the cluster to
+# be healthy before the remediation is abandoned
+STEP_TIMEOUT = 1800
+COMPACTION_MODES = ('periodic', 'revision')
+# The backend quota etcd applies when quota-backend-bytes is 0
+DEFAULT_QUOTA = 2 * GIB
+# Seconds between checks of the database sizes, and between remediations
+# not forced by a NOSPACE alarm
+CHECK_INTERVAL = 300
+REMEDIATION_INTERVAL = 3600
+CHECKED_KEY = 'etcd.maintenance.checked'
+REMEDIATED_KEY = 'etcd.maintenance.remediated'
+USAGE_KEY = 'etcd.maintenance.usage'
+ERROR_KEY = 'etcd.maintenance.error'
+REMEDIATION_KEY = 'etcd.maintenance.remediation'
+
+
+class MaintenanceFailed(Exception):
+    ''' A maintenance step failed, results holds the progress made. '''
+
+    def __init__(self, message, results=None):
+        super().__init__(message)
+        self.results = [] if results is None else results
+
+
+def member_statuses(etcdctl=None):
+    ''' Returns a dict of member name to (client url, EndpointStatus), the
+    status being None for a member that did not answer. '''
+    etcdctl = etcdctl or EtcdCtl()
+    statuses = {}
+    for name, member in etcdctl.member_list().items():
+        urls = split_endpoints(member.client_urls)
+        status = None
+        for url in urls:
+            try:
+                status = etcdctl.endpoint_status(url)[0]
+                break
+            except (EtcdCtl.CommandFailed, IndexError):
+                continue
+        statuses[name] = (urls[0] if urls else None, status)
+    return statuses
+
+
+def health_problems(statuses, max_lag=MAX_RAFT_LAG, allow_nospace=False):
+    ''' Returns why the cluster is not fit for maintenance, an empty list
+    when it is. Every member must answer without errors, agree on one
+    leader and trail it by at most max_lag raft entries. With allow_nospace
+    the NOSPACE alarm is not counted as an error. '''
+    problems = []
+    leaders = set()
+    for name, (_, status) in sorted(statuses.items()):
+        errors = status and [e for e in status.errors
+                             if not (allow_nospace and 'NOSPACE' in e)]
+        if status is None:
+            problems.append('{} is unreachable'.format(name))
+        elif errors:
+            problems.append('{}: {}'.format(name, ', '.join(errors)))
+        elif int(status.leader, 16) == 0:
+            problems.append('{} has no leader'.format(name))
+        else:
+            leaders.add(status.leader)
+    if problems:
+        return problems
+    if len(leaders) != 1:
+        return ['members disagree on the leader']
+
+    leader = leaders.pop()
+    leader_index = max((status.raft_index
+                        for _, status in statuses.values()
+                        if status.member_id == leader), default=0)
+    for name, (_, status) in sorted(statuses.items()):
+        lag = leader_index - status.raft_index
+        if lag > max_lag:
+            problems.append('{} trails the leader by {} entries'.format(
+                name, lag))
+    return problems
+
+
+def wait_until_healthy(etcdctl=None, timeout=GATE_TIMEOUT,
+                       allow_nospace=False):
+    ''' Poll the cluster until health_problems() reports none, for up to
+    timeout seconds. Returns the member statuses and the problems left. '''
+    etcdctl = etcdctl or EtcdCtl()
+    deadline = time.time() + timeout
+    while True:
+        try:
+            statuses = member_statuses(etcdctl)
+            problems = health_problems(statuses, allow_nospace=allow_nospace)
+        except EtcdCtl.CommandFailed as e:
+            statuses, problems = {}, [str(e)]
+        if not problems or time.time() >= deadline:
+            return statuses, problems
+        log('Waiting for the cluster to settle: {}'.format(
+            '; '.join(problems)), 'DEBUG')
+        time.sleep(GATE_INTERVAL)
+
+
+def defrag_order(statuses):
+    ''' Returns the member names in the order they are defragmented:
+    followers by name, the raft leader last. '''
+    def key(name):
+        status = statuses[name][1]
+        return (status is not None and status.leader == status.member_id,
+                name)
+    return sorted(statuses, key=key)
+
+
+def in_use_ratio(status):
+    ''' The share of the database file holding live data. '''
+    if not status.db_size:
+        return 1.0
+    return status.db_size_in_use / status.db_size
+
+
+def defrag_member(etcdctl, name, endpoint, results=None):
+    ''' Defragment the member name at endpoint, raising MaintenanceFailed
+    with results when it fails. '''
+    log('Defragmenting {} at {}'.format(name, endpoint))
+    try:
+        etcdctl.defrag(endpoint)
+    except EtcdCtl.CommandFailed as e:
+        raise MaintenanceFailed('Defrag of {} failed: {}'.format(
+            name, e), results) from e
+    finally:
+        invalidate_snapshots()
+
+
+def rolling_defrag(etcdctl=None, max_in_use_ratio=MAX_IN_USE_RATIO,
+                   timeout=GATE_TIMEOUT, allow_nospace=False):
+    ''' Defragment every member in turn, gating each on cluster health.
+
+    Returns a list of dicts, one per member in defrag order, with the keys
+    name, endpoint, db_size, db_size_in_use and either skipped (the reason)
+    or db_size_after and reclaimed. Raises MaintenanceFailed when the
+    cluster does not recover within timeout seconds, after recording the
+    members handled so far in its results attribute. allow_nospace lets the
+    rollout run while the NOSPACE alarm is raised.
+    '''
+    etcdctl = etcdctl or EtcdCtl()
+    results = []
+    statuses, problems = wait_until_healthy(etcdctl, timeout, allow_nospace)
+    if problems:
+        raise MaintenanceFailed('Cluster is unhealthy: {}'.format(
+            '; '.join(problems)), results)
+
+    for name in defrag_order(statuses):
+        # Sizes are read again after every member, skip one that left.
+        if name not in statuses:
+            continue
+        endpoint, status = statuses[name]
+        result = {'name': name, 'endpoint': endpoint,
+                  'db_size': status.db_size,
+                  'db_size_in_use': status.db_size_in_use}
+        results.append(result)
+        ratio = in_use_ratio(status)
+        if ratio > max_in_use_ratio:
+            result['skipped'] = '{:.0%} in use'.format(ratio)
+            continue
+
+        defrag_member(etcdctl, name, endpoint, results)
+
+        statuses, problems = wait_until_healthy(etcdctl, timeout, allow_nospace)
+        if problems:
+            raise MaintenanceFailed('Cluster did not recover after '
+                                    'defragmenting {}: {}'.format(
+                                        name, '; '.join(problems)), results)
+        after = statuses.get(name, (None, None))[1]
+        if after is not None:
+            result['db_size_after'] = after.db_size
+            result['reclaimed'] = max(0, status.db_size - after.db_size)
+    return results
+
+
+def compaction(mode='periodic', retention=''):
+    ''' Return the etcd auto compaction settings for a mode and retention
+    as a dict of etcd config keys, empty when compaction is disabled. A
+    periodic retention is a duration such as 30m or a number of hours, a
+    revision retention the number of revisions to keep. Raises ValueError
+    for settings etcd would refuse. '''
+    retention = str(retention).strip()
+    if mode not in COMPACTION_MODES:
+        raise ValueError('unknown auto_compaction_mode {!r}, expected one of '
+                         '{}'.format(mode, ', '.join(COMPACTION_MODES)))
+    if mode == 'revision' and retention and \
+            not re.match(r'^\d+$', retention):
+        raise ValueError('auto_compaction_retention must be a number of '
+                         'revisions in revision mode')
+    if not retention or not parse_duration(retention):
+        return {}
+    return {'auto-compaction-mode': mode,
+            'auto-compaction-retention': retention}
+
+
+def config_compaction():
+    ''' Return (settings, error) for the charm config. Invalid settings are
+    reported and auto compaction is left off. '''
+    try:
+        return compaction(config('auto_compaction_mode') or 'periodic',
+                          config('auto_compaction_retention') or ''), None
+    except ValueError as e:
+        log('Invalid auto compaction: {}'.format(e), 'ERROR')
+        return {}, str(e)
+
+
+def effective_quota(tuning):
+    ''' The backend quota in bytes etcd enforces for the tuning. '''
+    return tuning.get('quota-backend-bytes') or DEFAULT_QUOTA
+
+
+def due(interval=CHECK_INTERVAL, key=CHECKED_KEY):
+    ''' Whether interval seconds passed since the time recorded in key. '''
+    return time.time() - (unitdata.kv().get(key) or 0) >= interval
+
+
+def mark(key):
+    unitdata.kv().set(key, int(time.time()))
+
+
+def quota_usage(statuses, quota):
+    ''' Returns the largest database size of any member as a share of
+    quota, and the name of that member. '''
+    sizes = {name: status.db_size for name, (_, status) in statuses.items()
+             if status is not None}
+    if not sizes:
+        return 0.0, None
+    name = max(sizes, key=sizes.get)
+    return sizes[name] / quota, name
+
+
+def nospace_raised(etcdctl=None):
+    ''' Whether any member raised the NOSPACE alarm. '''
+    etcdctl = etcdctl or EtcdCtl()
+    return any(alarm.alarm == 'NOSPACE' for alarm in etcdctl.alarm_list())
+
+
+def last_error():
+    ''' The failure of the last remediation, or None if it succeeded. '''
+    return unitdata.kv().get(ERROR_KEY)
+
+
+def remediation():
+    ''' The progress of the remediation under way, or None. '''
+    return unitdata.kv().get(REMEDIATION_KEY)
+
+
+def remediate(quota, etcdctl=None):
+    ''' Take the next step of the remediation under way, starting one if
+    there is none: compact the history to the current revision, defragment
+    the members one per call, then disarm the alarms. Each step is gated on
+    the cluster being healthy and checks the outcome of the one before.
+    Returns a list of the steps taken, empty while the cluster is not
+    healthy. Raises MaintenanceFailed, abandoning the remediation. '''
+    etcdctl = etcdctl or EtcdCtl()
+    db = unitdata.kv()
+    state = remediation() or {'step': 'compact', 'since': int(time.time())}
+    try:
+        try:
+            statuses = member_statuses(etcdctl)
+            problems = health_problems(statuses, allow_nospace=True)
+        except EtcdCtl.CommandFailed as e:
+            statuses, problems = {}, [str(e)]
+        if problems:
+            if time.time() - state['since'] < STEP_TIMEOUT:
+                db.set(REMEDIATION_KEY, state)
+                log('Waiting for the cluster to settle: {}'.format(
+                    '; '.join(problems)), 'DEBUG')
+                return []
+            raise MaintenanceFailed('Cluster is unhealthy: {}'.format(
+                '; '.join(problems)))
+        steps = REMEDIATION_STEPS[state['step']](quota, etcdctl, statuses,
+                                                 state)
+    except MaintenanceFailed:
+        db.unset(REMEDIATION_KEY)
+        raise
+    if state['step'] == 'done':
+        db.unset(REMEDIATION_KEY)
+    else:
+        state['since'] = int(time.time())
+        db.set(REMEDIATION_KEY, state)
+    return steps
+
+
+def compact_step(quota, etcdctl, statuses, state):
+    ''' Compact the history and queue every member for a defrag. '''
+    revision = max(status.revision for _, status in statuses.values())
+    try:
+        etcdctl.compact(revision, physical=True)
+    except EtcdCtl.CommandFailed as e:
+        # Compaction is idempotent, an auto compaction may have got there
+        if 'has been compacted' not in str(e):
+            raise MaintenanceFailed('Compaction to revision {} failed: '
+                                    '{}'.format(revision, e)) from e
+    state.update(step='defrag', pending=defrag_order(statuses),
+                 sizes={name: status.db_size
+                        for name, (_, status) in statuses.items()})
+    return ['compacted to revision {}'.format(revision)]
+
+
+def defrag_step(quota, etcdctl, statuses, state):
+    ''' Defragment the next member, followers first. '''
+    # Skip the members that left since the order was taken
+    pending = [name for name in state['pending'] if name in statuses]
+    if not pending:
+        state.update(step='disarm', pending=[])
+        return disarm_step(quota, etcdctl, statuses, state)
+    name = pending.pop(0)
+    defrag_member(etcdctl, name, statuses[name][0])
+    state['pending'] = pending
+    return ['defragmented {}'.format(name)]
+
+
+def disarm_step(quota, etcdctl, statuses, state):
+    ''' Check the live data fits the quota and disarm the alarms. '''
+    steps = []
+    reclaimed = sum(max(0, state['sizes'][name] - status.db_size)
+                    for name, (_, status) in statuses.items()
+                    if name in state.get('sizes', {}))
+    if state.get('sizes'):
+        steps.append('defragmented {} members, reclaiming {} bytes'.format(
+            len(state['sizes']), reclaimed))
+    usage, name = quota_usage(statuses, quota)
+    if usage >= 1:
+        raise MaintenanceFailed(
+            'Defragmenting left {} at {:.0%} of the quota, the live data '
+            'needs a larger quota-backend-bytes'.format(name, usage))
+
+    try:
+        disarmed = etcdctl.alarm_disarm()
+        if nospace_raised(etcdctl):
+            raise MaintenanceFailed('The NOSPACE alarm is still raised')
+    except EtcdCtl.CommandFailed as e:
+        raise MaintenanceFailed('Disarming the alarms failed: {}'.format(
+            e)) from e
+    if disarmed:
+        steps.append('disarmed {}'.format(', '.join(sorted(
+            set(alarm.alarm for alarm in disarmed)))))
+    state['step'] = 'done'
+    return steps
+
+
+REMEDIATION_STEPS = {'compact': compact_step, 'defrag': defrag_step,
+                     'disarm': disarm_step}
+
+
+def maintain(quota, threshold, etcdctl=None):
+    ''' Check the database sizes against quota and remediate on a NOSPACE
+    alarm, or when a member uses more than threshold of the quota (0 to
+    only act on the alarm). A remediation under way is taken one step
+    further instead. Returns the steps taken, or an empty list. '''
+    etcdctl = etcdctl or EtcdCtl()
+    mark(CHECKED_KEY)
+    if remediation() is None:
+        usage, name = quota_usage(member_statuses(etcdctl), quota)
+        unitdata.kv().set(USAGE_KEY, usage)
+        nospace = nospace_raised(etcdctl)
+        if nospace:
+            log('NOSPACE alarm raised, the cluster is read only', 'WARNING')
+        elif threshold and usage >= threshold and \
+                due(REMEDIATION_INTERVAL, REMEDIATED_KEY):
+            log('{} uses {:.0%} of the backend quota'.format(name, usage),
+                'WARNING')
+        else:
+            if usage < (threshold or 1):
+                # Whatever failed before, the cluster has recovered since
+                unitdata.kv().unset(ERROR_KEY)
+            return []
+        mark(REMEDIATED_KEY)
+
+    try:
+        steps = remediate(quota, etcdctl)
+    except MaintenanceFailed as e:
+        log('Keyspace maintenance failed: {}'.format(e), 'ERROR')
+        unitdata.kv().set(ERROR_KEY, str(e))
+        raise
+    if remediation() is None:
+        unitdata.kv().unset(ERROR_KEY)
+    if steps:
+        log('Keyspace maintenance: {}'.format('; '.join(steps)))
+    return steps
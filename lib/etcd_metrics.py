@@ -0,0 +1,160 @@
+''' Timing of the commands the charm runs against etcd.
+
+Every etcdctl invocation, gateway call and notable subprocess is recorded
+with its wall time, exit status and endpoint in a bounded ring buffer kept in
+unitdata, so slow hooks can be attributed to etcd, the network or the charm.
+The charm-metrics action summarises the buffer per command.
+'''
+from charmhelpers.core import unitdata
+from subprocess import CalledProcessError
+from subprocess import TimeoutExpired
+from subprocess import check_call
+from subprocess import check_output
+
+import os
+import threading
+import time
+
+METRICS_KEY = 'etcd.metrics'
+# Records kept, oldest are dropped first
+RING_SIZE = 512
+PERCENTILES = (50, 95, 99)
+
+# unitdata is sqlite, which may only be used from the thread that opened it,
+# so records made by worker threads wait here until flush() is called.
+_pending = []
+_lock = threading.Lock()
+
+
+def command_label(command):
+    ''' Name a command by its executable and subcommands, eg:
+    ['/snap/bin/etcd.etcdctl', 'member', 'list', '--write-out', 'json']
+    is labelled "etcdctl member list". '''
+    if isinstance(command, str):
+        command = command.split()
+    if not command:
+        return ''
+    words = [os.path.basename(command[0]).replace('etcd.etcdctl',
+                                                  'etcdctl')]
+    for arg in command[1:3]:
+        if arg.startswith('-'):
+            break
+        words.append(arg)
+    return ' '.join(words)
+
+
+def command_endpoint(command):
+    ''' Return the endpoint a command targets, or "local". '''
+    if isinstance(command, str):
+        command = command.split()
+    for index, arg in enumerate(command):
+        for flag in ('--endpoints', '--endpoint'):
+            if arg == flag and index + 1 < len(command):
+                return command[index + 1]
+            if arg.startswith(flag + '='):
+                return arg.split('=', 1)[1]
+    return 'local'
+
+
+def record(label, endpoint, status, seconds):
+    ''' Append a timing record to the ring buffer.
+
+    @params label - the command, see command_label()
+    @params endpoint - the endpoint targeted
+    @params status - the exit status, or a short reason such as "timeout"
+    @params seconds - the wall time taken
+    '''
+    with _lock:
+        _pending.append([label, endpoint, status, round(seconds * 1000, 1),
+                         int(time.time())])
+    if threading.current_thread() is threading.main_thread():
+        flush()
+
+
+def flush():
+    ''' Move the records made so far into unitdata. Must be called from
+    the main thread. '''
+    with _lock:
+        if not _pending:
+            return
+        pending = list(_pending)
+        del _pending[:]
+    db = unitdata.kv()
+    records = (db.get(METRICS_KEY) or []) + pending
+    db.set(METRICS_KEY, records[-RING_SIZE:])
+
+
+class timed:
+    ''' Context manager recording the wall time of a block. The status is
+    0, the return code of a CalledProcessError, "timeout", or the name of
+    any other exception raised. '''
+
+    def __init__(self, label, endpoint='local'):
+        self.label = label
+        self.endpoint = endpoint
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            status = 0
+        elif issubclass(exc_type, CalledProcessError):
+            status = exc.returncode
+        elif issubclass(exc_type, TimeoutExpired):
+            status = 'timeout'
+        else:
+            status = exc_type.__name__
+        record(self.label, self.endpoint, status, time.time() - self.start)
+        return False
+
+
+def timed_check_output(command, *args, **kwargs):
+    ''' subprocess.check_output, recorded in the ring buffer. '''
+    with timed(command_label(command), command_endpoint(command)):
+        return check_output(command, *args, **kwargs)
+
+
+def timed_check_call(command, *args, **kwargs):
+    ''' subprocess.check_call, recorded in the ring buffer. '''
+    with timed(command_label(command), command_endpoint(command)):
+        return check_call(command, *args, **kwargs)
+
+
+def percentile(values, pct):
+    ''' Nearest-rank percentile of a sorted list of values. '''
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * pct // 100))
+    return values[int(rank) - 1]
+
+
+def summary():
+    ''' Summarise the ring buffer per command as a dict of
+    {label: {'count', 'errors', 'p50', 'p95', 'p99', 'max', 'endpoints'}}
+    with timings in milliseconds. '''
+    by_label = {}
+    for label, endpoint, status, ms, _ in unitdata.kv().get(METRICS_KEY) or []:
+        stats = by_label.setdefault(label, {'times': [], 'errors': 0,
+                                            'endpoints': set()})
+        stats['times'].append(ms)
+        stats['endpoints'].add(endpoint)
+        if status != 0:
+            stats['errors'] += 1
+
+    result = {}
+    for label, stats in by_label.items():
+        times = sorted(stats['times'])
+        result[label] = {'count': len(times),
+                         'errors': stats['errors'],
+                         'max': times[-1],
+                         'endpoints': sorted(stats['endpoints'])}
+        for pct in PERCENTILES:
+            result[label]['p{}'.format(pct)] = percentile(times, pct)
+    return result
+
+
+def reset():
+    ''' Empty the ring buffer. '''
+    unitdata.kv().set(METRICS_KEY, [])
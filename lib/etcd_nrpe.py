@@ -0,0 +1,77 @@
+''' NRPE checks fed from the cached metrics of the local member.
+
+lib/etcd_scrape.py caches the metrics once a minute, and each check compares
+one value of the cache with the warning and critical thresholds from the
+nagios_metric_thresholds option, or fails when the cache is older than
+nagios_metrics_max_age seconds.
+'''
+from charmhelpers.core.hookenv import config
+from charmhelpers.core.hookenv import log
+
+import yaml
+
+PLUGIN = '/usr/lib/nagios/plugins/check_etcd-metrics.py'
+CRON = '/etc/cron.d/check_etcd-metrics'
+# check name: (description, [warning, critical])
+CHECKS = {
+    'wal-fsync-p99': ('etcd WAL fsync p99 latency (ms)', [10, 50]),
+    'backend-commit-p99': ('etcd backend commit p99 latency (ms)', [25, 100]),
+    'leader-changes': ('etcd leader changes in the last hour', [3, 10]),
+    'proposals-pending': ('etcd pending raft proposals', [10, 100]),
+    'db-quota': ('etcd database size as a percentage of its quota',
+                 [80, 90]),
+    'alarms': ('etcd has no raised alarms', None),
+}
+# Files of the alarm check the metrics checks replaced
+LEGACY_FILES = ('/etc/cron.d/check_etcd-alarms',
+                '/usr/lib/nagios/plugins/check_etcd-alarms.py',
+                '/var/lib/nagios/etcd-alarm-list.txt')
+
+
+def thresholds(text=''):
+    ''' Return the thresholds of every check as a dict of check name to
+    [warning, critical], with text, a YAML mapping of the same form,
+    overriding the defaults. Raises ValueError for unknown checks and
+    malformed thresholds. '''
+    settings = {name: list(default) for name, (_, default) in CHECKS.items()
+                if default}
+    try:
+        overrides = yaml.safe_load(text or '') or {}
+    except yaml.YAMLError as e:
+        raise ValueError('nagios_metric_thresholds is not valid YAML: '
+                         '{}'.format(e))
+    if not isinstance(overrides, dict):
+        raise ValueError('nagios_metric_thresholds must be a mapping')
+    for name, pair in overrides.items():
+        if name not in settings:
+            raise ValueError('unknown check {!r}, expected one of {}'.format(
+                name, ', '.join(sorted(settings))))
+        if not isinstance(pair, list) or len(pair) != 2 or not all(
+                isinstance(v, (int, float)) and not isinstance(v, bool)
+                for v in pair):
+            raise ValueError('{} must be [warning, critical]'.format(name))
+        if pair[0] > pair[1]:
+            raise ValueError('{} warning is above critical'.format(name))
+        settings[name] = pair
+    return settings
+
+
+def config_thresholds():
+    ''' Return (thresholds, error) for the charm config. Invalid thresholds
+    are reported and the defaults used. '''
+    try:
+        return thresholds(config('nagios_metric_thresholds') or ''), None
+    except ValueError as e:
+        log('Invalid nagios_metric_thresholds: {}'.format(e), 'ERROR')
+        return thresholds(), str(e)
+
+
+def checks(settings, max_age):
+    ''' Returns (shortname, description, command) of every check. '''
+    result = []
+    for name in sorted(CHECKS):
+        command = '{} {} --max-age {}'.format(PLUGIN, name, max_age)
+        if name in settings:
+            command += ' -w {} -c {}'.format(*settings[name])
+        result.append(('etcd-' + name, CHECKS[name][0], command))
+    return result
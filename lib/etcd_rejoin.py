@@ -0,0 +1,136 @@
+''' Leader scheduled rejoins after a snapshot restore.
+
+A restore leaves the leader alone in a new cluster, and every other unit
+must wipe its data and register again. etcd only accepts one new member at a
+time, so rather than letting followers race for it the leader admits them in
+turn: a follower publishes a rejoin request on the cluster peer relation,
+the leader appends it to an ordered schedule in leader data, and the
+admitted follower registers and reports done once it has caught up. The
+leader admits the next unit in the first of its hooks that finds the member
+caught up; like the restart schedule, catch up is checked once per hook
+rather than polled.
+
+    leader data    force_rejoin     id of the rejoin round, set by restore
+                   rejoin-schedule  {"request": ..., "order": [...],
+                                     "position": ..., "since": ...}
+    peer relation  rejoin-request   id of the round the unit is waiting on
+                   rejoin-done      id of the round the unit has rejoined in
+'''
+from charmhelpers.core.hookenv import leader_get
+from charmhelpers.core.hookenv import leader_set
+from charmhelpers.core.hookenv import local_unit
+from charmhelpers.core.hookenv import log
+from etcd_lib import get_peer_data
+from etcd_lib import peer_units
+from etcd_lib import set_peer_data
+from etcd_restart import member_caught_up
+
+import json
+import time
+
+ROUND_KEY = 'force_rejoin'
+SCHEDULE_KEY = 'rejoin-schedule'
+REQUEST_KEY = 'rejoin-request'
+DONE_KEY = 'rejoin-done'
+# Seconds an admitted unit has to rejoin before the next one is admitted
+ADMISSION_TIMEOUT = 600
+
+
+def current_round():
+    ''' Returns the id of the rejoin round requested by the leader, or
+    None. '''
+    return leader_get(ROUND_KEY) or None
+
+
+def get_schedule():
+    ''' Returns the published schedule as a dict, or None. '''
+    try:
+        return json.loads(leader_get(SCHEDULE_KEY) or 'null')
+    except ValueError:
+        return None
+
+
+def request_rejoin():
+    ''' Ask the leader to admit this unit in the current round. Returns
+    the round id, or None when no round was requested. '''
+    request = current_round()
+    if request:
+        set_peer_data({REQUEST_KEY: request})
+    return request
+
+
+def admitted():
+    ''' Whether the leader has admitted this unit to register. '''
+    schedule = get_schedule()
+    if not schedule or schedule.get('request') != current_round():
+        return False
+    order = schedule['order']
+    position = schedule['position']
+    return position < len(order) and order[position] == local_unit()
+
+
+def acknowledge():
+    ''' Tell the leader this unit has rejoined and caught up. Returns False
+    while it is still catching up. '''
+    if not member_caught_up(local_unit()):
+        return False
+    set_peer_data({DONE_KEY: current_round()})
+    return True
+
+
+def unit_number(unit):
+    return int(unit.split('/')[-1])
+
+
+def advance(schedule, done, present):
+    ''' Move the schedule past the units that have rejoined, left the
+    relation or timed out. Returns True if it moved. '''
+    moved = False
+    order = schedule['order']
+    while schedule['position'] < len(order):
+        unit = order[schedule['position']]
+        if done.get(unit) == schedule['request']:
+            if not member_caught_up(unit):
+                log('Waiting for {} to catch up'.format(unit), 'DEBUG')
+                return moved
+            log('{} has rejoined the cluster'.format(unit))
+        elif unit not in present:
+            log('{} left before rejoining'.format(unit), 'WARNING')
+        elif time.time() - schedule['since'] > ADMISSION_TIMEOUT:
+            log('{} did not rejoin within {}s, admitting the next unit'
+                .format(unit, ADMISSION_TIMEOUT), 'WARNING')
+        else:
+            return moved
+        schedule['position'] += 1
+        schedule['since'] = int(time.time())
+        moved = True
+    return moved
+
+
+def coordinate():
+    ''' Run on the leader in every hook. Appends new requests to the
+    schedule of the current round and admits the next unit as soon as the
+    previous one has rejoined. '''
+    request = current_round()
+    if not request:
+        return
+    schedule = get_schedule()
+    before = json.dumps(schedule, sort_keys=True)
+    if not schedule or schedule.get('request') != request:
+        schedule = {'request': request, 'order': [], 'position': 0,
+                    'since': int(time.time())}
+
+    waiting = [unit for unit, value in get_peer_data(REQUEST_KEY).items()
+               if value == request and unit not in schedule['order']]
+    if waiting and schedule['position'] >= len(schedule['order']):
+        # The head of an empty queue gets a fresh admission window
+        schedule['since'] = int(time.time())
+    schedule['order'].extend(sorted(waiting, key=unit_number))
+    advance(schedule, get_peer_data(DONE_KEY), set(peer_units()))
+
+    if json.dumps(schedule, sort_keys=True) != before:
+        order = schedule['order']
+        if schedule['position'] < len(order):
+            log('Admitting {} to rejoin the cluster'.format(
+                order[schedule['position']]))
+        leader_set({SCHEDULE_KEY: json.dumps(schedule)})
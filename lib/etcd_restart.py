@@ -0,0 +1,196 @@
+''' Leader coordinated rolling restarts.
+
+Restarting every member at once, as happens when certificates rotate or a
+port changes on all units, can drop quorum. Instead a unit that needs a
+restart publishes a request on the cluster peer relation and waits. The Juju
+leader grants a single restart token at a time through leader data, and only
+grants the next one once the restarted member is healthy and caught up with
+the raft leader. The Juju leader restarts last: its own request waits
+LEADER_GRACE seconds for the requests the peers make for the same change in
+their own hooks, which may run after the leader's. Catch up is checked once
+per leader hook rather than polled, so no hook is held up by a member that
+is slow to catch up.
+
+    peer relation  restart-request  nonce of the unit's latest request
+                   restart-done     nonce of the unit's latest restart
+    leader data    restart-token    {"unit": ..., "nonce": ..., "granted": ...}
+                   restart-leader-since
+                                    {"nonce": ..., "since": ...} of the
+                                    leader's own pending request
+'''
+from charmhelpers.core.hookenv import leader_get
+from charmhelpers.core.hookenv import leader_set
+from charmhelpers.core.hookenv import local_unit
+from charmhelpers.core.hookenv import log
+from etcd_gateway import split_endpoints
+from etcd_lib import get_peer_data
+from etcd_lib import peer_units
+from etcd_lib import set_peer_data
+from etcdctl import EtcdCtl
+from uuid import uuid4
+
+import json
+import time
+
+REQUEST_KEY = 'restart-request'
+DONE_KEY = 'restart-done'
+TOKEN_KEY = 'restart-token'
+LEADER_WAIT_KEY = 'restart-leader-since'
+# Seconds before a token its holder never acted on is revoked
+TOKEN_TIMEOUT = 600
+# Seconds the leader's own request waits for the peers to ask
+LEADER_GRACE = 60
+# Raft entries a member may trail the raft leader by and count as caught up
+MAX_RAFT_LAG = 1000
+
+
+def request_restart():
+    ''' Ask the leader for a restart token. A request still pending is
+    reused, so repeated calls in one rollout restart the unit once. Returns
+    the request nonce, or None when there are no peers to coordinate with
+    and the caller should restart straight away. '''
+    if not peer_units():
+        return None
+    unit = local_unit()
+    pending = pending_restarts().get(unit)
+    if pending:
+        return pending
+    nonce = uuid4().hex[:12]
+    set_peer_data({REQUEST_KEY: nonce})
+    return nonce
+
+
+def pending_restarts():
+    ''' Returns a dict of unit name to the nonce of its unserved request. '''
+    done = get_peer_data(DONE_KEY)
+    return {unit: nonce for unit, nonce in get_peer_data(REQUEST_KEY).items()
+            if done.get(unit) != nonce}
+
+
+def restart_order(units, leader, deferred=None):
+    ''' Returns units in the order they restart: by unit number, with the
+    deferred unit (whose last token expired) after the others and the
+    leader last of all. '''
+    def key(unit):
+        return (unit == leader, unit == deferred,
+                int(unit.split('/')[-1]))
+    return sorted(units, key=key)
+
+
+def get_token():
+    ''' Returns the current restart token as a dict, or None. '''
+    try:
+        return json.loads(leader_get(TOKEN_KEY) or 'null')
+    except ValueError:
+        return None
+
+
+def grant(unit, nonce):
+    ''' Hand the restart token to unit for its request nonce. '''
+    log('Granting restart token to {}'.format(unit))
+    leader_set({TOKEN_KEY: json.dumps({'unit': unit, 'nonce': nonce,
+                                       'granted': int(time.time())})})
+
+
+def revoke():
+    ''' Withdraw the restart token. '''
+    leader_set({TOKEN_KEY: ''})
+
+
+def granted():
+    ''' Returns the nonce of this unit's pending request if the leader has
+    granted it the token, else None. '''
+    token = get_token()
+    unit = local_unit()
+    if not token or token.get('unit') != unit:
+        return None
+    nonce = pending_restarts().get(unit)
+    return nonce if nonce == token.get('nonce') else None
+
+
+def acknowledge(nonce):
+    ''' Tell the leader the restart for nonce is done. '''
+    set_peer_data({DONE_KEY: nonce})
+
+
+def member_caught_up(unit, etcdctl=None):
+    ''' Whether the etcd member of unit is healthy, has a leader, and is
+    within MAX_RAFT_LAG entries of the raft leader. '''
+    etcdctl = etcdctl or EtcdCtl()
+    try:
+        members = etcdctl.member_list()
+        member = members.get(unit.replace('/', ''))
+        if not member or not member.client_urls:
+            return False
+        status = etcdctl.endpoint_status(
+            split_endpoints(member.client_urls)[0])[0]
+        if status.errors or int(status.leader, 16) == 0:
+            return False
+        if status.leader == status.member_id:
+            return True
+        leaders = [m for m in members.values()
+                   if m.unit_id == status.leader and m.client_urls]
+        if not leaders:
+            return False
+        leader_status = etcdctl.endpoint_status(
+            split_endpoints(leaders[0].client_urls)[0])[0]
+    except (EtcdCtl.CommandFailed, IndexError, ValueError):
+        return False
+    return leader_status.raft_index - status.raft_index <= MAX_RAFT_LAG
+
+
+def leader_may_restart(nonce):
+    ''' Whether the leader's own request nonce has waited LEADER_GRACE
+    seconds for the peers to ask for a restart too. '''
+    try:
+        wait = json.loads(leader_get(LEADER_WAIT_KEY) or 'null')
+    except ValueError:
+        wait = None
+    if not wait or wait.get('nonce') != nonce:
+        leader_set({LEADER_WAIT_KEY: json.dumps(
+            {'nonce': nonce, 'since': int(time.time())})})
+        return False
+    return time.time() - wait['since'] >= LEADER_GRACE
+
+
+def coordinate(restart_local):
+    ''' Run on the leader in every hook. Retires the outstanding token once
+    its holder has restarted and caught up, then grants the next one.
+
+        @param restart_local performs the leader's own restart when its turn
+        comes, as no other unit can act on the leader's behalf
+    '''
+    deferred = None
+    token = get_token()
+    if token:
+        done = get_peer_data(DONE_KEY).get(token['unit']) == token['nonce']
+        expired = time.time() - token.get('granted', 0) > TOKEN_TIMEOUT
+        if done:
+            if not expired and not member_caught_up(token['unit']):
+                log('Waiting for {} to catch up'.format(token['unit']),
+                    'DEBUG')
+                return
+        else:
+            # A holder that left the relation will never act on its token.
+            if not expired and token['unit'] in pending_restarts():
+                log('Waiting for {} to restart'.format(token['unit']),
+                    'DEBUG')
+                return
+            log('Revoking the restart token of {}'.format(token['unit']),
+                'WARNING')
+            deferred = token['unit']
+        revoke()
+
+    pending = pending_restarts()
+    if not pending:
+        return
+    leader = local_unit()
+    unit = restart_order(pending, leader, deferred)[0]
+    if unit == leader and not leader_may_restart(pending[unit]):
+        log('Waiting for the peers to ask for a restart', 'DEBUG')
+        return
+    grant(unit, pending[unit])
+    if unit == leader:
+        # The token is retired by a later hook, once the leader caught up
+        restart_local()
+        acknowledge(pending[unit])
@@ -0,0 +1,152 @@
+''' Streaming, atomic restores of snapshot archives.
+
+An archive is read once, as a stream, whatever its compression (gzip, xz,
+bzip2 or zstd). Its first file tells the format apart: a v3 snapshot holds a
+single ./db, which is written to a staging directory, a v2 backup holds the
+member directory tree, which is extracted there. The staging directory lives
+in the data directory, so the restored member is swapped in with renames
+rather than copies, and the previous member is kept beside it under a new
+name for an instant rollback.
+
+    <data-dir>/.restore-staging            the staging directory
+    <data-dir>/member.pre-restore-<stamp>  the member replaced by a restore
+'''
+from charmhelpers.core.hookenv import log
+from contextlib import contextmanager
+from datetime import datetime
+from subprocess import CalledProcessError
+from subprocess import PIPE
+from subprocess import Popen
+
+import errno
+import glob
+import os
+import shutil
+import signal
+import tarfile
+
+V2 = 'v2'
+V3 = 'v3'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+STAGING = '.restore-staging'
+ROLLBACK_SUFFIX = '.pre-restore-'
+CHUNK_SIZE = 1024 * 1024
+
+
+@contextmanager
+def open_archive(path):
+    ''' Open a snapshot archive as a streaming tarfile. '''
+    with open(path, 'rb') as fp:
+        magic = fp.read(len(ZSTD_MAGIC))
+    if magic != ZSTD_MAGIC:
+        with tarfile.open(path, mode='r|*') as tar:
+            yield tar
+        return
+
+    proc = Popen(['zstd', '-d', '-q', '-c', path], stdout=PIPE)
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+            yield tar
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    # zstd is killed by SIGPIPE when the archive is not read to its end
+    if returncode not in (0, -signal.SIGPIPE):
+        raise CalledProcessError(returncode, 'zstd')
+
+
+def safe_name(name):
+    ''' Normalise an entry name, refusing absolute paths and entries that
+    would land outside the extraction directory. '''
+    normalised = os.path.normpath(name)
+    if os.path.isabs(normalised) or normalised.split(os.sep)[0] == '..':
+        raise ValueError('unsafe archive entry {!r}'.format(name))
+    return normalised
+
+
+def copy_entry(tar, member, path):
+    ''' Stream the content of a file entry to path. '''
+    source = tar.extractfile(member)
+    with open(path, 'wb') as fp:
+        shutil.copyfileobj(source, fp, CHUNK_SIZE)
+        fp.flush()
+        os.fsync(fp.fileno())
+
+
+def stage_archive(archive, staging):
+    ''' Stream archive into staging. A v3 snapshot is written to
+    staging/db, a v2 backup extracted under staging/v2. Returns V3 or V2.
+    '''
+    os.makedirs(staging, exist_ok=True)
+    version = None
+    with open_archive(archive) as tar:
+        for member in tar:
+            name = safe_name(member.name)
+            if version is None and member.isfile():
+                version = V3 if name == 'db' else V2
+                log('Restoring a {} backup from {}'.format(version, archive))
+            if version == V3:
+                copy_entry(tar, member, os.path.join(staging, 'db'))
+                return V3
+            if name == '.' or not (member.isfile() or member.isdir()):
+                continue
+            target = os.path.join(staging, V2, name)
+            if member.isdir():
+                os.makedirs(target, exist_ok=True)
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                copy_entry(tar, member, target)
+    if version is None:
+        raise ValueError('{} holds no files'.format(archive))
+    return version
+
+
+def _move(source, destination):
+    ''' Rename source to destination, copying across filesystems. '''
+    try:
+        os.rename(source, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        log('{} and {} are on different filesystems, copying'.format(
+            source, destination), 'WARNING')
+        shutil.move(source, destination)
+
+
+def swap_member(source, data_dir, wal_dir=None, stamp=None):
+    ''' Replace data_dir/member with source/member, keeping the current
+    member as data_dir/member.pre-restore-<stamp>. Earlier rollbacks are
+    removed first. When the member's wal lives in wal_dir, the restored wal
+    replaces it there the same way. Returns the rollback path, or None when
+    there was no member to replace. '''
+    stamp = stamp or datetime.now().strftime('%Y%m%d-%H%M%S')
+    live = os.path.join(data_dir, 'member')
+    os.makedirs(data_dir, exist_ok=True)
+    for path in glob.glob(live + ROLLBACK_SUFFIX + '*'):
+        shutil.rmtree(path)
+    rollback = None
+    if os.path.exists(live):
+        rollback = live + ROLLBACK_SUFFIX + stamp
+        os.rename(live, rollback)
+    try:
+        _move(os.path.join(source, 'member'), live)
+    except OSError:
+        if rollback:
+            os.rename(rollback, live)
+        raise
+
+    restored_wal = os.path.join(live, 'wal')
+    if wal_dir and os.path.isdir(restored_wal):
+        for path in glob.glob(wal_dir + ROLLBACK_SUFFIX + '*'):
+            shutil.rmtree(path)
+        if os.path.exists(wal_dir):
+            os.rename(wal_dir, wal_dir + ROLLBACK_SUFFIX + stamp)
+        _move(restored_wal, wal_dir)
+    return rollback
+
+
+def staging_dir(data_dir):
+    ''' The staging directory of a restore into data_dir, emptied. '''
+    staging = os.path.join(data_dir, STAGING)
+    shutil.rmtree(staging, ignore_errors=True)
+    return staging
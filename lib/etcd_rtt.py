@@ -0,0 +1,120 @@
+''' Heartbeat and election timeouts derived from the measured round trip
+time between members.
+
+etcd recommends a heartbeat interval close to the round trip time between
+members and an election timeout of at least ten round trips. Every unit
+times TCP connects to the client port of its peers, found through the
+cluster relation, and publishes the p99 of its samples on the peer relation.
+The Juju leader derives cluster wide values from the worst p99 and publishes
+them in leader data, where they raise the heartbeat-interval and
+election-timeout of the performance profile. Explicit performance_overrides
+still win.
+
+    peer relation  rtt-p99-ms          p99 connect time to the unit's peers
+    leader data    rtt-heartbeat-interval, rtt-election-timeout    in ms
+'''
+from charmhelpers.core.hookenv import config
+from charmhelpers.core.hookenv import leader_get
+from charmhelpers.core.hookenv import log
+from charmhelpers.core import unitdata
+from etcd_lib import get_peer_data
+from etcd_metrics import percentile
+from etcd_tuning import MAX_ELECTION_TIMEOUT
+
+import math
+import socket
+import time
+
+RTT_KEY = 'rtt-p99-ms'
+HEARTBEAT_KEY = 'rtt-heartbeat-interval'
+ELECTION_KEY = 'rtt-election-timeout'
+MEASURED_KEY = 'etcd.rtt-measured'
+# Seconds between measurements, connects per peer, and the connect timeout
+MEASURE_INTERVAL = 3600
+SAMPLES = 20
+CONNECT_TIMEOUT = 1.0
+# The heartbeat is HEARTBEAT_FACTOR round trips rounded up to HEARTBEAT_STEP
+# ms, the election timeout ELECTION_FACTOR heartbeats.
+HEARTBEAT_FACTOR = 1.5
+HEARTBEAT_STEP = 10
+ELECTION_FACTOR = 10
+# A lower heartbeat is only published once it drops below this fraction of
+# the current one, so jitter between measurements does not cause a rolling
+# restart every hour.
+LOWER_THRESHOLD = 0.75
+
+
+def enabled():
+    return bool(config('rtt_tuning'))
+
+
+def measure(addresses, port, samples=SAMPLES, timeout=CONNECT_TIMEOUT):
+    ''' Time TCP connects to port on each address. Returns the samples in
+    ms, sorted; unreachable addresses contribute none. '''
+    times = []
+    for address in addresses:
+        for _ in range(samples):
+            start = time.time()
+            try:
+                socket.create_connection((address, port), timeout).close()
+            except (OSError, socket.timeout) as e:
+                log('RTT probe to {}:{} failed: {}'.format(address, port, e),
+                    'DEBUG')
+                break
+            times.append((time.time() - start) * 1000)
+    return sorted(times)
+
+
+def due(interval=MEASURE_INTERVAL):
+    ''' Whether interval seconds passed since the last measurement. '''
+    return time.time() - (unitdata.kv().get(MEASURED_KEY) or 0) >= interval
+
+
+def mark_measured():
+    unitdata.kv().set(MEASURED_KEY, int(time.time()))
+
+
+def p99(samples):
+    ''' The p99 of sorted samples formatted for the peer relation. '''
+    return '{:.2f}'.format(percentile(samples, 99))
+
+
+def cluster_rtt():
+    ''' The worst p99 RTT published by any unit, in ms, or None. '''
+    values = []
+    for unit, value in get_peer_data(RTT_KEY).items():
+        try:
+            values.append(float(value))
+        except (TypeError, ValueError):
+            log('Ignoring RTT {!r} from {}'.format(value, unit), 'WARNING')
+    return max(values) if values else None
+
+
+def derive(rtt):
+    ''' Return (heartbeat-interval, election-timeout) in ms for a round trip
+    time of rtt ms, within etcd's 50s election timeout limit. '''
+    steps = math.ceil(rtt * HEARTBEAT_FACTOR / HEARTBEAT_STEP)
+    heartbeat = max(1, steps) * HEARTBEAT_STEP
+    heartbeat = min(heartbeat, MAX_ELECTION_TIMEOUT // ELECTION_FACTOR)
+    return heartbeat, heartbeat * ELECTION_FACTOR
+
+
+def should_publish(current, heartbeat):
+    ''' Whether a newly derived heartbeat replaces the published one:
+    always when higher, only when clearly lower otherwise. '''
+    if not current:
+        return True
+    return (heartbeat > current or
+            heartbeat < current * LOWER_THRESHOLD)
+
+
+def published():
+    ''' The (heartbeat, election) the leader published, or None. '''
+    try:
+        heartbeat = int(leader_get(HEARTBEAT_KEY) or 0)
+        election = int(leader_get(ELECTION_KEY) or 0)
+    except ValueError:
+        return None
+    if not heartbeat or not election:
+        return None
+    return heartbeat, election
@@ -0,0 +1,197 @@
+''' Scrape the local /metrics endpoint into a cache for the NRPE checks.
+
+A cron job runs this module once a minute. Each run reads /metrics and the
+alarm list from the local member and writes a JSON summary that every NRPE
+check then reads, so however many checks run, etcd is scraped once.
+
+Latencies are the p99 of the histogram observations of the last WINDOW
+seconds, as Prometheus' histogram_quantile(rate(...[5m])) would report,
+not of the whole life of the process. Like etcd_gateway, only the standard
+library is used, as the collector runs outside of a hook.
+
+    {"scraped": ..., "error": ..., "values": {"wal-fsync-p99": ..., ...},
+     "history": [[timestamp, {"wal-fsync": [[le, count], ...], ...}], ...]}
+'''
+from etcd_gateway import EtcdGateway
+
+import argparse
+import json
+import math
+import os
+import re
+import time
+
+CACHE_PATH = '/var/lib/nagios/etcd-metrics.json'
+LOCAL_ENDPOINT = 'http://127.0.0.1:4001'
+# Seconds of history latencies are computed over, and leader changes
+# counted over
+WINDOW = 300
+HOUR = 3600
+# The backend quota etcd applies when quota-backend-bytes is 0
+DEFAULT_QUOTA = 2 * 1024 ** 3
+HISTOGRAMS = {
+    'wal-fsync': 'etcd_disk_wal_fsync_duration_seconds',
+    'backend-commit': 'etcd_disk_backend_commit_duration_seconds',
+}
+LEADER_CHANGES = 'etcd_server_leader_changes_seen_total'
+PROPOSALS_PENDING = 'etcd_server_proposals_pending'
+QUOTA = 'etcd_server_quota_backend_bytes'
+# etcd 3.3 only exports the debugging name
+DB_SIZE = ('etcd_mvcc_db_total_size_in_bytes',
+           'etcd_debugging_mvcc_db_total_size_in_bytes')
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)')
+LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def parse(text):
+    ''' Parse the Prometheus text format into a dict of metric name to a
+    list of (labels, value). '''
+    metrics = {}
+    for line in text.splitlines():
+        match = SAMPLE.match(line)
+        if not match or line.startswith('#'):
+            continue
+        name, labels, value = match.groups()
+        try:
+            value = float(value)
+        except ValueError:
+            continue
+        metrics.setdefault(name, []).append(
+            (dict(LABEL.findall(labels or '')), value))
+    return metrics
+
+
+def value(metrics, *names):
+    ''' The sum of the samples of the first of names that is exported, or
+    None. '''
+    for name in names:
+        if name in metrics:
+            return sum(v for _, v in metrics[name])
+    return None
+
+
+def buckets(metrics, name):
+    ''' The cumulative buckets of histogram name as a sorted list of
+    [upper bound, count], summed over every other label. '''
+    counts = {}
+    for labels, count in metrics.get(name + '_bucket', []):
+        le = float(labels.get('le', 'inf'))
+        counts[le] = counts.get(le, 0) + count
+    return [[le, counts[le]] for le in sorted(counts)]
+
+
+def delta(current, previous):
+    ''' The observations made between two bucket lists. A counter reset,
+    when etcd restarted, discards the previous list. '''
+    before = dict((le, count) for le, count in previous or [])
+    if any(count < before.get(le, 0) for le, count in current):
+        return current
+    return [[le, count - before.get(le, 0)] for le, count in current]
+
+
+def quantile(q, cumulative):
+    ''' Estimate the q quantile of cumulative buckets by linear
+    interpolation within the bucket it falls into, as Prometheus'
+    histogram_quantile does. None when there are no observations. '''
+    if not cumulative or not cumulative[-1][1]:
+        return None
+    rank = q * cumulative[-1][1]
+    lower, below = 0.0, 0
+    for le, count in cumulative:
+        if count >= rank:
+            if math.isinf(le):
+                return lower
+            if count == below:
+                return le
+            return lower + (le - lower) * (rank - below) / (count - below)
+        lower, below = le, count
+    return lower
+
+
+def summarise(metrics, alarms, history, now):
+    ''' Returns the values the checks compare against their thresholds and
+    the history kept for the next run, given the parsed metrics, the raised
+    alarm names and the history of earlier runs. '''
+    sample = {name: buckets(metrics, histogram)
+              for name, histogram in HISTOGRAMS.items()}
+    sample['leader-changes'] = value(metrics, LEADER_CHANGES)
+    history = [h for h in history or [] if now - h[0] <= HOUR]
+    history.append([now, sample])
+
+    # Without an earlier sample in the window there is no recent latency,
+    # only the totals since etcd started.
+    recent = [h for h in history if now - h[0] <= WINDOW]
+    values = {}
+    for name in HISTOGRAMS:
+        p99 = None
+        if len(recent) > 1:
+            p99 = quantile(0.99, delta(sample[name], recent[0][1].get(name)))
+        values[name + '-p99'] = None if p99 is None else round(p99 * 1000, 3)
+
+    # Leader changes over the hour, or the time there is history for
+    first = history[0]
+    changes = (sample['leader-changes'] or 0) - \
+        (first[1].get('leader-changes') or 0)
+    if changes < 0:
+        changes = sample['leader-changes'] or 0
+    values['leader-changes'] = changes
+    values['proposals-pending'] = value(metrics, PROPOSALS_PENDING)
+
+    size = value(metrics, *DB_SIZE)
+    quota = value(metrics, QUOTA) or DEFAULT_QUOTA
+    values['db-quota'] = None if size is None else round(
+        100.0 * size / quota, 1)
+    values['alarms'] = sorted(alarms)
+    return values, history
+
+
+def load(path):
+    ''' The cache at path, or an empty one. '''
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def collect(path=CACHE_PATH, endpoint=LOCAL_ENDPOINT, now=None):
+    ''' Scrape endpoint and update the cache at path. A failed scrape keeps
+    the previous values and records the error, the checks report the cache
+    as stale once the last good scrape is too old. '''
+    now = now or int(time.time())
+    cache = load(path)
+    gateway = EtcdGateway(endpoint)
+    try:
+        metrics = parse(gateway.metrics())
+        result = gateway.call('maintenance/alarm', {'action': 'GET'})
+        alarms = set(str(a.get('alarm', 'NONE'))
+                     for a in result.get('alarms', []))
+    except (EtcdGateway.Unavailable, EtcdGateway.RequestFailed) as e:
+        cache['error'] = str(e)
+    else:
+        values, history = summarise(metrics, alarms, cache.get('history'),
+                                    now)
+        cache = {'scraped': now, 'endpoint': endpoint, 'error': None,
+                 'values': values, 'history': history}
+    finally:
+        gateway.close()
+
+    partial = '{}.{}.part'.format(path, os.getpid())
+    with open(partial, 'w') as fp:
+        json.dump(cache, fp)
+    os.chmod(partial, 0o644)
+    os.replace(partial, path)
+    return cache
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Cache the metrics of the local etcd member.')
+    parser.add_argument('--cache', default=CACHE_PATH)
+    parser.add_argument('--endpoint', default=LOCAL_ENDPOINT)
+    args = parser.parse_args(argv)
+    collect(args.cache, args.endpoint)
+
+
+if __name__ == '__main__':
+    main()
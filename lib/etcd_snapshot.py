@@ -0,0 +1,489 @@
+''' Consistent, single pass snapshots of the etcd data.
+
+A v3 snapshot is streamed from the local member's Maintenance.Snapshot RPC
+through the JSON gateway. Each chunk goes straight into the "db" member of a
+tar stream, through gzip or multi-threaded zstd, and into the archive, while
+the SHA-256 of the archive is computed over the same bytes. Nothing is read
+back from disk. When the gateway is unavailable `etcdctl snapshot save`
+writes the snapshot to a temporary file, which is then archived in one read
+pass.
+
+Archives keep the layout restore.py expects: ./db for v3 and the tree
+written by `etcdctl backup` for v2. v3 snapshots can instead be saved into a
+deduplicated SnapshotStore, see etcd_snapshot_store.
+
+The charm can also save snapshots on a schedule, from a systemd timer that
+runs this module at idle I/O priority with main(). The bytes read are then
+limited by a token bucket, and archives beyond the retention policy pruned.
+'''
+from base64 import b64decode
+from charmhelpers.core.hookenv import config
+from charmhelpers.core.hookenv import log
+from datetime import datetime
+from etcd_gateway import EtcdGateway
+from etcd_metrics import timed
+from etcd_snapshot_store import MANIFEST_PATTERN
+from etcd_snapshot_store import SnapshotStore
+from etcd_tuning import parse_size
+from etcdctl import BACKOFF
+from etcdctl import MAX_BACKOFF
+from etcdctl import EtcdCtl
+from etcdctl import RetryPolicy
+from etcdctl import get_gateway
+from subprocess import CalledProcessError
+from subprocess import PIPE
+from subprocess import Popen
+
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+
+# Supported compressions and their archive suffix
+COMPRESSIONS = {'gzip': 'gz', 'zstd': 'zst'}
+# A compressed tarball per snapshot, or a deduplicated SnapshotStore
+FORMATS = ('archive', 'repository')
+CHUNK_SIZE = 1024 * 1024
+# Socket timeout while streaming, a large database can pause between chunks
+STREAM_TIMEOUT = 60
+# The snapshot stream ends with the SHA-256 of the database
+HASH_SIZE = 32
+ARCHIVE_PATTERN = re.compile(r'^etcd-snapshot-.+\.tar\.(gz|zst)$')
+# One number and unit of a systemd time span such as "1h 30min"
+TIME_SPAN = re.compile(r'\d+\s*[a-z]*\s*')
+# Seconds after which leftovers of an interrupted snapshot are removed
+STALE_AGE = 86400
+DAY = 86400
+# Scheduled snapshots run outside of hooks, where the config is not
+# available to build the etcdctl retry policy from.
+SCHEDULED_POLICY = RetryPolicy(2, 5, 3, BACKOFF, MAX_BACKOFF)
+
+
+class HashingWriter:
+    ''' A file-like sink that hashes and counts the bytes written through
+    it. '''
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+class TokenBucket:
+    ''' Limit a byte stream to rate bytes per second, with bursts of up to
+    one second's worth. Consuming more than is available sleeps off the
+    debt. '''
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.clock = clock
+        self.sleep = sleep
+        self.last = clock()
+
+    def consume(self, count):
+        now = self.clock()
+        self.tokens = min(self.rate,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= count
+        if self.tokens < 0:
+            self.sleep(-self.tokens / self.rate)
+
+
+def throttle(chunks, bucket=None):
+    ''' Pass chunks through, at the rate of bucket when given. '''
+    for chunk in chunks:
+        if bucket:
+            bucket.consume(len(chunk))
+        yield chunk
+
+
+class ChunkReader:
+    ''' A read() interface over an iterator of byte chunks, for
+    tarfile.addfile(). '''
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer.extend(chunk)
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def exhausted(self):
+        return not self.buffer and not self.read(1)
+
+
+def verify_stream(chunks):
+    ''' Pass chunks through, checking the SHA-256 etcd appends to the
+    snapshot stream against the bytes before it. Raises ValueError on a
+    mismatch once the stream ends. '''
+    sha256 = hashlib.sha256()
+    tail = b''
+    for chunk in chunks:
+        data = tail + chunk
+        sha256.update(data[:-HASH_SIZE])
+        tail = data[-HASH_SIZE:]
+        yield chunk
+    if len(tail) < HASH_SIZE or sha256.digest() != tail:
+        raise ValueError('snapshot stream failed its integrity check')
+
+
+def gateway_snapshot(endpoint=None):
+    ''' Start a snapshot stream from the gateway of endpoint, the local
+    member by default. Returns the size of the snapshot and an iterator over
+    its bytes. '''
+    gateway = get_gateway(endpoint)
+    messages = gateway.stream('maintenance/snapshot', timeout=STREAM_TIMEOUT)
+    first = next(messages, None)
+    if first is None:
+        raise EtcdGateway.Unavailable('{}: empty snapshot stream'.format(
+            gateway.endpoint))
+    blob = b64decode(first.get('blob', ''))
+    # remaining_bytes only counts the database, the hash follows in a
+    # message of its own
+    size = len(blob) + int(first.get('remaining_bytes', 0)) + HASH_SIZE
+
+    def chunks():
+        yield blob
+        for message in messages:
+            yield b64decode(message.get('blob', ''))
+
+    return size, verify_stream(chunks())
+
+
+def add_stream(tar, name, size, chunks):
+    ''' Add a tar member of size bytes read from chunks. '''
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o600
+    info.mtime = int(time.time())
+    reader = ChunkReader(chunks)
+    tar.addfile(info, reader)
+    if not reader.exhausted():
+        raise ValueError('snapshot stream is longer than announced')
+
+
+def add_tree(tar, directory, bucket=None):
+    ''' Add the contents of directory as ./..., reading each file at the
+    rate of bucket. '''
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        relative = os.path.relpath(root, directory)
+        arcname = '.' if relative == '.' else './' + relative
+        tar.add(root, arcname=arcname, recursive=False)
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as fp:
+                chunks = iter(lambda: fp.read(CHUNK_SIZE), b'')
+                add_stream(tar, '{}/{}'.format(arcname, name),
+                           os.fstat(fp.fileno()).st_size,
+                           throttle(chunks, bucket))
+
+
+def _zstd(sink, add):
+    ''' Run add() on a tar stream piped through zstd into sink. '''
+    proc = Popen(['zstd', '-q', '-T0', '-c'], stdin=PIPE, stdout=PIPE)
+    errors = []
+
+    def pump():
+        try:
+            for chunk in iter(lambda: proc.stdout.read(CHUNK_SIZE), b''):
+                sink.write(chunk)
+        except Exception as e:
+            # Unblock the writer, which would otherwise wait on a full pipe
+            errors.append(e)
+            proc.kill()
+
+    thread = threading.Thread(target=pump)
+    thread.start()
+    try:
+        with tarfile.open(fileobj=proc.stdin, mode='w|') as tar:
+            add(tar)
+    except BrokenPipeError:
+        if not errors:
+            raise
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        thread.join()
+        returncode = proc.wait()
+    if errors:
+        raise errors[0]
+    if returncode:
+        raise CalledProcessError(returncode, 'zstd')
+
+
+def write_archive(path, compression, add):
+    ''' Write a compressed tar archive to path, calling add(tar) to add its
+    members. The archive is written as path.part and renamed into place
+    once complete. Returns the (size, sha256) of the archive. '''
+    partial = path + '.part'
+    try:
+        with open(partial, 'wb') as fp:
+            sink = HashingWriter(fp)
+            if compression == 'zstd':
+                _zstd(sink, add)
+            else:
+                with tarfile.open(fileobj=sink, mode='w|gz') as tar:
+                    add(tar)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(partial, path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    return sink.size, sink.sha256.hexdigest()
+
+
+def save_to_store(repository, etcdctl=None, bandwidth=0):
+    ''' Save a v3 snapshot into the deduplicated SnapshotStore at
+    repository. Returns the result of SnapshotStore.save() with the source
+    the snapshot was taken from. '''
+    etcdctl = etcdctl or EtcdCtl()
+    bucket = TokenBucket(bandwidth) if bandwidth else None
+    store = SnapshotStore(repository)
+    try:
+        source = 'gateway'
+        with timed('snapshot gateway'):
+            _, chunks = gateway_snapshot()
+            result = store.save(throttle(chunks, bucket), source)
+    except (EtcdGateway.Unavailable, EtcdGateway.RequestFailed) as e:
+        # Chunks stored before the failure are collected by the next gc()
+        log('Snapshot stream failed, using etcdctl: {}'.format(e), 'WARNING')
+        source = 'etcdctl snapshot save'
+        staging = tempfile.mkdtemp(prefix='.snapshot-', dir=repository)
+        try:
+            with timed('snapshot ' + source):
+                path = os.path.join(staging, 'db')
+                etcdctl.snapshot_save(path)
+                with open(path, 'rb') as fp:
+                    chunks = iter(lambda: fp.read(CHUNK_SIZE), b'')
+                    result = store.save(throttle(chunks, bucket), source)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+    result['source'] = source
+    return result
+
+
+def archive_path(target_dir, compression):
+    stamp = datetime.now().strftime('%Y-%m-%d-%H.%M.%S')
+    return os.path.join(target_dir, 'etcd-snapshot-{}.tar.{}'.format(
+        stamp, COMPRESSIONS[compression]))
+
+
+def save(target_dir, compression='gzip', keys_version='v3', data_dir=None,
+         etcdctl=None, bandwidth=0):
+    ''' Save a snapshot archive in target_dir. Returns a dict of its path,
+    size in bytes, sha256 and the source it was taken from.
+
+    @params keys_version - 'v3' for a snapshot of the v3 keyspace, 'v2' for
+    an `etcdctl backup` of the v2 store in data_dir
+    @params bandwidth - bytes per second the snapshot is read at, 0 for no
+    limit. `etcdctl snapshot save` itself cannot be limited.
+    '''
+    if compression not in COMPRESSIONS:
+        raise ValueError('compression must be one of {}'.format(
+            ', '.join(sorted(COMPRESSIONS))))
+    if compression == 'zstd' and not shutil.which('zstd'):
+        raise ValueError('zstd compression requires the zstd package')
+    if keys_version not in ('v2', 'v3'):
+        raise ValueError('keys-version must be either v2 or v3')
+    etcdctl = etcdctl or EtcdCtl()
+    bucket = TokenBucket(bandwidth) if bandwidth else None
+    os.makedirs(target_dir, exist_ok=True)
+    path = archive_path(target_dir, compression)
+
+    if keys_version == 'v2':
+        source = 'etcdctl backup'
+        with timed('snapshot ' + source):
+            size, sha256 = _save_from_disk(
+                path, compression, target_dir,
+                lambda d: etcdctl.backup(data_dir, d), bucket)
+    else:
+        try:
+            source = 'gateway'
+            with timed('snapshot gateway'):
+                snapshot_size, chunks = gateway_snapshot()
+                chunks = throttle(chunks, bucket)
+                size, sha256 = write_archive(
+                    path, compression,
+                    lambda tar: add_stream(tar, 'db', snapshot_size, chunks))
+        except (EtcdGateway.Unavailable, EtcdGateway.RequestFailed) as e:
+            log('Snapshot stream failed, using etcdctl: {}'.format(e),
+                'WARNING')
+            source = 'etcdctl snapshot save'
+            with timed('snapshot ' + source):
+                size, sha256 = _save_from_disk(
+                    path, compression, target_dir,
+                    lambda d: etcdctl.snapshot_save(os.path.join(d, 'db')),
+                    bucket)
+    return {'path': path, 'size': size, 'sha256': sha256, 'source': source}
+
+
+def _save_from_disk(path, compression, target_dir, dump, bucket=None):
+    ''' Archive what dump(directory) writes to a temporary directory. '''
+    staging = tempfile.mkdtemp(prefix='.snapshot-', dir=target_dir)
+    try:
+        dump(staging)
+        return write_archive(path, compression,
+                             lambda tar: add_tree(tar, staging, bucket))
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def human_size(size):
+    ''' Format a size in bytes the way `du -h` does, eg 1.5M. '''
+    for unit in ('', 'K', 'M', 'G', 'T'):
+        if size < 1024 or unit == 'T':
+            break
+        size /= 1024.0
+    if unit == '':
+        return str(int(size))
+    return '{:.1f}{}'.format(size, unit)
+
+
+def archives(target_dir, pattern=ARCHIVE_PATTERN):
+    ''' Returns the snapshot archives (or the files matching pattern) in
+    target_dir as (mtime, path) tuples, newest first. '''
+    found = []
+    for name in os.listdir(target_dir):
+        if pattern.match(name):
+            path = os.path.join(target_dir, name)
+            found.append((os.path.getmtime(path), path))
+    return sorted(found, reverse=True)
+
+
+def prune(target_dir, keep=0, max_age=0, now=None, pattern=ARCHIVE_PATTERN):
+    ''' Remove the archives beyond the newest keep and those older than
+    max_age seconds, along with leftovers of interrupted snapshots. A limit
+    of 0 is disabled, and the newest archive is always kept. Returns the
+    paths removed.
+
+    @params pattern - matches the names of the archives, or of the
+    manifests in a snapshot store
+    '''
+    now = now or time.time()
+    removed = []
+    for index, (mtime, path) in enumerate(archives(target_dir, pattern)):
+        if index == 0:
+            continue
+        if (keep and index >= keep) or (max_age and now - mtime > max_age):
+            os.remove(path)
+            removed.append(path)
+    for name in os.listdir(target_dir):
+        path = os.path.join(target_dir, name)
+        stale = now - os.path.getmtime(path) > STALE_AGE
+        if stale and name.endswith('.part'):
+            os.remove(path)
+            removed.append(path)
+        elif stale and name.startswith('.snapshot-'):
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(path)
+    return removed
+
+
+def config_schedule():
+    ''' Return (schedule, error) for the snapshot_* charm config. The
+    schedule is a dict of the options main() takes, or None when scheduled
+    snapshots are disabled or the config is invalid. '''
+    interval = (config('snapshot_interval') or '').strip()
+    if not interval:
+        return None, None
+    try:
+        # Removing every span leaves nothing of a valid interval, without
+        # the backtracking of matching the repeated spans as one pattern
+        if not interval[0].isdigit() or TIME_SPAN.sub('', interval):
+            raise ValueError('snapshot_interval {!r} is not a time span, '
+                             'eg 6h or 1d'.format(interval))
+        compression = config('snapshot_compression') or 'gzip'
+        if compression not in COMPRESSIONS:
+            raise ValueError('snapshot_compression must be one of {}'.format(
+                ', '.join(sorted(COMPRESSIONS))))
+        snapshot_format = config('snapshot_format') or 'archive'
+        if snapshot_format not in FORMATS:
+            raise ValueError('snapshot_format must be one of {}'.format(
+                ', '.join(FORMATS)))
+        schedule = {
+            'interval': interval,
+            'target': config('snapshot_target'),
+            'format': snapshot_format,
+            'compression': compression,
+            'keep': int(config('snapshot_retention_count') or 0),
+            'max_age_days': int(config('snapshot_retention_days') or 0),
+            'bandwidth': parse_size(config('snapshot_bandwidth_limit') or 0),
+        }
+    except ValueError as e:
+        log('Invalid snapshot schedule: {}'.format(e), 'ERROR')
+        return None, str(e)
+    if not schedule['target'] or not os.path.isabs(schedule['target']):
+        return None, 'snapshot_target must be an absolute path'
+    if schedule['keep'] < 0 or schedule['max_age_days'] < 0:
+        return None, 'snapshot retention limits must not be negative'
+    return schedule, None
+
+
+def main(argv=None):
+    ''' Save a scheduled snapshot and prune the target directory. '''
+    parser = argparse.ArgumentParser(
+        description='Save an etcd snapshot and prune old ones.')
+    parser.add_argument('--target', required=True)
+    parser.add_argument('--format', default='archive', choices=FORMATS)
+    parser.add_argument('--compression', default='gzip',
+                        choices=sorted(COMPRESSIONS))
+    parser.add_argument('--keep', type=int, default=0,
+                        help='snapshots to keep, 0 for no limit')
+    parser.add_argument('--max-age-days', type=int, default=0,
+                        help='days snapshots are kept, 0 for no limit')
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        help='bytes per second to read, 0 for no limit')
+    args = parser.parse_args(argv)
+
+    etcdctl = EtcdCtl(policy=SCHEDULED_POLICY)
+    max_age = args.max_age_days * DAY
+    if args.format == 'repository':
+        result = save_to_store(args.target, etcdctl, args.bandwidth)
+        print('Saved {manifest} ({size} bytes, {new_chunks} of {chunks} '
+              'chunks new, {new_bytes} bytes stored) from '
+              '{source}'.format(**result))
+        store = SnapshotStore(args.target)
+        pruned = prune(store.manifest_dir, args.keep, max_age,
+                       pattern=MANIFEST_PATTERN) + prune(args.target)
+        chunks, freed = store.gc()
+        print('Collected {} chunks, {} bytes'.format(chunks, freed))
+    else:
+        result = save(args.target, args.compression, etcdctl=etcdctl,
+                      bandwidth=args.bandwidth)
+        print('Saved {path} ({size} bytes, sha256 {sha256}) from '
+              '{source}'.format(**result))
+        pruned = prune(args.target, args.keep, max_age)
+    for path in pruned:
+        print('Pruned {}'.format(path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+''' A content addressed, deduplicated store of etcd snapshots.
+
+Successive snapshots of a slowly changing database are mostly identical.
+Each snapshot is split into chunks that are stored once, named by the
+SHA-256 of their content, and a small JSON manifest lists the chunks that
+make up the snapshot. A new snapshot only costs the chunks that changed.
+
+bbolt updates its fixed size pages in place rather than shifting data, so
+chunk boundaries are aligned to a multiple of the page size instead of being
+content defined: a changed page only ever dirties the one chunk holding it.
+
+    <repository>/chunks/ab/abcdef...        zlib compressed chunk
+    <repository>/manifests/<name>.json      {"chunks": [...], ...}
+    <repository>/lock                       held while saving or collecting
+
+Chunks no manifest refers to are removed by gc().
+'''
+from contextlib import contextmanager
+from datetime import datetime
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+import zlib
+
+# 16 bbolt pages of 4KiB
+CHUNK_SIZE = 64 * 1024
+MANIFEST_VERSION = 1
+MANIFEST_PATTERN = re.compile(r'^etcd-snapshot-.+\.json$')
+
+
+class SnapshotStore:
+    ''' A snapshot repository rooted at path. '''
+
+    class Corrupt(Exception):
+        ''' A chunk or snapshot does not match its recorded hash. '''
+        pass
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.chunk_dir = os.path.join(path, 'chunks')
+        self.manifest_dir = os.path.join(path, 'manifests')
+
+    @contextmanager
+    def lock(self):
+        ''' Hold the repository lock, so garbage collection never removes
+        the chunks of a snapshot whose manifest is not written yet. '''
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, 'lock'), 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunk_dir, digest[:2], digest)
+
+    def put(self, data):
+        ''' Store a chunk unless it exists. Returns its digest and the bytes
+        written, 0 for a chunk that was already stored. '''
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            return digest, 0
+        compressed = zlib.compress(data, 1)
+        write_atomic(path, compressed)
+        return digest, len(compressed)
+
+    def get(self, digest):
+        ''' Return the content of a chunk, checked against its digest. '''
+        with open(self.chunk_path(digest), 'rb') as fp:
+            data = zlib.decompress(fp.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise SnapshotStore.Corrupt('chunk {} is corrupt'.format(digest))
+        return data
+
+    def save(self, stream, source='', name=None):
+        ''' Store the snapshot read from stream, an iterator of byte chunks
+        of any size, and write its manifest. Returns a dict of the manifest
+        path, the snapshot size and sha256, and the number of chunks and
+        bytes that were new to the store. '''
+        name = name or 'etcd-snapshot-{}'.format(
+            datetime.now().strftime('%Y-%m-%d-%H.%M.%S'))
+        sha256 = hashlib.sha256()
+        digests = []
+        size = new_chunks = new_bytes = 0
+        buffer = bytearray()
+
+        def store(data):
+            nonlocal new_chunks, new_bytes
+            digest, written = self.put(bytes(data))
+            digests.append(digest)
+            if written:
+                new_chunks += 1
+                new_bytes += written
+
+        with self.lock():
+            for data in stream:
+                sha256.update(data)
+                size += len(data)
+                buffer.extend(data)
+                while len(buffer) >= self.chunk_size:
+                    store(buffer[:self.chunk_size])
+                    del buffer[:self.chunk_size]
+            if buffer:
+                store(buffer)
+            manifest = {'version': MANIFEST_VERSION,
+                        'name': name,
+                        'created': int(time.time()),
+                        'source': source,
+                        'chunk_size': self.chunk_size,
+                        'size': size,
+                        'sha256': sha256.hexdigest(),
+                        'chunks': digests}
+            path = os.path.join(self.manifest_dir, name + '.json')
+            write_atomic(path, json.dumps(manifest).encode('utf-8'))
+        return {'manifest': path, 'size': size, 'sha256': manifest['sha256'],
+                'chunks': len(digests), 'new_chunks': new_chunks,
+                'new_bytes': new_bytes}
+
+    def manifests(self):
+        ''' Returns the manifest paths, newest first. '''
+        if not os.path.isdir(self.manifest_dir):
+            return []
+        paths = [os.path.join(self.manifest_dir, name)
+                 for name in os.listdir(self.manifest_dir)
+                 if MANIFEST_PATTERN.match(name)]
+        return sorted(paths, key=os.path.getmtime, reverse=True)
+
+    def gc(self):
+        ''' Remove the chunks no manifest refers to. Returns the number of
+        chunks and bytes removed. '''
+        removed = freed = 0
+        with self.lock():
+            referenced = set()
+            for path in self.manifests():
+                referenced.update(load_manifest(path)['chunks'])
+            if not os.path.isdir(self.chunk_dir):
+                return 0, 0
+            for prefix in os.listdir(self.chunk_dir):
+                directory = os.path.join(self.chunk_dir, prefix)
+                for digest in os.listdir(directory):
+                    if digest in referenced:
+                        continue
+                    path = os.path.join(directory, digest)
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+                    removed += 1
+        return removed, freed
+
+
+def load_manifest(path):
+    ''' Read a manifest, raising ValueError for one this code cannot
+    read. '''
+    with open(path) as fp:
+        manifest = json.load(fp)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError('{}: unsupported manifest version {}'.format(
+            path, manifest.get('version')))
+    return manifest
+
+
+def store_of(manifest_path):
+    ''' The SnapshotStore a manifest belongs to. '''
+    return SnapshotStore(os.path.dirname(os.path.dirname(
+        os.path.abspath(manifest_path))))
+
+
+def chunks_of(manifest_path):
+    ''' Yield the content of the snapshot described by a manifest, chunk by
+    chunk. Each chunk is checked against its digest, and the whole against
+    the snapshot sha256 once it has been read. '''
+    manifest = load_manifest(manifest_path)
+    store = store_of(manifest_path)
+    sha256 = hashlib.sha256()
+    for digest in manifest['chunks']:
+        data = store.get(digest)
+        sha256.update(data)
+        yield data
+    if sha256.hexdigest() != manifest['sha256']:
+        raise SnapshotStore.Corrupt('{} does not match its sha256'.format(
+            manifest_path))
+
+
+def reassemble(manifest_path, output_path):
+    ''' Write the snapshot described by a manifest to output_path. Returns
+    its size. '''
+    size = 0
+    partial = output_path + '.part'
+    try:
+        with open(partial, 'wb') as fp:
+            for data in chunks_of(manifest_path):
+                fp.write(data)
+                size += len(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(partial, output_path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    return size
+
+
+def write_atomic(path, data):
+    ''' Write data to path through a temporary file, durably. '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = '{}.{}.part'.format(path, os.getpid())
+    with open(partial, 'wb') as fp:
+        fp.write(data)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(partial, path)
@@ -0,0 +1,235 @@
+''' Server tuning for etcd3.conf, from the performance_profile and
+performance_overrides charm config.
+
+A profile is a named set of etcd settings. Overrides are a YAML mapping of
+etcd config keys to values that is applied on top of the profile, eg:
+
+    snapshot-count: 50000
+    backend-batch-interval: 10ms
+    max-request-bytes: 3MiB
+
+Millisecond settings may be given as plain numbers or as durations, byte
+settings as numbers or with a K/M/G(i)B suffix, and nanosecond durations as
+Go style strings such as 1h30m or 250ms, which etcd reads from YAML as plain
+nanosecond integers.
+'''
+from charmhelpers.core.hookenv import config
+from charmhelpers.core.hookenv import log
+
+import re
+import yaml
+
+# How each tunable is parsed: ms and ns are durations in milli and
+# nanoseconds, bytes a size, count a non-negative integer.
+TUNABLES = {
+    'snapshot-count': 'count',
+    'heartbeat-interval': 'ms',
+    'election-timeout': 'ms',
+    'quota-backend-bytes': 'bytes',
+    'max-snapshots': 'count',
+    'max-wals': 'count',
+    'backend-batch-interval': 'ns',
+    'backend-batch-limit': 'count',
+    'max-request-bytes': 'bytes',
+    'max-txn-ops': 'count',
+    'grpc-keepalive-min-time': 'ns',
+    'grpc-keepalive-interval': 'ns',
+    'grpc-keepalive-timeout': 'ns',
+}
+
+MS = 10 ** 6
+SECOND = 10 ** 9
+MIB = 1024 ** 2
+GIB = 1024 ** 3
+
+# The settings every profile starts from, as hardcoded in etcd3.conf before
+# profiles existed. Keys not listed use etcd's own default.
+DEFAULTS = {
+    'snapshot-count': 10000,
+    'heartbeat-interval': 100,
+    'election-timeout': 1000,
+    'quota-backend-bytes': 0,
+    'max-snapshots': 5,
+    'max-wals': 5,
+}
+
+PROFILES = {
+    'default': {},
+    # Commit the backend more often and detect failed leaders sooner, for
+    # members on a fast, low latency network.
+    'low-latency': {
+        'heartbeat-interval': 50,
+        'election-timeout': 500,
+        'snapshot-count': 5000,
+        'backend-batch-interval': 10 * MS,
+        'backend-batch-limit': 1000,
+    },
+    # Batch more writes per backend commit and snapshot less often.
+    'high-throughput': {
+        'snapshot-count': 50000,
+        'backend-batch-interval': 100 * MS,
+        'backend-batch-limit': 50000,
+        'max-txn-ops': 1024,
+        'max-request-bytes': 3 * MIB,
+        'grpc-keepalive-min-time': 5 * SECOND,
+    },
+    # Raise the quota and the request limits, and give large snapshots time
+    # to transfer before a follower is considered lost.
+    'large-dataset': {
+        'quota-backend-bytes': 8 * GIB,
+        'snapshot-count': 100000,
+        'heartbeat-interval': 250,
+        'election-timeout': 2500,
+        'max-request-bytes': 10 * MIB,
+        'max-txn-ops': 2048,
+    },
+}
+
+# etcd refuses election timeouts above 50s, and warns about quotas above 8GiB.
+MAX_ELECTION_TIMEOUT = 50000
+MAX_QUOTA = 8 * GIB
+
+DURATION_UNITS = {'ns': 1, 'us': 10 ** 3, 'ms': MS,
+                  's': SECOND, 'm': 60 * SECOND, 'h': 3600 * SECOND}
+SIZE_UNITS = {'': 1, 'b': 1, 'k': 1000, 'kb': 1000, 'kib': 1024,
+              'm': 1000 ** 2, 'mb': 1000 ** 2, 'mib': MIB,
+              'g': 1000 ** 3, 'gb': 1000 ** 3, 'gib': GIB}
+
+
+def parse_duration(value, unit=1):
+    ''' Parse a Go style duration such as "1m30s" into a number of units
+    (nanoseconds by default). Plain numbers are already in units. '''
+    if isinstance(value, bool):
+        raise ValueError('{!r} is not a duration'.format(value))
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = str(value).strip()
+    if re.match(r'^\d+$', text):
+        return int(text)
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ns|us|ms|s|m|h)', text)
+    if not parts or ''.join(n + u for n, u in parts) != text:
+        raise ValueError('{!r} is not a duration'.format(value))
+    nanoseconds = sum(float(n) * DURATION_UNITS[u] for n, u in parts)
+    return int(nanoseconds // unit)
+
+
+def parse_size(value):
+    ''' Parse a size such as 8GiB or 3145728 into bytes. '''
+    if isinstance(value, bool):
+        raise ValueError('{!r} is not a size'.format(value))
+    if isinstance(value, int):
+        return value
+    match = re.match(r'^(\d+(?:\.\d+)?)\s*([a-z]*)$', str(value).strip(),
+                     re.IGNORECASE)
+    if not match or match.group(2).lower() not in SIZE_UNITS:
+        raise ValueError('{!r} is not a size'.format(value))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
+def parse_value(key, value):
+    ''' Parse an override for key according to its TUNABLES kind. '''
+    kind = TUNABLES[key]
+    if kind == 'ms':
+        parsed = parse_duration(value, MS)
+    elif kind == 'ns':
+        parsed = parse_duration(value)
+    elif kind == 'bytes':
+        parsed = parse_size(value)
+    else:
+        if isinstance(value, bool) or not re.match(r'^\d+$', str(value)):
+            raise ValueError('{} must be a whole number'.format(key))
+        parsed = int(value)
+    if parsed < 0:
+        raise ValueError('{} must not be negative'.format(key))
+    return parsed
+
+
+def parse_overrides(text):
+    ''' Parse the performance_overrides YAML mapping. '''
+    if not text or not text.strip():
+        return {}
+    try:
+        overrides = yaml.safe_load(text)
+    except yaml.YAMLError as e:
+        raise ValueError('performance_overrides is not valid YAML: '
+                         '{}'.format(e))
+    if not isinstance(overrides, dict):
+        raise ValueError('performance_overrides must be a mapping')
+    unknown = sorted(set(overrides) - set(TUNABLES))
+    if unknown:
+        raise ValueError('unknown performance_overrides keys: {}'.format(
+            ', '.join(str(k) for k in unknown)))
+    return {k: parse_value(k, v) for k, v in overrides.items()}
+
+
+def validate(settings):
+    ''' Check the constraints between settings. Raises ValueError. '''
+    heartbeat = settings['heartbeat-interval']
+    election = settings['election-timeout']
+    if heartbeat < 1:
+        raise ValueError('heartbeat-interval must be at least 1ms')
+    if election < 5 * heartbeat:
+        raise ValueError('election-timeout ({}ms) must be at least 5 times '
+                         'heartbeat-interval ({}ms)'.format(election,
+                                                            heartbeat))
+    if election > MAX_ELECTION_TIMEOUT:
+        raise ValueError('election-timeout must not exceed {}ms'.format(
+            MAX_ELECTION_TIMEOUT))
+    if settings['snapshot-count'] < 1:
+        raise ValueError('snapshot-count must be at least 1')
+    for key in ('backend-batch-limit', 'max-txn-ops', 'max-request-bytes'):
+        if key in settings and settings[key] < 1:
+            raise ValueError('{} must be at least 1'.format(key))
+    quota = settings['quota-backend-bytes']
+    request = settings.get('max-request-bytes')
+    if quota and request and request >= quota:
+        raise ValueError('max-request-bytes must be smaller than '
+                         'quota-backend-bytes')
+    if quota > MAX_QUOTA:
+        log('quota-backend-bytes above 8GiB is not recommended by etcd',
+            'WARNING')
+    keepalive = settings.get('grpc-keepalive-interval')
+    timeout = settings.get('grpc-keepalive-timeout')
+    if keepalive is not None and keepalive < settings.get(
+            'grpc-keepalive-min-time', 5 * SECOND):
+        raise ValueError('grpc-keepalive-interval must not be shorter than '
+                         'grpc-keepalive-min-time')
+    if timeout is not None and timeout < 1 * SECOND:
+        raise ValueError('grpc-keepalive-timeout must be at least 1s')
+
+
+def tuning(profile='default', overrides='', measured=None):
+    ''' Return the etcd settings for a profile and overrides as a dict of
+    etcd config keys. Raises ValueError for an unknown profile, a bad
+    override or settings that violate a constraint.
+
+        @param measured optional (heartbeat-interval, election-timeout) in ms
+        derived from the RTT between members. They raise the profile's
+        values, unless either is set in the overrides.
+    '''
+    if profile not in PROFILES:
+        raise ValueError('unknown performance_profile {!r}, expected one of '
+                         '{}'.format(profile, ', '.join(sorted(PROFILES))))
+    settings = dict(DEFAULTS)
+    settings.update(PROFILES[profile])
+    overrides = parse_overrides(overrides)
+    timeouts = ('heartbeat-interval', 'election-timeout')
+    if measured and not any(key in overrides for key in timeouts):
+        for key, value in zip(timeouts, measured):
+            settings[key] = max(settings[key], value)
+    settings.update(overrides)
+    validate(settings)
+    return settings
+
+
+def config_tuning(measured=None):
+    ''' Return (settings, error) for the charm config. When the config is
+    invalid the error is reported and the default profile is used, so a typo
+    can never stop etcd from being configured. '''
+    try:
+        return tuning(config('performance_profile') or 'default',
+                      config('performance_overrides') or '',
+                      measured), None
+    except ValueError as e:
+        log('Invalid performance tuning: {}'.format(e), 'ERROR')
+        return tuning(), str(e)
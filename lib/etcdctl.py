@@ -1,8 +1,70 @@
 from charms import layer
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import config
 from charmhelpers.core.hookenv import log
+from etcd_gateway import EtcdGateway
+from etcd_gateway import split_endpoints
+from etcd_metrics import command_endpoint
+from etcd_metrics import command_label
+from etcd_metrics import flush as flush_metrics
+from etcd_metrics import timed
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from subprocess import CalledProcessError
+from subprocess import PIPE
+from subprocess import TimeoutExpired
 from subprocess import check_output
+import json
 import os
+import random
+import re
+import time
+import yaml
+
+LOCAL_ENDPOINT = 'http://127.0.0.1:4001'
+SNAP_PATH = '/snap/etcd/current'
+# Seconds allowed for each member to answer a health probe
+HEALTH_TIMEOUT = 5
+# Defragmenting blocks the member and routinely outlasts a command timeout
+DEFRAG_TIMEOUT = 60
+# Seconds a snapshot of a multi-GB database may take to stream
+SNAPSHOT_TIMEOUT = 3600
+# Retry backoff bounds in seconds, and the time etcdctl is given on top of
+# its own timeouts before it is killed
+BACKOFF = 0.5
+MAX_BACKOFF = 4
+DEADLINE_SLACK = 5
+
+# How a command picks its endpoints. ROUTE_DIRECT uses exactly the endpoints
+# given (the local member by default), for commands about one member.
+# ROUTE_ANY fails over to every known member, and ROUTE_LEADER does the same
+# but tries the raft leader first, for membership changes.
+ROUTE_DIRECT = 'direct'
+ROUTE_ANY = 'any'
+ROUTE_LEADER = 'leader'
+
+# Failures worth retrying on another endpoint, as reported by etcdctl. The
+# gateway reports the gRPC code instead, see EtcdGateway.RequestFailed.
+TRANSIENT_ERRORS = (
+    'context deadline exceeded',
+    'connection refused',
+    'connection reset',
+    'transport is closing',
+    'request timed out',
+    'timed out',
+    'leader changed',
+    'no leader',
+    'unhealthy cluster',
+    'too many requests',
+    'unavailable',
+)
+
+# Gateway connections are kept for the lifetime of the hook process so that
+# every EtcdCtl call after the first reuses the same TLS session.
+_gateways = {}
+_tls_paths = None
+_snapshots = {}
 
 
 def etcdctl_command():
@@ -11,48 +73,175 @@ def etcdctl_command():
     return 'etcdctl'
 
 
+class RetryPolicy(namedtuple('RetryPolicy', 'dial_timeout command_timeout '
+                                            'attempts backoff max_backoff')):
+    ''' How long EtcdCtl waits on an endpoint and how often it retries.
+    Timeouts are in seconds, attempts is the number of passes made over the
+    endpoint list. '''
+    __slots__ = ()
+
+    @classmethod
+    def from_config(cls):
+        ''' Build the policy from the etcdctl_* charm config. '''
+        opts = config()
+        return cls(int(opts.get('etcdctl_dial_timeout') or 2),
+                   int(opts.get('etcdctl_command_timeout') or 5),
+                   int(opts.get('etcdctl_retries') or 3),
+                   BACKOFF, MAX_BACKOFF)
+
+    @property
+    def deadline(self):
+        ''' A hard limit on a single etcdctl process, should it ignore its
+        own timeouts. '''
+        return self.dial_timeout + self.command_timeout + DEADLINE_SLACK
+
+    def delay(self, retry):
+        ''' The full jitter exponential backoff before the nth retry. '''
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** retry))
+
+
+class Member(namedtuple('Member', 'unit_id name peer_urls client_urls '
+                                  'is_learner')):
+    ''' A cluster member. unit_id is the hex member ID used by etcdctl,
+    the URLs are comma separated strings. '''
+    __slots__ = ()
+
+    @property
+    def started(self):
+        ''' Members that have been added but never started have no name. '''
+        return bool(self.name)
+
+
+# The v3 status of a single endpoint. IDs are hex, sizes are in bytes.
+EndpointStatus = namedtuple('EndpointStatus', [
+    'endpoint', 'member_id', 'leader', 'version', 'db_size',
+    'db_size_in_use', 'raft_term', 'raft_index', 'raft_applied_index',
+    'revision', 'is_learner', 'errors'])
+
+# A raised alarm. alarm is the alarm name, eg: NOSPACE or CORRUPT.
+Alarm = namedtuple('Alarm', ['member_id', 'alarm'])
+
+# etcdctl prints the AlarmType enum as a number, the gateway by name.
+ALARM_TYPES = {0: 'NONE', 1: 'NOSPACE', 2: 'CORRUPT'}
+
+# The outcome of probing a single member's status endpoint.
+MemberHealth = namedtuple('MemberHealth', [
+    'name', 'unit_id', 'endpoint', 'healthy', 'latency_ms', 'raft_term',
+    'leader', 'db_size', 'error'])
+
+
 class EtcdCtl:
     ''' etcdctl modeled as a python class. This python wrapper consumes
     and exposes some of the commands contained in etcdctl. Related to unit
-    registration, cluster health, and other operations '''
+    registration, cluster health, and other operations. Every command uses
+    the v3 API and is parsed from JSON into Member, EndpointStatus and Alarm
+    records. '''
     class CommandFailed(Exception):
         pass
 
-    def register(self, cluster_data):
+    class Transient(CommandFailed):
+        ''' A failure which may succeed on another endpoint or later. '''
+        pass
+
+    def __init__(self, native=True, policy=None):
+        ''' @params native - talk to the v3 JSON gateway over a persistent
+        connection, falling back to forking etcdctl when it is unreachable.
+        @params policy - the RetryPolicy, read from config by default
+        '''
+        self.native = native
+        self.policy = policy or RetryPolicy.from_config()
+
+    def _fallback(self, error):
+        log('etcd gateway unavailable, falling back to etcdctl: {}'.format(
+            error), 'DEBUG')
+
+    def call(self, rpc, body, arguments, endpoints=None, json_output=True,
+             route=ROUTE_DIRECT, policy=None):
+        ''' Perform a v3 RPC and return the decoded JSON response.
+
+        @params rpc - the gateway path of the RPC, eg: cluster/member/list
+        @params body - the JSON request body for the gateway
+        @params arguments - the equivalent etcdctl arguments, used when the
+        gateway cannot be reached
+        @params endpoints - the endpoint(s) to target, defaults to the local
+        member
+        @params json_output - False for etcdctl commands which have no JSON
+        output, in which case an empty response is returned
+        @params route, policy - see run()
+        '''
+        policy = policy or self.policy
+        if self.native:
+            targets = self._route(endpoints, route)
+            for endpoint in targets:
+                try:
+                    return gateway_call(get_gateway(endpoint), rpc, body,
+                                        policy.command_timeout)
+                except EtcdGateway.Unavailable as e:
+                    self._fallback(e)
+                except EtcdGateway.RequestFailed as e:
+                    if route != ROUTE_DIRECT and e.endpoint_specific:
+                        log(str(e), 'DEBUG')
+                        continue
+                    log(str(e), 'WARNING')
+                    raise EtcdCtl.CommandFailed(str(e)) from e
+            if route != ROUTE_DIRECT:
+                # Fall back over the endpoints already resolved above.
+                endpoints, route = ','.join(targets), ROUTE_ANY
+
+        if not json_output:
+            self.run(arguments, endpoints=endpoints, route=route,
+                     policy=policy)
+            return {}
+        out = self.run(list(arguments) + ['--write-out', 'json'],
+                       endpoints=endpoints, route=route, policy=policy)
+        try:
+            return json.loads(out)
+        except ValueError as e:
+            raise EtcdCtl.CommandFailed(
+                'Unexpected etcdctl output: {}'.format(out)) from e
+
+    def register(self, cluster_data, learner=False):
         ''' Perform self registration against the etcd leader and returns the
-        raw output response.
+        initial cluster string to start with.
 
         @params cluster_data - a dict of data to fill out the request to
         push our registration to the leader
         requires keys: leader_address, port, unit_name, cluster_address,
         management_port
+        @params learner - add the member as a non-voting raft learner, which
+        must be promoted with member_promote() once it has caught up
         '''
         # Build a connection string for the cluster data.
         connection = get_connection_string([cluster_data['cluster_address']],
                                            cluster_data['management_port'])
-
-        command = 'member add {} {}'.format(
-            cluster_data['unit_name'],
-            connection
-        )
-
+        body = {'peerURLs': [connection]}
+        arguments = ['member', 'add', cluster_data['unit_name'],
+                     '--peer-urls', connection]
+        if learner:
+            body['isLearner'] = True
+            arguments.append('--learner')
+
+        invalidate_snapshots()
         try:
-            result = self.run(command, endpoints=cluster_data['leader_address'], api=2)
+            result = self.call(
+                'cluster/member/add', body, arguments,
+                endpoints=cluster_data['leader_address'], route=ROUTE_LEADER)
         except EtcdCtl.CommandFailed:
             log('Notice:  Unit failed self registration', 'WARNING')
             raise
 
-        # ['Added member named etcd12 with ID b9ab5b5a2e4baec5 to cluster',
-        # '', 'ETCD_NAME="etcd12"',
-        #  'ETCD_INITIAL_CLUSTER="etcd11=https://10.113.96.26:2380,etcd12=https://10.113.96.206:2380"',  # noqa
-        # 'ETCD_INITIAL_CLUSTER_STATE="existing"', '']
-
-        reg = {}
-
-        for line in result.split('\n'):
-            if 'ETCD_INITIAL_CLUSTER=' in line:
-                reg['cluster'] = line.split('="')[-1].rstrip('"')
-        return reg
+        # Mirror the ETCD_INITIAL_CLUSTER string printed by etcdctl, where
+        # the member we just added has no name yet.
+        new_id = member_id_to_hex(result['member']['ID'])
+        cluster = []
+        for member in parse_members(result):
+            name = member.name
+            if member.unit_id == new_id:
+                name = cluster_data['unit_name']
+            for url in split_endpoints(member.peer_urls):
+                cluster.append('{}={}'.format(name, url))
+        return {'cluster': ','.join(cluster)}
 
     def unregister(self, unit_id, leader_address=None):
         ''' Perform self deregistration during unit teardown
@@ -63,39 +252,31 @@ class EtcdCtl:
         @params leader_address - The endpoint to communicate with the leader in
         the event of self deregistration.
         '''
-        return self.run(['member', 'remove', unit_id], endpoints=leader_address, api=2)
+        invalidate_snapshots()
+        return self.call('cluster/member/remove',
+                         {'ID': member_id_from_hex(unit_id)},
+                         ['member', 'remove', unit_id],
+                         endpoints=leader_address, route=ROUTE_LEADER)
+
+    def member_promote(self, unit_id, leader_address=None):
+        ''' Promote the learner unit_id to a voting member. etcd refuses
+        while the learner is too far behind the raft leader. '''
+        invalidate_snapshots()
+        return self.call('cluster/member/promote',
+                         {'ID': member_id_from_hex(unit_id)},
+                         ['member', 'promote', unit_id],
+                         endpoints=leader_address, route=ROUTE_LEADER)
 
     def member_list(self, leader_address=False):
         ''' Returns the output from `etcdctl member list` as a python dict
-        organized by unit_name, containing all the data-points in the resulting
-        response. '''
-        command = 'member list'
-
+        of Member records organized by unit_name. Members that have not
+        started yet have no name and are keyed by their unit_id instead. '''
+        result = self.call('cluster/member/list', {}, ['member', 'list'],
+                           endpoints=leader_address or None, route=ROUTE_ANY)
         members = {}
-        out = self.run(command, endpoints=leader_address, api=2)
-        raw_member_list = out.strip('\n').split('\n')
-        # Expect output like this:
-        # 4f24ee16c889f6c1: name=etcd20 peerURLs=https://10.113.96.197:2380 clientURLs=https://10.113.96.197:2379  # noqa
-        # edc04bb81479d7e8: name=etcd21 peerURLs=https://10.113.96.243:2380 clientURLs=https://10.113.96.243:2379  # noqa
-        # edc0dsa81479d7e8[unstarted]: peerURLs=https://10.113.96.124:2380  # noqa
-
-        for unit in raw_member_list:
-            if '[unstarted]' in unit:
-                unit_guid = unit.split('[')[0]
-                members['unstarted'] = {'unit_id': unit_guid}
-                if 'peerURLs=' in unit:
-                    peer_urls = unit.split(' ')[1].split("=")[-1]
-                    members['unstarted']['peer_urls'] = peer_urls
-                continue
-            unit_guid = unit.split(':')[0]
-            unit_name = unit.split(' ')[1].split("=")[-1]
-            peer_urls = unit.split(' ')[2].split("=")[-1]
-            client_urls = unit.split(' ')[3].split("=")[-1]
-
-            members[unit_name] = {'unit_id': unit_guid,
-                                  'name': unit_name,
-                                  'peer_urls': peer_urls,
-                                  'client_urls': client_urls}
+        for member in parse_members(result):
+            members[member.name or member.unit_id] = member
+        remember_endpoints(members.values())
         return members
 
     def member_update(self, unit_id, uri):
@@ -104,50 +285,293 @@ class EtcdCtl:
         @params unit_id: The string ID of the unit in the cluster.
         @params uri: The string universal resource indicator of where to
         contact the peer. '''
-        out = ''
+        invalidate_snapshots()
+        log('member update {} {}'.format(unit_id, uri))
         try:
-            command = 'member update {} {}'.format(unit_id, uri)
-            log(command)
-            # Run the member update command for the existing unit_id.
-            out = self.run(command)
+            self.call('cluster/member/update',
+                      {'ID': member_id_from_hex(unit_id), 'peerURLs': [uri]},
+                      ['member', 'update', unit_id, '--peer-urls', uri],
+                      route=ROUTE_LEADER)
         except EtcdCtl.CommandFailed:
             log('Failed to update member {}'.format(unit_id), 'WARNING')
-        return out
+            return ''
+        return 'Member {} updated with peer URL {}'.format(unit_id, uri)
+
+    def endpoint_status(self, endpoints=None):
+        ''' Returns a list of EndpointStatus records, one per endpoint. A
+        single etcdctl invocation is used for all the endpoints.
 
-    def cluster_health(self, output_only=False):
-        ''' Returns the output of etcdctl cluster-health as a python dict
-        organized by topical information with detailed unit output '''
+        @params endpoints - a comma separated string or a list of endpoints,
+        defaults to the local member
+        '''
+        if isinstance(endpoints, (list, tuple)):
+            endpoints = ','.join(endpoints)
+        targets = split_endpoints(endpoints) if endpoints else [None]
+        if self.native:
+            try:
+                return [parse_status(endpoint or LOCAL_ENDPOINT,
+                                     gateway_call(get_gateway(endpoint),
+                                                  'maintenance/status'))
+                        for endpoint in targets]
+            except EtcdGateway.Unavailable as e:
+                self._fallback(e)
+            except EtcdGateway.RequestFailed as e:
+                raise EtcdCtl.CommandFailed(str(e)) from e
+        out = self.run(['endpoint', 'status', '--write-out', 'json'],
+                       endpoints=endpoints)
+        try:
+            return [parse_status(s['Endpoint'], s['Status'])
+                    for s in json.loads(out)]
+        except (ValueError, KeyError) as e:
+            raise EtcdCtl.CommandFailed(
+                'Unexpected etcdctl output: {}'.format(out)) from e
+
+    def alarm_list(self, endpoints=None):
+        ''' Returns a list of the Alarm records raised in the cluster. '''
+        result = self.call('maintenance/alarm', {'action': 'GET'},
+                           ['alarm', 'list'], endpoints=endpoints,
+                           route=ROUTE_ANY)
+        return parse_alarms(result)
+
+    def alarm_disarm(self, endpoints=None):
+        ''' Disarm every alarm and return the Alarm records disarmed. '''
+        if self.native:
+            try:
+                gateway = get_gateway(endpoints)
+                alarms = parse_alarms(gateway_call(
+                    gateway, 'maintenance/alarm', {'action': 'GET'}))
+                for alarm in alarms:
+                    gateway_call(gateway, 'maintenance/alarm', {
+                        'action': 'DEACTIVATE',
+                        'memberID': member_id_from_hex(alarm.member_id),
+                        'alarm': alarm.alarm})
+                return alarms
+            except EtcdGateway.Unavailable as e:
+                self._fallback(e)
+            except EtcdGateway.RequestFailed as e:
+                raise EtcdCtl.CommandFailed(str(e)) from e
+        out = self.run(['alarm', 'disarm', '--write-out', 'json'],
+                       endpoints=endpoints, route=ROUTE_ANY)
+        try:
+            return parse_alarms(json.loads(out))
+        except ValueError as e:
+            raise EtcdCtl.CommandFailed(
+                'Unexpected etcdctl output: {}'.format(out)) from e
+
+    def compact(self, revision, physical=False, endpoints=None):
+        ''' Compact the event history up to revision. '''
+        self.call('kv/compaction',
+                  {'revision': str(revision), 'physical': physical},
+                  ['compact', str(revision),
+                   '--physical={}'.format('true' if physical else 'false')],
+                  endpoints=endpoints, json_output=False, route=ROUTE_ANY)
+        return 'compacted revision {}'.format(revision)
+
+    def defrag(self, endpoints=None):
+        ''' Defragment the storage of the member at endpoints. '''
+        timeout = max(self.policy.command_timeout, DEFRAG_TIMEOUT)
+        self.call('maintenance/defragment', {}, ['defrag'],
+                  endpoints=endpoints, json_output=False,
+                  policy=self.policy._replace(command_timeout=timeout))
+        return 'Finished defragmenting etcd member[{}]'.format(
+            endpoints or LOCAL_ENDPOINT)
+
+    def snapshot_save(self, path, endpoints=None):
+        ''' Save a consistent snapshot of the member at endpoints to path.
+        The save is not retried, a partial file is left as path.part. '''
+        timeout = max(self.policy.command_timeout, SNAPSHOT_TIMEOUT)
+        self.run(['snapshot', 'save', path], endpoints=endpoints,
+                 policy=self.policy._replace(command_timeout=timeout,
+                                             attempts=1))
+
+    def backup(self, data_dir, backup_dir):
+        ''' Copy the v2 store of data_dir to backup_dir, rewriting the member
+        and cluster IDs, with `etcdctl backup`. '''
+        self.run(['backup', '--data-dir', data_dir,
+                  '--backup-dir', backup_dir], api=2)
+
+    def cluster_health(self, output_only=False, timeout=None,
+                       member_list=None):
+        ''' Returns the health of every cluster member as a python dict
+        organized by topical information with detailed unit output. The
+        'members' key holds one MemberHealth record per member.
+
+        @params member_list - returns the members to probe, defaults to
+        listing them with member_list()
+        '''
         health = {}
         try:
-            out = self.run('cluster-health', endpoints=False, api=2)
-            if output_only:
-                return out
-            health_output = out.strip('\n').split('\n')
-            health['status'] = health_output[-1]
-            health['units'] = health_output[0:-2]
+            members = (member_list or self.member_list)()
         except EtcdCtl.CommandFailed:
             log('Notice:  Unit failed cluster-health check', 'WARNING')
             health['status'] = 'cluster is unhealthy see log file for details.'
             health['units'] = []
+            health['members'] = []
+            if output_only:
+                return health['status']
+            return health
+
+        results = self.member_health(members, timeout or HEALTH_TIMEOUT)
+        lines = []
+        for result in results:
+            if result.healthy:
+                lines.append('member {} is healthy: got healthy result from '
+                             '{} in {}ms'.format(result.unit_id,
+                                                 result.endpoint,
+                                                 result.latency_ms))
+            else:
+                lines.append('member {} is unhealthy: {}'.format(
+                    result.unit_id, result.error))
+        healthy = len([r for r in results if r.healthy])
+        if results and healthy == len(results):
+            health['status'] = 'cluster is healthy'
+        elif healthy:
+            health['status'] = 'cluster is degraded'
+        else:
+            health['status'] = 'cluster is unhealthy'
+        health['units'] = lines
+        health['members'] = results
+        if output_only:
+            return '\n'.join(lines + [health['status']])
         return health
 
-    def run(self, arguments, endpoints=None, api=3):
+    def member_health(self, members, timeout=HEALTH_TIMEOUT):
+        ''' Probe the status of every member concurrently. Each probe is
+        bounded by timeout seconds, so a dead member costs one timeout for
+        the whole cluster rather than one per member.
+
+        @params members - the dict returned by member_list()
+        @params timeout - per endpoint deadline in seconds
+        Returns a list of MemberHealth records sorted by member name.
+        '''
+        if not members:
+            return []
+        pool = ThreadPoolExecutor(max_workers=len(members))
+        futures = {}
+        for name, member in members.items():
+            future = pool.submit(self._probe_member, name, member, timeout)
+            futures[future] = (name, member)
+        done, _ = wait(futures, timeout=timeout)
+        # Do not wait on stragglers, their sockets time out on their own.
+        pool.shutdown(wait=False)
+        flush_metrics()
+
+        results = []
+        for future, (name, member) in futures.items():
+            error = 'timed out after {}s'.format(timeout)
+            if future in done:
+                if future.exception() is None:
+                    results.append(future.result())
+                    continue
+                error = str(future.exception())
+            results.append(MemberHealth(name, member.unit_id, None, False,
+                                        None, None, None, None, error))
+        return sorted(results, key=lambda r: r.name)
+
+    def _probe_member(self, name, member, timeout):
+        urls = split_endpoints(member.client_urls)
+        error = 'no published client urls'
+        for url in urls:
+            start = time.time()
+            try:
+                status = self._probe_status(url, timeout)
+            except (EtcdGateway.Unavailable, EtcdGateway.RequestFailed,
+                    EtcdCtl.CommandFailed, ValueError) as e:
+                error = str(e) or e.__class__.__name__
+                continue
+            latency = round((time.time() - start) * 1000, 1)
+            if status.errors:
+                error = ', '.join(status.errors)
+                continue
+            return MemberHealth(name, member.unit_id, url, True, latency,
+                                status.raft_term, status.leader,
+                                status.db_size, None)
+        return MemberHealth(name, member.unit_id, urls[0] if urls else None,
+                            False, None, None, None, None, error)
+
+    def _probe_status(self, url, timeout):
+        if self.native:
+            ca_path, crt_path, key_path = tls_paths()
+            gateway = EtcdGateway(url, ca_path, crt_path, key_path,
+                                  timeout=timeout)
+            try:
+                return parse_status(url, gateway_call(gateway,
+                                                      'maintenance/status'))
+            finally:
+                gateway.close()
+        policy = self.policy._replace(dial_timeout=timeout,
+                                      command_timeout=timeout, attempts=1)
+        out = self.run(['endpoint', 'status', '--write-out', 'json'],
+                       endpoints=url, policy=policy)
+        return parse_status(url, json.loads(out)[0]['Status'])
+
+    def _route(self, endpoints, route):
+        ''' Return the ordered list of endpoints a command is tried on. '''
+        if route == ROUTE_DIRECT:
+            return [LOCAL_ENDPOINT if endpoints is None else endpoints]
+        targets = split_endpoints(endpoints) if endpoints else [LOCAL_ENDPOINT]
+        targets += [url for url in known_endpoints() if url not in targets]
+        if route == ROUTE_LEADER:
+            leader = self._leader_endpoint(targets)
+            if leader:
+                targets = [leader] + [t for t in targets if t != leader]
+        return targets
+
+    def _leader_endpoint(self, targets):
+        ''' Return a client URL of the raft leader, as seen by the first
+        of targets to answer, or None. '''
+        probe = EtcdCtl(self.native, self.policy._replace(attempts=1))
+        for target in targets:
+            try:
+                status = probe.endpoint_status(target)[0]
+                members = parse_members(probe.call(
+                    'cluster/member/list', {}, ['member', 'list'],
+                    endpoints=target))
+            except (EtcdCtl.CommandFailed, IndexError, ValueError):
+                continue
+            for member in members:
+                if member.unit_id == status.leader and member.client_urls:
+                    return split_endpoints(member.client_urls)[0]
+            return None
+        return None
+
+    def _attempt(self, targets, operation, policy):
+        ''' Call operation(endpoint) on each of targets in turn until one
+        succeeds. Transient failures move on to the next endpoint, and the
+        whole list is retried with a jittered exponential backoff. Any other
+        failure is raised straight away. '''
+        error = None
+        for attempt in range(max(1, policy.attempts)):
+            if attempt:
+                time.sleep(policy.delay(attempt - 1))
+            for endpoint in targets:
+                try:
+                    return operation(endpoint)
+                except EtcdCtl.Transient as e:
+                    log('etcd endpoint {} failed: {}'.format(endpoint, e),
+                        'DEBUG')
+                    error = e
+        raise error
+
+    def run(self, arguments, endpoints=None, api=3, route=ROUTE_DIRECT,
+            policy=None):
         ''' Wrapper to subprocess calling output. This is a convenience
-        method to clean up the calls to subprocess and append TLS data'''
+        method to clean up the calls to subprocess and append TLS data.
+
+        @params route - ROUTE_DIRECT, ROUTE_ANY or ROUTE_LEADER, see above.
+        The v2 API is always routed directly.
+        @params policy - a RetryPolicy overriding the one of this instance
+        '''
+        policy = policy or self.policy
         env = {}
         command = [etcdctl_command()]
-        opts = layer.options('tls-client')
-        ca_path = opts['ca_certificate_path']
-        crt_path = opts['server_certificate_path']
-        key_path = opts['server_key_path']
+        ca_path, crt_path, key_path = tls_paths()
 
         if api == 3:
             env['ETCDCTL_API'] = '3'
             env['ETCDCTL_CACERT'] = ca_path
             env['ETCDCTL_CERT'] = crt_path
             env['ETCDCTL_KEY'] = key_path
-            if endpoints is None:
-                endpoints = 'http://127.0.0.1:4001'
 
         elif api == 2:
             env['ETCDCTL_API'] = '2'
@@ -156,6 +580,7 @@ class EtcdCtl:
             env['ETCDCTL_KEY_FILE'] = key_path
             if endpoints is None:
                 endpoints = ':4001'
+            route = ROUTE_DIRECT
 
         else:
             raise NotImplementedError(
@@ -169,41 +594,294 @@ class EtcdCtl:
             raise RuntimeError(
                 'arguments not correct type; must be string, list or tuple')
 
-        if endpoints is not False:
-            if api == 3:
-                command.extend(['--endpoints', endpoints])
-            elif api == 2:
-                command.insert(1, '--endpoint')
-                command.insert(2, endpoints)
-
+        if api == 3:
+            command.extend([
+                '--dial-timeout', '{}s'.format(policy.dial_timeout),
+                '--command-timeout', '{}s'.format(policy.command_timeout)])
+
+        def execute(endpoint):
+            cmd = list(command)
+            if endpoint is not False:
+                if api == 3:
+                    cmd.extend(['--endpoints', endpoint])
+                elif api == 2:
+                    cmd[1:1] = ['--endpoint', endpoint]
+            return self._execute(cmd, env, policy.deadline)
+
+        return self._attempt(self._route(endpoints, route), execute, policy)
+
+    def _execute(self, command, env, deadline):
         try:
-            return check_output(
-                command,
-                env=env
-            ).decode('utf-8')
+            with timed(command_label(command), command_endpoint(command)):
+                out = check_output(
+                    command,
+                    env=env,
+                    stderr=PIPE,
+                    timeout=deadline
+                )
+            return out.decode('utf-8')
+        except TimeoutExpired as e:
+            log('{} killed after {}s'.format(command, deadline), 'WARNING')
+            raise EtcdCtl.Transient(
+                'etcdctl timed out after {}s'.format(deadline)) from e
         except CalledProcessError as e:
+            error = (e.stderr or b'').decode('utf-8', 'replace').strip()
             log(command, 'ERROR')
             log(env, 'ERROR')
             log(e.stdout, 'ERROR')
-            log(e.stderr, 'ERROR')
-            raise EtcdCtl.CommandFailed() from e
+            log(error, 'ERROR')
+            if is_transient(error):
+                raise EtcdCtl.Transient(error) from e
+            raise EtcdCtl.CommandFailed(error) from e
 
     def version(self):
         ''' Return the version of etcdctl '''
+        if self.native:
+            try:
+                return get_gateway(None).version()['etcdserver']
+            except (EtcdGateway.Unavailable, EtcdGateway.RequestFailed,
+                    KeyError) as e:
+                self._fallback(e)
         out = check_output(
             [etcdctl_command(), 'version'],
-            env={'ETCDCTL_API': '3'}
+            env={'ETCDCTL_API': '3'},
+            timeout=self.policy.deadline
         ).decode('utf-8')
 
         if out == "No help topic for 'version'\n":
             # Probably on etcd2
             out = check_output(
-                [etcdctl_command(), '--version']
+                [etcdctl_command(), '--version'],
+                timeout=self.policy.deadline
             ).decode('utf-8')
 
         return out.split('\n')[0].split()[2]
 
 
+class ClusterSnapshot:
+    ''' A per-hook view of the cluster as seen from one endpoint. Each
+    datapoint is fetched lazily on first use and then shared by every
+    handler in the hook, until a membership change invalidates it. '''
+
+    def __init__(self, endpoints=None):
+        self.endpoints = endpoints
+        self.etcdctl = EtcdCtl()
+        self._data = {}
+
+    def _get(self, key, loader):
+        if key not in self._data:
+            self._data[key] = loader()
+        return self._data[key]
+
+    def invalidate(self):
+        ''' Forget everything loaded so far. '''
+        self._data = {}
+
+    @property
+    def members(self):
+        ''' The member_list() of the cluster. Raises EtcdCtl.CommandFailed
+        like member_list() does, without caching the failure. '''
+        return self._get('members', lambda: self.etcdctl.member_list(
+            self.endpoints or False))
+
+    @property
+    def health(self):
+        ''' The cluster_health() of the members listed by members. '''
+        return self._get('health', lambda: self.etcdctl.cluster_health(
+            member_list=lambda: self.members))
+
+    @property
+    def leader(self):
+        ''' The name of the current leader, or None if it is unknown. '''
+        def load():
+            try:
+                status = self.etcdctl.endpoint_status(self.endpoints)[0]
+                members = self.members
+            except (EtcdCtl.CommandFailed, IndexError):
+                return None
+            for member in members.values():
+                if member.unit_id == status.leader:
+                    return member.name
+            return None
+        return self._get('leader', load)
+
+    @property
+    def version(self):
+        ''' The version of etcd. '''
+        return self._get('version', etcd_version)
+
+
+def cluster_snapshot(endpoints=None):
+    ''' Return the shared ClusterSnapshot for endpoints. '''
+    if endpoints not in _snapshots:
+        _snapshots[endpoints] = ClusterSnapshot(endpoints)
+    return _snapshots[endpoints]
+
+
+def invalidate_snapshots():
+    ''' Drop every cached ClusterSnapshot datapoint. Called after any call
+    that changes cluster membership. '''
+    for snapshot in _snapshots.values():
+        snapshot.invalidate()
+
+
+def snap_revision():
+    ''' Return the revision of the installed etcd snap, or None. '''
+    try:
+        return os.readlink(SNAP_PATH)
+    except OSError:
+        return None
+
+
+def etcd_version():
+    ''' Return the installed etcd version, or 'n/a' if it cannot be
+    determined. The answer only changes when the snap is refreshed, so it is
+    cached in unitdata keyed by the snap revision. In order of preference the
+    version is read from the snap metadata, the local server's /version
+    endpoint, and finally etcdctl itself. '''
+    db = unitdata.kv()
+    revision = snap_revision()
+    cached = db.get('etcd.version')
+    if revision and cached and cached.get('revision') == revision:
+        return cached['version']
+
+    version = None
+    try:
+        with open(os.path.join(SNAP_PATH, 'meta', 'snap.yaml')) as fp:
+            version = str(yaml.safe_load(fp).get('version', ''))
+    except (OSError, ValueError, AttributeError, yaml.YAMLError):
+        pass
+    if not version or not re.match(r'\d+\.\d+\.\d+', version):
+        try:
+            version = get_gateway(None).version()['etcdserver']
+        except (EtcdGateway.Unavailable, EtcdGateway.RequestFailed,
+                KeyError):
+            try:
+                version = EtcdCtl(native=False).version()
+            except (CalledProcessError, IndexError, OSError):
+                log('Failed to get etcd version', 'ERROR')
+                return 'n/a'
+
+    if revision:
+        db.set('etcd.version', {'revision': revision, 'version': version})
+    return version
+
+
+def supports_learners(version=None):
+    ''' Whether etcd supports raft learners, added in 3.4. '''
+    version = version or etcd_version()
+    match = re.match(r'(\d+)\.(\d+)', version)
+    return bool(match) and tuple(map(int, match.groups())) >= (3, 4)
+
+
+def tls_paths():
+    ''' Return the CA, certificate and key paths used to talk to etcd. '''
+    global _tls_paths
+    if _tls_paths is None:
+        opts = layer.options('tls-client')
+        _tls_paths = (opts['ca_certificate_path'],
+                      opts['server_certificate_path'],
+                      opts['server_key_path'])
+    return _tls_paths
+
+
+def get_gateway(endpoints=None):
+    ''' Return the shared gateway client for the first of endpoints,
+    defaulting to the local insecure listener. '''
+    endpoint = split_endpoints(endpoints)[0] if endpoints else LOCAL_ENDPOINT
+    if endpoint not in _gateways:
+        ca_path, crt_path, key_path = tls_paths()
+        try:
+            _gateways[endpoint] = EtcdGateway(endpoint, ca_path, crt_path,
+                                              key_path)
+        except ValueError as e:
+            raise EtcdGateway.Unavailable(str(e)) from e
+    return _gateways[endpoint]
+
+
+def gateway_call(gateway, rpc, body=None, timeout=None):
+    ''' Call an RPC on gateway, recording its wall time.
+
+    @params timeout - the socket timeout in seconds of this call only, the
+    gateway is shared and keeps its own
+    '''
+    with timed('gateway ' + rpc, gateway.endpoint):
+        return gateway.call(rpc, body, timeout)
+
+
+def known_endpoints():
+    ''' Return the client URLs of every member seen by the last successful
+    member_list(), used to fail over when the local member is down. '''
+    return list(unitdata.kv().get('etcd.endpoints', []) or [])
+
+
+def remember_endpoints(members):
+    ''' Record the client URLs of members for known_endpoints(). '''
+    urls = []
+    for member in members:
+        urls.extend(split_endpoints(member.client_urls))
+    if urls:
+        unitdata.kv().set('etcd.endpoints', urls)
+
+
+def is_transient(error):
+    ''' Whether an error message describes a failure worth retrying. '''
+    error = error.lower()
+    return any(message in error for message in TRANSIENT_ERRORS)
+
+
+def member_id_to_hex(member_id):
+    ''' The v3 API reports member IDs as decimal uint64s (as a string over
+    the gateway, a number from etcdctl), whereas etcdctl member commands
+    expect them in hex. '''
+    return '{:x}'.format(int(member_id))
+
+
+def member_id_from_hex(unit_id):
+    ''' Convert a hex member ID into the decimal string used by the gateway.
+    '''
+    return str(int(unit_id, 16))
+
+
+def parse_members(result):
+    ''' Parse a v3 member list/add/remove response into Member records. '''
+    return [Member(member_id_to_hex(m['ID']),
+                   m.get('name', ''),
+                   ','.join(m.get('peerURLs', [])),
+                   ','.join(m.get('clientURLs', [])),
+                   bool(m.get('isLearner', False)))
+            for m in result.get('members', [])]
+
+
+def parse_status(endpoint, status):
+    ''' Parse a v3 status response into an EndpointStatus record. Older
+    servers omit some fields, which are reported as 0. '''
+    header = status.get('header', {})
+    return EndpointStatus(
+        endpoint,
+        member_id_to_hex(header.get('member_id', 0)),
+        member_id_to_hex(status.get('leader', 0)),
+        status.get('version', ''),
+        int(status.get('dbSize', 0)),
+        int(status.get('dbSizeInUse', 0)),
+        int(status.get('raftTerm') or header.get('raft_term', 0)),
+        int(status.get('raftIndex', 0)),
+        int(status.get('raftAppliedIndex', 0)),
+        int(header.get('revision', 0)),
+        bool(status.get('isLearner', False)),
+        list(status.get('errors', [])))
+
+
+def parse_alarms(result):
+    ''' Parse a v3 alarm response into Alarm records. '''
+    alarms = []
+    for alarm in result.get('alarms', []):
+        kind = alarm.get('alarm', 0)
+        alarms.append(Alarm(member_id_to_hex(alarm.get('memberID', 0)),
+                            ALARM_TYPES.get(kind, kind)))
+    return alarms
+
+
 def get_connection_string(members, port, protocol='https'):
     ''' Return a connection string for the list of members using the provided
     port and protocol (defaults to https)'''
@@ -39,18 +39,37 @@ from charmhelpers.contrib.charmsupport import nrpe
 from charms.layer import status
 
 from etcdctl import EtcdCtl
+from etcdctl import cluster_snapshot
+from etcdctl import etcd_version
 from etcdctl import get_connection_string
+from etcdctl import supports_learners
 from etcd_databag import EtcdDatabag
+from etcd_databag import WAL_MOUNT
+from etcd_databag import WAL_PATH
+from etcd_metrics import timed_check_output
+from etcd_tuning import config_tuning
+import etcd_disk
+import etcd_learner
+import etcd_maintenance
+import etcd_nrpe
+import etcd_rejoin
+import etcd_restart
+import etcd_rtt
+import etcd_scrape
+import etcd_snapshot
 from etcd_lib import (
+    file_hash,
     get_ingress_address,
     get_ingress_addresses,
+    get_peer_data,
     render_grafana_dashboard,
+    set_peer_data,
+    systemd_quote,
+    write_if_changed,
 )
 
 from shlex import split
 from subprocess import check_call
-from subprocess import check_output
-from subprocess import CalledProcessError
 from shutil import copyfile
 
 import json
@@ -61,7 +80,6 @@ import time
 import traceback
 import yaml
 import shutil
-import random
 
 
 # Layer Note:   the @when_not etcd.installed state checks are relating to
@@ -77,6 +95,8 @@ import random
 nrpe.Check.shortname_re = r'[\.A-Za-z0-9-_]+$'
 
 GRAFANA_DASHBOARD_NAME = 'etcd'
+SYSTEMD_DIR = '/etc/systemd/system/'
+SNAPSHOT_UNIT = 'etcd-snapshot'
 
 register_trigger(when_not="endpoint.grafana.joined", clear_flag="grafana.configured")
 register_trigger(when_not="endpoint.prometheus.joined",
@@ -114,18 +134,20 @@ def snap_upgrade_notice():
 @when_not('upgrade.series.in-progress')
 def check_cluster_health():
     ''' report on the cluster health every 5 minutes'''
-    etcdctl = EtcdCtl()
-    health = etcdctl.cluster_health()
+    cluster = cluster_snapshot()
+    health = cluster.health
 
     # Determine if the unit is healthy or unhealthy
     if 'unhealthy' in health['status']:
         unit_health = "UnHealthy"
+    elif 'degraded' in health['status']:
+        unit_health = "Degraded"
     else:
         unit_health = "Healthy"
 
     # Determine units peer count, and surface 0 by default
     try:
-        peers = len(etcdctl.member_list())
+        peers = len(cluster.members)
     except Exception:
         unit_health = "Errored"
         peers = 0
@@ -133,6 +155,44 @@ def check_cluster_health():
     bp = "{0} with {1} known peer{2}"
     status_message = bp.format(unit_health, peers, 's' if peers != 1 else '')
 
+    _, tuning_error = config_tuning()
+    if tuning_error:
+        status.blocked('Invalid performance tuning: {}'.format(tuning_error))
+        return
+
+    _, schedule_error = etcd_snapshot.config_schedule()
+    if schedule_error:
+        status.blocked('Invalid snapshot schedule: {}'.format(schedule_error))
+        return
+
+    _, compaction_error = etcd_maintenance.config_compaction()
+    if compaction_error:
+        status.blocked('Invalid auto compaction: {}'.format(compaction_error))
+        return
+
+    _, thresholds_error = etcd_nrpe.config_thresholds()
+    if thresholds_error:
+        status.blocked('Invalid nagios_metric_thresholds: {}'.format(
+            thresholds_error))
+        return
+
+    maintenance_error = etcd_maintenance.last_error()
+    if maintenance_error:
+        status.blocked('Keyspace maintenance failed: {}'.format(
+            maintenance_error))
+        return
+
+    if is_flag_set('etcd.learner'):
+        status.maintenance('Catching up as a raft learner')
+        return
+
+    bag = EtcdDatabag()
+    disk = etcd_disk.measured(bag.wal_path or bag.etcd_data_dir)
+    level, disk_message = etcd_disk.verdict(disk or {},
+                                            *etcd_disk.thresholds())
+    if level:
+        status_message = '{}, {}'.format(status_message, disk_message)
+
     status.active(status_message)
 
 
@@ -140,8 +200,8 @@ def check_cluster_health():
 @when_not('etcd.installed')
 def set_app_version():
     ''' Surface the etcd application version on juju status '''
-    # note - the snap doesn't place an etcd alias on disk. This shall infer
-    # the version from etcdctl, as the snap distributes both in lockstep.
+    # note - the version is resolved from the installed snap, which
+    # distributes etcd and etcdctl in lockstep.
     application_version_set(etcd_version())
 
 
@@ -177,6 +237,7 @@ def remove_states():
     remove_state('etcd.ssl.placed')
     remove_state('etcd.ssl.exported')
     remove_state('etcd.nrpe.configured')
+    remove_state('etcd.snapshot-schedule.configured')
     # force a config re-render in case template changed
     set_state('etcd.rerender-config')
 
@@ -212,24 +273,24 @@ def leader_config_changed():
     if previous_port and previous_mgmt_port:
         bag = EtcdDatabag()
         etcdctl = EtcdCtl()
-        members = etcdctl.member_list()
+        members = cluster_snapshot().members
         # Iterate over all the members in the list.
         for unit_name in members:
             # Grab the previous peer url and replace the management port.
-            peer_urls = members[unit_name]['peer_urls']
+            peer_urls = members[unit_name].peer_urls
             log('Previous peer url: {0}'.format(peer_urls))
             old_port = ':{0}'.format(previous_mgmt_port)
             new_port = ':{0}'.format(configuration.get('management_port'))
             url = peer_urls.replace(old_port, new_port)
             # Update the member's peer_urls with the new ports.
-            log(etcdctl.member_update(members[unit_name]['unit_id'], url))
+            log(etcdctl.member_update(members[unit_name].unit_id, url))
         # Render just the leaders configuration with the new values.
-        render_config()
+        changed = render_config()
         address = get_ingress_address('cluster')
         leader_set({'leader_address':
                    get_connection_string([address],
                                          bag.management_port)})
-        host.service_restart(bag.etcd_daemon)
+        restart_on_change(bag, changed)
 
 
 @when('snap.installed.etcd')
@@ -249,15 +310,106 @@ def bind_to_all_interfaces_changed():
     set_state('etcd.rerender-config')
 
 
+@when('snap.installed.etcd')
+@when_any('config.changed.performance_profile',
+          'config.changed.performance_overrides',
+          'config.changed.auto_compaction_mode',
+          'config.changed.auto_compaction_retention')
+@when_not('upgrade.series.in-progress')
+def performance_tuning_changed():
+    set_state('etcd.rerender-config')
+
+
+@when('snap.installed.etcd')
+@when('leadership.changed.rtt-heartbeat-interval')
+@when_not('upgrade.series.in-progress')
+def rtt_timeouts_changed():
+    ''' The leader published new RTT derived timeouts. '''
+    if etcd_rtt.enabled():
+        set_state('etcd.rerender-config')
+
+
+@when('config.changed.metrics_port')
+@when('snap.installed.etcd')
+@when_not('upgrade.series.in-progress')
+def metrics_port_changed():
+    set_state('etcd.rerender-config')
+
+
+@when('config.changed.rtt_tuning')
+@when('snap.installed.etcd')
+@when_not('upgrade.series.in-progress')
+def rtt_tuning_changed():
+    if etcd_rtt.published():
+        set_state('etcd.rerender-config')
+
+
+@when('cluster.joined')
+@when_any('etcd.registered', 'etcd.leader.configured')
+@when_not('upgrade.series.in-progress')
+def measure_peer_rtt(cluster):
+    ''' Periodically time connects to the peers and publish the p99 for the
+    leader to derive heartbeat and election timeouts from. '''
+    if not etcd_rtt.enabled() or not etcd_rtt.due():
+        return
+    own = set(get_ingress_addresses('db'))
+    peers = [a for a in cluster.get_db_ingress_addresses() if a not in own]
+    samples = etcd_rtt.measure(peers, config('port'))
+    etcd_rtt.mark_measured()
+    if samples:
+        set_peer_data({etcd_rtt.RTT_KEY: etcd_rtt.p99(samples)})
+
+
+@when('leadership.is_leader')
+@when('cluster.joined')
+@when_not('upgrade.series.in-progress')
+def derive_rtt_timeouts():
+    ''' Publish timeouts for the worst p99 RTT any unit measured. Units
+    apply them with a rolling restart. '''
+    if not etcd_rtt.enabled():
+        return
+    rtt = etcd_rtt.cluster_rtt()
+    if rtt is None:
+        return
+    heartbeat, election = etcd_rtt.derive(rtt)
+    current = etcd_rtt.published()
+    if not etcd_rtt.should_publish(current and current[0], heartbeat):
+        return
+    log('Peer p99 RTT is {}ms, publishing heartbeat-interval {}ms and '
+        'election-timeout {}ms'.format(rtt, heartbeat, election))
+    leader_set({etcd_rtt.HEARTBEAT_KEY: heartbeat,
+                etcd_rtt.ELECTION_KEY: election})
+    set_state('etcd.rerender-config')
+
+
+@when('leadership.is_leader')
+@when('etcd.leader.configured')
+@when_not('upgrade.series.in-progress')
+def maintain_keyspace():
+    ''' Every few minutes, check the database sizes against the quota and
+    recover from a NOSPACE alarm, or a database nearing the quota, with a
+    compaction, a rolling defrag and an alarm disarm, one step per hook. '''
+    if not etcd_maintenance.due() and not etcd_maintenance.remediation():
+        return
+    tuning, _ = config_tuning()
+    try:
+        etcd_maintenance.maintain(etcd_maintenance.effective_quota(tuning),
+                                  config('quota_remediation_ratio') or 0)
+    except EtcdCtl.CommandFailed as e:
+        log('Could not check the database sizes: {}'.format(e), 'WARNING')
+    except etcd_maintenance.MaintenanceFailed:
+        # The error is kept for check_cluster_health() to report
+        pass
+
+
 @when('etcd.rerender-config')
 @when_not('upgrade.series.in-progress')
 def rerender_config():
     ''' Config must be updated and service restarted '''
     bag = EtcdDatabag()
     log('Rendering config file for {0}'.format(bag.unit_name))
-    render_config()
-    if host.service_running(bag.etcd_daemon):
-        host.service_restart(bag.etcd_daemon)
+    if render_config() and host.service_running(bag.etcd_daemon):
+        schedule_restart()
     set_app_version()
 
 
@@ -277,7 +429,6 @@ def send_cluster_connection_details(cluster, db):
     cert = read_tls_cert('client.crt')
     key = read_tls_cert('client.key')
     ca = read_tls_cert('ca.crt')
-    etcdctl = EtcdCtl()
 
     # Set the key, cert, and ca on the db relation
     db.set_client_credentials(key, cert, ca)
@@ -293,7 +444,7 @@ def send_cluster_connection_details(cluster, db):
     # Create a connection string with all the members on the configured port.
     connection_string = get_connection_string(members, port)
     # Set the connection string on the db relation.
-    db.set_connection_string(connection_string, version=etcdctl.version())
+    db.set_connection_string(connection_string, version=etcd_version())
 
 
 @when('db.connected')
@@ -305,8 +456,6 @@ def send_single_connection_details(db):
     key = read_tls_cert('client.key')
     ca = read_tls_cert('ca.crt')
 
-    etcdctl = EtcdCtl()
-
     # Set the key and cert on the db relation
     db.set_client_credentials(key, cert, ca)
 
@@ -317,7 +466,7 @@ def send_single_connection_details(db):
     # Create a connection string with this member on the configured port.
     connection_string = get_connection_string(members, bag.port)
     # Set the connection string on the db relation.
-    db.set_connection_string(connection_string, version=etcdctl.version())
+    db.set_connection_string(connection_string, version=etcd_version())
 
 
 @when('proxy.connected')
@@ -332,15 +481,14 @@ def send_cluster_details(proxy):
     proxy.set_client_credentials(key, cert, ca)
 
     # format a list of cluster participants
-    etcdctl = EtcdCtl()
-    peers = etcdctl.member_list()
+    peers = cluster_snapshot().members
     cluster = []
     for peer in peers:
         thispeer = peers[peer]
         # Potential member doing registration. Default to skip
-        if 'peer_urls' not in thispeer.keys() or not thispeer['peer_urls']:
+        if not thispeer.started or not thispeer.peer_urls:
             continue
-        peer_string = "{}={}".format(thispeer['name'], thispeer['peer_urls'])
+        peer_string = "{}={}".format(thispeer.name, thispeer.peer_urls)
         cluster.append(peer_string)
 
     proxy.set_cluster_string(','.join(cluster))
@@ -357,7 +505,14 @@ def channel_changed():
 def snap_install():
     channel = get_target_etcd_channel()
     snap.install('core')
-    if channel:
+    if not channel:
+        return
+    if snap.is_installed('etcd') and \
+            host.service_running(EtcdDatabag().etcd_daemon):
+        # Refreshing restarts etcd, so take a turn in the rolling restart.
+        set_flag('etcd.refresh.requested')
+        schedule_restart()
+    else:
         snap.install('etcd', channel=channel, classic=False)
         remove_state('etcd.ssl.exported')
 
@@ -391,7 +546,7 @@ def add_systemd_restart_always():
     try:
         # Get the systemd version
         cmd = ['systemd', '--version']
-        output = check_output(cmd).decode('UTF-8')
+        output = timed_check_output(cmd).decode('UTF-8')
         line = output.splitlines()[0]
         words = line.split()
         assert words[0] == 'systemd'
@@ -409,16 +564,92 @@ def add_systemd_restart_always():
     os.makedirs(dest_dir, exist_ok=True)
     copyfile(template, '{}/always-restart.conf'.format(dest_dir))
     check_call(['systemctl', 'daemon-reload'])
-    host.service_restart('{}.service'.format(service))
+    if host.service_running('{}.service'.format(service)):
+        schedule_restart()
     set_state('etcd.service-restart.configured')
 
 
+@when_any('config.changed.snapshot_interval',
+          'config.changed.snapshot_target',
+          'config.changed.snapshot_format',
+          'config.changed.snapshot_compression',
+          'config.changed.snapshot_retention_count',
+          'config.changed.snapshot_retention_days',
+          'config.changed.snapshot_bandwidth_limit')
+def snapshot_schedule_changed():
+    remove_state('etcd.snapshot-schedule.configured')
+
+
+@when('snap.installed.etcd')
+@when_not('etcd.snapshot-schedule.configured')
+@when_not('upgrade.series.in-progress')
+def configure_snapshot_schedule():
+    ''' Install, update or remove the systemd timer taking scheduled
+    snapshots. '''
+    schedule, error = etcd_snapshot.config_schedule()
+    if error:
+        # check_cluster_health() reports the error, keep the last timer
+        return
+    timer = SNAPSHOT_UNIT + '.timer'
+    if not schedule:
+        if os.path.exists(SYSTEMD_DIR + timer):
+            check_call(['systemctl', 'disable', '--now', timer])
+            for unit in ('.timer', '.service'):
+                os.remove(SYSTEMD_DIR + SNAPSHOT_UNIT + unit)
+            check_call(['systemctl', 'daemon-reload'])
+        set_state('etcd.snapshot-schedule.configured')
+        return
+
+    context = dict(schedule, charm_dir=hookenv.charm_dir(),
+                   charm_name=hookenv.charm_name(),
+                   target=systemd_quote(schedule['target']))
+    changed = False
+    for unit in ('.service', '.timer'):
+        content = render('{}{}'.format(SNAPSHOT_UNIT, unit), None, context)
+        changed |= write_if_changed(SYSTEMD_DIR + SNAPSHOT_UNIT + unit,
+                                    content, perms=0o644)
+    os.makedirs(schedule['target'], exist_ok=True)
+    if changed:
+        check_call(['systemctl', 'daemon-reload'])
+        # Restart the timer, so a new interval applies from now
+        check_call(['systemctl', 'enable', timer])
+        check_call(['systemctl', 'restart', timer])
+    set_state('etcd.snapshot-schedule.configured')
+
+
+@when('snap.installed.etcd')
+@when_not('etcd.disk.checked')
+@when_not('etcd.registered')
+@when_not('upgrade.series.in-progress')
+def disk_preflight():
+    ''' Measure the fsync latency of the disk the WAL will be written to
+    before etcd first starts, and refuse to join on a disk that is too slow.
+    '''
+    if not config('disk_preflight_seconds'):
+        set_flag('etcd.disk.checked')
+        return
+    bag = EtcdDatabag()
+    path = bag.wal_path or bag.etcd_data_dir
+    if not etcd_disk.measured(path):
+        status.maintenance('Measuring disk fsync latency')
+    result = etcd_disk.preflight(path)
+    level, message = etcd_disk.verdict(result, *etcd_disk.thresholds())
+    if level:
+        log(message, 'WARNING')
+    if level == 'blocked':
+        status.blocked(message)
+        return
+    set_flag('etcd.disk.checked')
+
+
 @when('snap.installed.etcd')
 @when('etcd.ssl.placed')
+@when('etcd.disk.checked')
 @when('cluster.joined')
 @when_not('leadership.is_leader')
 @when_not('etcd.registered')
 @when_not('etcd.installed')
+@when_not('etcd.rejoin.requested')
 @when_not('upgrade.series.in-progress')
 def register_node_with_leader(cluster):
     '''
@@ -438,14 +669,16 @@ def register_node_with_leader(cluster):
         # Check if we are already registered. Unregister ourselves if we are so
         # we can register from scratch.
         peer_url = 'https://%s:%s' % (bag.cluster_address, bag.management_port)
-        members = etcdctl.member_list(leader_address)
+        members = cluster_snapshot(leader_address).members
         for _, member in members.items():
-            if member['peer_urls'] == peer_url:
+            if member.peer_urls == peer_url:
                 log('Found member that matches our peer URL. Unregistering...')
-                etcdctl.unregister(member['unit_id'], leader_address)
+                etcdctl.unregister(member.unit_id, leader_address)
 
-        # Now register.
-        resp = etcdctl.register(bag.__dict__)
+        # Now register, as a learner where etcd supports them so the new
+        # member does not count toward quorum until it has caught up.
+        learner = supports_learners()
+        resp = etcdctl.register(bag.context(), learner=learner)
         bag.set_cluster(resp['cluster'])
     except EtcdCtl.CommandFailed:
         log('etcdctl.register failed, will retry')
@@ -457,9 +690,25 @@ def register_node_with_leader(cluster):
     host.service_restart(bag.etcd_daemon)
     open_port(bag.port)
     set_state('etcd.registered')
+    if learner:
+        set_flag('etcd.learner')
+        promote_learner()
+
+
+@when('etcd.registered')
+@when('etcd.learner')
+@when_not('upgrade.series.in-progress')
+def promote_learner():
+    ''' Promote this member to a voting member once its raft log has caught
+    up with the leader's. '''
+    if not etcd_learner.promote():
+        status.maintenance('Catching up as a raft learner')
+        return
+    clear_flag('etcd.learner')
 
 
 @when('etcd.ssl.placed')
+@when_any('etcd.disk.checked', 'etcd.registered')
 @when('leadership.is_leader')
 @when_not('etcd.leader.configured')
 @when_not('etcd.installed')
@@ -481,10 +730,11 @@ def initialize_new_leader():
     # sorry, some hosts need this. The charm races with systemd and wins.
     time.sleep(2)
 
-    # Check health status before we say we are good
-    etcdctl = EtcdCtl()
-    status = etcdctl.cluster_health()
-    if 'unhealthy' in status:
+    # Check health status before we say we are good. The restart above
+    # invalidates anything we may have learned about the cluster earlier.
+    cluster = cluster_snapshot()
+    cluster.invalidate()
+    if 'unhealthy' in cluster.health['status']:
         status.blocked('Cluster not healthy.')
         return
     # We have a healthy leader, broadcast initial data-points for followers
@@ -572,10 +822,16 @@ def tls_update():
     ''' Handle changes to the TLS data by ensuring that the service is
         restarted.
     '''
-    # ensure config is updated with new certs and service restarted
+    # ensure config is updated with new certs and service restarted, the
+    # config only holds the certificate paths so check their content too
     bag = EtcdDatabag()
-    render_config(bag)
-    host.service_restart(bag.etcd_daemon)
+    changed = render_config(bag)
+    certs = [file_hash(path) for path in (bag.ca_certificate,
+                                          bag.server_certificate,
+                                          bag.server_key)]
+    if data_changed('etcd.tls-certificates', certs):
+        changed = True
+    restart_on_change(bag, changed)
 
     # ensure that certs are re-echoed to the db relations
     remove_state('etcd.ssl.placed')
@@ -628,7 +884,8 @@ def force_rejoin():
 
     This action is required if leader unit performed snapshot restore. All
     other members must remove their local data and previous cluster
-    identities and join newly formed, restored, cluster.
+    identities and join newly formed, restored, cluster. Only one member can
+    join at a time, so the unit registers when the leader admits it.
     """
     log('Wiping local storage and rejoining cluster')
     conf = EtcdDatabag()
@@ -637,14 +894,10 @@ def force_rejoin():
     etcd_data = os.path.join(conf.storage_path(), 'member')
     if os.path.exists(etcd_data):
         shutil.rmtree(etcd_data)
-    for _ in range(11):
-        # We need randomized back-off timer because only one unit can be
-        # joining at the same time
-        time.sleep(random.randint(1, 10))
-        register_node_with_leader(None)
-        if is_flag_set('etcd.registered'):
-            log('Successfully rejoined the cluster')
-            break
+    if etcd_rejoin.request_rejoin():
+        set_flag('etcd.rejoin.requested')
+        status.waiting('Waiting for the leader to admit this unit')
+        rejoin_when_admitted()
 
 
 @when('leadership.changed.force_rejoin')
@@ -654,15 +907,46 @@ def force_rejoin_requested():
     check_cluster_health()
 
 
+@when('etcd.rejoin.requested')
+@when_not('leadership.is_leader')
+@when_not('upgrade.series.in-progress')
+def rejoin_when_admitted():
+    ''' Register with the leader once it admits us, then report back
+    when the member has caught up so the next unit can join. '''
+    if not is_flag_set('etcd.registered'):
+        if not etcd_rejoin.admitted():
+            return
+        register_node_with_leader(None)
+        if not is_flag_set('etcd.registered'):
+            return
+        log('Successfully rejoined the cluster')
+    if is_flag_set('etcd.learner'):
+        # etcd takes one learner at a time, the next unit waits until this
+        # one votes.
+        promote_learner()
+        if is_flag_set('etcd.learner'):
+            return
+    if etcd_rejoin.acknowledge():
+        clear_flag('etcd.rejoin.requested')
+
+
+@when('leadership.is_leader')
+@when('cluster.joined')
+@when_not('upgrade.series.in-progress')
+def coordinate_rejoins():
+    ''' Admit followers to the restored cluster one at a time. '''
+    etcd_rejoin.coordinate()
+
+
 @hook('cluster-relation-broken')
 def perform_self_unregistration(cluster=None):
     ''' Attempt self removal during unit teardown. '''
     etcdctl = EtcdCtl()
     leader_address = leader_get('leader_address')
     unit_name = os.getenv('JUJU_UNIT_NAME').replace('/', '')
-    members = etcdctl.member_list()
+    members = cluster_snapshot().members
     # Self Unregistration
-    etcdctl.unregister(members[unit_name]['unit_id'], leader_address)
+    etcdctl.unregister(members[unit_name].unit_id, leader_address)
 
 
 @hook('data-storage-attached')
@@ -687,11 +971,7 @@ def format_and_mount_storage():
         hookenv.log('Refusing to take action against {}'.format(block))
         return
 
-    # Format the device in non-interactive mode
-    cmd = ['mkfs.ext4', device_info['location'], '-F']
-    hookenv.log('Creating filesystem on {}'.format(device_info['location']))
-    hookenv.log('With command: {}'.format(' '.join(cmd)))
-    check_call(cmd)
+    format_volume(block)
 
     # halt etcd to perform the data-store migration
     host.service_stop(bag.etcd_daemon)
@@ -712,24 +992,82 @@ def format_and_mount_storage():
 
         check_call(cmd)
 
+    persist_mount(block, tail)
+
+    # Finally re-render the configuration and resume operation
+    restart_on_change(bag, render_config(bag))
+
+
+@hook('wal-storage-attached')
+def format_and_mount_wal_storage():
+    ''' Mount the optional wal storage and move the write ahead log onto it,
+    so WAL fsyncs do not compete with backend commits for the data disk. '''
+    device_info = storage_get()
+    block = device_info['location']
+    if volume_is_mounted(block):
+        hookenv.log('Device is already attached to the system.')
+        hookenv.log('Refusing to take action against {}'.format(block))
+        set_state('wal.volume.attached')
+        return
+
+    format_volume(block)
+
+    bag = EtcdDatabag()
+    bag.cluster = leader_get('cluster')
+    # A unit yet to install or register etcd picks the wal storage up when
+    # its configuration is first rendered, so there is nothing to restart.
+    running = (is_flag_set('snap.installed.etcd') and
+               is_flag_set('etcd.registered'))
+    if running:
+        # halt etcd so no segment is written during the migration
+        host.service_stop(bag.etcd_daemon)
+
+    os.makedirs(WAL_MOUNT, exist_ok=True)
+    mount_volume(block, WAL_MOUNT)
+    os.makedirs(WAL_PATH, exist_ok=True)
+
+    # Only attempt migration if the member has a wal in its data directory
+    wal_dir = os.path.join(bag.etcd_data_dir, 'member', 'wal')
+    if os.path.isdir(wal_dir):
+        cmd = ['rsync', '-azp', '{}/'.format(wal_dir), '{}/'.format(WAL_PATH)]
+        hookenv.log('Detected existing wal, migrating to new location.')
+        hookenv.log('With command: {}'.format(' '.join(cmd)))
+        check_call(cmd)
+        # etcd refuses to start with a wal in both places
+        shutil.rmtree(wal_dir)
+
+    persist_mount(block, WAL_MOUNT)
+
+    set_state('wal.volume.attached')
+    if running:
+        bag.wal_path = WAL_PATH
+        restart_on_change(bag, render_config(bag))
+
+
+def format_volume(block):
+    ''' Create an ext4 filesystem on the block device. '''
+    # Format the device in non-interactive mode
+    cmd = ['mkfs.ext4', block, '-F']
+    hookenv.log('Creating filesystem on {}'.format(block))
+    hookenv.log('With command: {}'.format(' '.join(cmd)))
+    check_call(cmd)
+
+
+def persist_mount(block, location):
+    ''' Add the mount of block on location to fstab, so it persists through
+    reboots. '''
     with open('/etc/fstab', 'r') as fp:
         contents = fp.readlines()
 
-    found = 0
     # scan fstab for the device
-    for line in contents:
-        if block in line:
-            found = found + 1
-
-    # if device not in fstab, append so it persists through reboots
-    if not found > 0:
-        append = "{0} {1} ext4 defaults 0 0".format(block, tail)  # noqa
-        with open('/etc/fstab', 'a') as fp:
-            fp.writelines([append])
+    if any(block in line for line in contents):
+        return
 
-    # Finally re-render the configuration and resume operation
-    render_config(bag)
-    host.service_restart(bag.etcd_daemon)
+    append = "{0} {1} ext4 defaults 0 0\n".format(block, location)
+    with open('/etc/fstab', 'a') as fp:
+        if contents and not contents[-1].endswith('\n'):
+            fp.write('\n')
+        fp.write(append)
 
 
 def read_tls_cert(cert):
@@ -763,7 +1101,9 @@ def initial_nrpe_config(nagios=None):
 
 
 @when_any('config.changed.nagios_context',
-          'config.changed.nagios_servicegroups')
+          'config.changed.nagios_servicegroups',
+          'config.changed.nagios_metric_thresholds',
+          'config.changed.nagios_metrics_max_age')
 def force_update_nrpe_config():
     remove_state('etcd.nrpe.configured')
 
@@ -783,39 +1123,31 @@ def update_nrpe_config(unused=None):
     # add our first check, to alert on service failure
     nrpe.add_init_service_checks(nrpe_setup, services, current_unit)
 
-    # add the cron job to populate the cache for our second check
-    # (we cache the output of 'etcdctl alarm list' to minimise overhead)
-    with open("templates/check_etcd-alarms.cron") as fp:
-        write_file(
-            path="/etc/cron.d/check_etcd-alarms",
-            content=fp.read().encode(),
-            owner="root",
-            perms=0o644,
-        )
-
-    # create an empty output file for the above
+    # A single collector caches the metrics of the local member once a
+    # minute, and every metrics check reads from that cache.
+    for path in etcd_nrpe.LEGACY_FILES:
+        if os.path.exists(path):
+            os.remove(path)
     write_file(
-        path="/var/lib/nagios/etcd-alarm-list.txt",
-        content="",
+        path=etcd_nrpe.CRON,
+        content=render('check_etcd-metrics.cron', None, {
+            'charm_dir': hookenv.charm_dir(),
+            'cache': etcd_scrape.CACHE_PATH}).encode(),
         owner="root",
         perms=0o644,
     )
-
-    # install the NRPE script for the above
-    with open("templates/check_etcd-alarms.py") as fp:
+    with open("templates/check_etcd-metrics.py") as fp:
         write_file(
-            path="/usr/lib/nagios/plugins/check_etcd-alarms.py",
+            path=etcd_nrpe.PLUGIN,
             content=fp.read().encode(),
             owner="root",
             perms=0o755,
         )
 
-    # define our second check, to alert on etcd alarm status
-    nrpe_setup.add_check(
-        "etcd-alarms",
-        "Verify etcd has no raised alarms",
-        "/usr/lib/nagios/plugins/check_etcd-alarms.py",
-    )
+    settings, _ = etcd_nrpe.config_thresholds()
+    for shortname, description, command in etcd_nrpe.checks(
+            settings, config('nagios_metrics_max_age')):
+        nrpe_setup.add_check(shortname, description, command)
 
     nrpe_setup.write()
     set_state('etcd.nrpe.configured')
@@ -836,6 +1168,10 @@ def remove_nrpe_config(nagios=None):
 
     for service in services:
         nrpe_setup.remove_check(shortname=service)
+    for shortname, _, _ in etcd_nrpe.checks({}, 0):
+        nrpe_setup.remove_check(shortname=shortname)
+    if os.path.exists(etcd_nrpe.CRON):
+        os.remove(etcd_nrpe.CRON)
 
 
 @when('endpoint.prometheus.joined',
@@ -850,16 +1186,21 @@ def register_prometheus_jobs():
     prometheus = endpoint_from_flag('endpoint.prometheus.joined')
     cluster = endpoint_from_flag('cluster.joined')
 
-    peer_ips = cluster.get_db_ingress_addresses() if cluster else []
-    peer_ips.append(get_ingress_address('db'))
-    targets = ["{}:{}".format(ip, config('port')) for ip in peer_ips]
-    log('Configuring Prometheus scrape targets: {}'.format(targets), DEBUG)
+    # Label every member with its unit name, rather than an address
+    addresses = get_peer_data('db-ingress-address') if cluster else {}
+    addresses[hookenv.local_unit()] = get_ingress_address('db')
+    metrics_port = config('metrics_port')
+    port = metrics_port or config('port')
+    static_configs = [
+        {'targets': ['{}:{}'.format(addresses[unit], port)],
+         'labels': {'instance': unit}}
+        for unit in sorted(addresses)]
+    log('Configuring Prometheus scrape targets: {}'.format(static_configs),
+        DEBUG)
     prometheus.register_job(job_name='etcd',
                             job_data={
-                                'scheme': 'https',
-                                'static_configs': [
-                                    {'targets': targets},
-                                ]
+                                'scheme': 'http' if metrics_port else 'https',
+                                'static_configs': static_configs,
                             })
     set_flag('prometheus.configured')
 
@@ -901,7 +1242,7 @@ def register_grafana_dashboard():
 def volume_is_mounted(volume):
     ''' Takes a hardware path and returns true/false if it is mounted '''
     cmd = ['df', '-t', 'ext4']
-    out = check_output(cmd).decode('utf-8')
+    out = timed_check_output(cmd).decode('utf-8')
     return volume in out
 
 
@@ -930,6 +1271,13 @@ def close_open_ports():
         close_port(previous_port)
         open_port(port)
 
+    previous_metrics_port = configuration.previous('metrics_port')
+    metrics_port = configuration.get('metrics_port')
+    if previous_metrics_port and previous_metrics_port != metrics_port:
+        close_port(previous_metrics_port)
+    if metrics_port:
+        open_port(metrics_port)
+
 
 def install(src, tgt):
     ''' This method wraps the bash "install" command '''
@@ -937,65 +1285,102 @@ def install(src, tgt):
 
 
 def render_config(bag=None):
-    ''' Render the etcd configuration template for the given version '''
+    ''' Render the etcd configuration template for the given version.
+    The file is only rewritten, atomically, when its content changes.
+    Returns True if it did, so callers can skip needless restarts. '''
     if not bag:
         bag = EtcdDatabag()
 
-    move_etcd_data_to_standard_location()
+    move_etcd_data_to_standard_location(bag)
 
     v2_conf_path = "{}/etcd.conf".format(bag.etcd_conf_dir)
     v3_conf_path = "{}/etcd.conf.yml".format(bag.etcd_conf_dir)
 
     # probe for 2.x compatibility
     if etcd_version().startswith('2.'):
-        render('etcd2.conf', v2_conf_path, bag.__dict__, owner='root',
-               group='root')
+        changed = write_if_changed(
+            v2_conf_path, render('etcd2.conf', None, bag.context()))
     # default to 3.x template behavior
     else:
-        render('etcd3.conf', v3_conf_path, bag.__dict__, owner='root',
-               group='root')
+        changed = write_if_changed(
+            v3_conf_path, render('etcd3.conf', None, bag.context()))
         if os.path.exists(v2_conf_path):
             # v3 will fail if the v2 config is left in place
             os.remove(v2_conf_path)
+            changed = True
     # Close the previous client port and open the new one.
     close_open_ports()
     remove_state('etcd.rerender-config')
+    return changed
 
 
-def etcd_version():
-    ''' This method surfaces the version from etcdctl '''
-    raw_output = None
-    try:
-        # try v3
-        raw_output = check_output(
-            ['/snap/bin/etcd.etcdctl', 'version'],
-            env={'ETCDCTL_API': '3'}
-        ).decode('utf-8').strip()
-        if "No help topic for 'version'" in raw_output:
-            # handle v2
-            raw_output = check_output(
-                ['/snap/bin/etcd.etcdctl', '--version']
-            ).decode('utf-8').strip()
-        for line in raw_output.splitlines():
-            if 'etcdctl version' in line:
-                # "etcdctl version: 3.0.17" or "etcdctl version 2.3.8"
-                version = line.split()[-1]
-                return version
-        hookenv.log('Unable to find etcd version: {}'.format(raw_output),
-                    level=hookenv.ERROR)
-        return 'n/a'
-    except (ValueError, CalledProcessError):
-        hookenv.log('Failed to get etcd version:\n'
-                    '{}'.format(traceback.format_exc()), level=hookenv.ERROR)
-        return 'n/a'
+def restart_on_change(bag, changed):
+    ''' Restart etcd if its configuration changed, or start it if it is not
+    running. Every restart costs a leader election, so an unchanged running
+    member is left alone, and a changed one takes its turn in the rolling
+    restart. '''
+    if not host.service_running(bag.etcd_daemon):
+        host.service_restart(bag.etcd_daemon)
+        return True
+    if changed:
+        schedule_restart()
+        return True
+    log('etcd configuration unchanged, skipping restart', DEBUG)
+    return False
+
+
+def schedule_restart():
+    ''' Restart etcd when the leader grants this unit the restart token, or
+    straight away when there are no peers to coordinate with. '''
+    if etcd_restart.request_restart() is None:
+        perform_restart()
+        return
+    log('Waiting for a rolling restart token')
+    set_flag('etcd.restart.requested')
+    restart_when_granted()
+
+
+@when('etcd.restart.requested')
+@when_not('upgrade.series.in-progress')
+def restart_when_granted():
+    ''' Restart once the leader has granted us the restart token. '''
+    nonce = etcd_restart.granted()
+    if not nonce:
+        return
+    perform_restart()
+    etcd_restart.acknowledge(nonce)
+
+
+@when('leadership.is_leader')
+@when('cluster.joined')
+@when_not('upgrade.series.in-progress')
+def coordinate_rolling_restarts():
+    ''' Hand out restart tokens one unit at a time, leader last. '''
+    etcd_restart.coordinate(perform_restart)
 
 
-def move_etcd_data_to_standard_location():
+def perform_restart():
+    ''' Restart etcd, refreshing the snap instead if a channel change is
+    waiting on the restart. '''
+    bag = EtcdDatabag()
+    if is_flag_set('etcd.refresh.requested'):
+        channel = get_target_etcd_channel()
+        log('Refreshing etcd to {}'.format(channel))
+        snap.install('etcd', channel=channel, classic=False)
+        remove_state('etcd.ssl.exported')
+        clear_flag('etcd.refresh.requested')
+    else:
+        host.service_restart(bag.etcd_daemon)
+    clear_flag('etcd.restart.requested')
+
+
+def move_etcd_data_to_standard_location(bag=None):
     ''' Moves etcd data to the standard location if it's not already located
     there. This is necessary when generating new etcd config after etcd has
     been upgraded from version 2.3 to 3.x.
     '''
-    bag = EtcdDatabag()
+    if not bag:
+        bag = EtcdDatabag()
     conf_path = bag.etcd_conf_dir + '/etcd.conf.yml'
     if not os.path.exists(conf_path):
         return
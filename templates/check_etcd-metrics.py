@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2020 Canonical Ltd.
+
+import argparse
+import json
+import time
+
+import nagios_plugin3
+
+CACHE_PATH = '/var/lib/nagios/etcd-metrics.json'
+
+# check name: (label, unit of the value)
+CHECKS = {
+    'wal-fsync-p99': ('WAL fsync p99', 'ms'),
+    'backend-commit-p99': ('backend commit p99', 'ms'),
+    'leader-changes': ('leader changes in the last hour', ''),
+    'proposals-pending': ('pending proposals', ''),
+    'db-quota': ('database size', '%'),
+    'alarms': ('alarms', ''),
+}
+
+
+def load_cache(path, max_age):
+    """Load the cached metrics, failing if they are missing or stale"""
+    try:
+        with open(path) as fp:
+            cache = json.load(fp)
+    except (OSError, ValueError) as e:
+        raise nagios_plugin3.UnknownError(
+            'UNKNOWN - cannot read {}: {}'.format(path, e))
+    age = int(time.time() - cache.get('scraped', 0))
+    if age > max_age:
+        raise nagios_plugin3.CriticalError(
+            'CRITICAL - metrics cache is stale, last scraped {}s ago{}'.format(
+                age, ': {}'.format(cache['error']) if cache.get('error')
+                else ''))
+    return cache['values']
+
+
+def check_alarms(values):
+    """Raise an error if any alarm is raised"""
+    alarms = values.get('alarms') or []
+    perfdata = '| alarms={}'.format(len(alarms))
+    if alarms:
+        raise nagios_plugin3.CriticalError('CRITICAL - alarms raised: {} {}'
+                                           .format(', '.join(alarms),
+                                                   perfdata))
+    print('OK - no active alarms {}'.format(perfdata))
+
+
+def check_threshold(name, values, warning, critical):
+    """Compare a value to its thresholds and report it with perfdata"""
+    label, unit = CHECKS[name]
+    value = values.get(name)
+    if value is None:
+        print('OK - no {} recorded recently'.format(label))
+        return
+    perfdata = '| {}={}{};{};{};0'.format(
+        name, value, unit, '' if warning is None else warning,
+        '' if critical is None else critical)
+    message = '{} is {}{} {}'.format(label, value, unit, perfdata)
+    if critical is not None and value >= critical:
+        raise nagios_plugin3.CriticalError('CRITICAL - ' + message)
+    if warning is not None and value >= warning:
+        raise nagios_plugin3.WarnError('WARNING - ' + message)
+    print('OK - ' + message)
+
+
+def check(args):
+    values = load_cache(args.cache, args.max_age)
+    if args.check == 'alarms':
+        check_alarms(values)
+    else:
+        check_threshold(args.check, values, args.warning, args.critical)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check a metric of the local etcd member.')
+    parser.add_argument('check', choices=sorted(CHECKS))
+    parser.add_argument('-w', '--warning', type=float)
+    parser.add_argument('-c', '--critical', type=float)
+    parser.add_argument('--max-age', type=int, default=300,
+                        help='seconds after which the cache is stale')
+    parser.add_argument('--cache', default=CACHE_PATH)
+    nagios_plugin3.try_check(check, parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
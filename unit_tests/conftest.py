@@ -0,0 +1,48 @@
+from contextlib import ExitStack
+from unittest.mock import patch
+
+import pytest
+
+
+class FakeCluster:
+    """Leader data and peer relation data shared by the units."""
+
+    def __init__(self, units, local):
+        self.units = units
+        self.local = local
+        self.leader = {}
+        self.relation = {unit: {} for unit in units}
+
+    def get_peer_data(self, key):
+        return {unit: data[key] for unit, data in self.relation.items()
+                if data.get(key)}
+
+    def set_peer_data(self, settings):
+        self.relation[self.local].update(settings)
+        return True
+
+    def peer_units(self):
+        return [unit for unit in self.units if unit != self.local]
+
+
+@pytest.fixture
+def peer_cluster():
+    """Returns a function building a FakeCluster of units, with etcd/0 the
+    local unit, that module reads its leader and peer relation data from.
+    Members are caught up unless cluster.caught_up says otherwise."""
+    with ExitStack() as stack:
+        def build(module, units):
+            cluster = FakeCluster(units, units[0])
+            for name, fake in (('get_peer_data', cluster.get_peer_data),
+                               ('set_peer_data', cluster.set_peer_data),
+                               ('peer_units', cluster.peer_units),
+                               ('local_unit', lambda: cluster.local),
+                               ('leader_get', cluster.leader.get),
+                               ('leader_set', cluster.leader.update)):
+                stack.enter_context(patch('{}.{}'.format(module, name),
+                                          fake))
+            cluster.caught_up = stack.enter_context(
+                patch('{}.member_caught_up'.format(module)))
+            cluster.caught_up.return_value = True
+            return cluster
+        yield build
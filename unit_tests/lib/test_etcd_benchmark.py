@@ -0,0 +1,145 @@
+import base64
+from unittest.mock import patch
+
+import pytest
+
+import etcd_benchmark
+from etcd_gateway import EtcdGateway
+
+
+@pytest.fixture
+def kv():
+    kv = {}
+    with patch('etcd_benchmark.unitdata') as unitdata:
+        unitdata.kv.return_value.get.side_effect = kv.get
+        unitdata.kv.return_value.set.side_effect = kv.__setitem__
+        yield kv
+
+
+class FakeCluster:
+    """An in memory keyspace served to every gateway connected to it."""
+
+    def __init__(self, fail=()):
+        self.keys = {}
+        self.calls = []
+        self.fail = fail
+        self.connected = []
+        self.closed = 0
+
+    def connect(self, endpoint):
+        self.connected.append(endpoint)
+        return FakeGateway(self)
+
+
+class FakeGateway:
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    def call(self, rpc, body):
+        self.cluster.calls.append(rpc)
+        if rpc in self.cluster.fail:
+            raise EtcdGateway.RequestFailed('{} failed'.format(rpc))
+        key = base64.b64decode(body.get('key', ''))
+        if rpc == 'kv/put':
+            self.cluster.keys[key] = body['value']
+        elif rpc == 'kv/txn':
+            request = body['success'][0]['request_put']
+            self.cluster.keys[base64.b64decode(request['key'])] = \
+                request['value']
+        elif rpc == 'kv/deleterange':
+            end = base64.b64decode(body['range_end'])
+            for name in list(self.cluster.keys):
+                if key <= name < end:
+                    del self.cluster.keys[name]
+        return {}
+
+    def stream(self, rpc, body):
+        yield {'created': True}
+        yield {'events': [{'type': 'PUT'}]}
+
+    def close(self):
+        self.cluster.closed += 1
+
+
+@pytest.mark.parametrize('text, message', [
+    ('put=1,delete=1', 'unknown operation'),
+    ('put', 'needs a weight'),
+    ('put=-1', 'must not be negative'),
+    ('put=0', 'at least one operation'),
+])
+def test_invalid_mix(text, message):
+    """Test malformed operation mixes are refused."""
+    with pytest.raises(ValueError, match=message):
+        etcd_benchmark.parse_mix(text)
+
+
+def test_mix_defaults_and_drops_unweighted_operations():
+    """Test an empty mix is the default and zero weights are dropped."""
+    assert etcd_benchmark.parse_mix('') == {'put': 40, 'range': 40,
+                                            'txn': 10, 'watch': 10}
+    assert etcd_benchmark.parse_mix('put=1, watch=0') == {'put': 1}
+
+
+def test_keys_have_the_requested_size():
+    """Test keys are padded to key_size and cleanup covers the prefix."""
+    keys = etcd_benchmark.keyspace('/b/', 100, 16)
+    assert keys[0] == '/b/0000000000000'
+    assert all(len(k) == 16 for k in keys)
+    assert etcd_benchmark.keyspace('/b/', 100, 1)[-1] == '/b/99'
+    assert etcd_benchmark.prefix_end('/b/') == b'/b0'
+
+
+def test_percentiles_per_operation():
+    """Test latencies are reported in milliseconds per operation."""
+    samples = {'put': [i / 1000.0 for i in range(1, 1001)]}
+    result = etcd_benchmark.summarise(samples, {'put': 2, 'watch': 1}, 10)
+    assert result['put'] == {'count': 1000, 'errors': 2, 'ops-per-sec': 100.0,
+                             'p50': 500.0, 'p95': 950.0, 'p99': 990.0,
+                             'p999': 999.0}
+    assert result['watch']['count'] == 0
+    assert result['watch']['p99'] is None
+
+
+def test_run_spreads_clients_and_cleans_up():
+    """Test every operation runs and the keyspace is deleted afterwards."""
+    cluster = FakeCluster()
+    endpoints = ['https://10.0.0.1:2379', 'https://10.0.0.2:2379']
+    result = etcd_benchmark.run(endpoints, cluster.connect, keys=10,
+                                concurrency=4, duration=0.2)
+    assert set(result['operations']) == set(etcd_benchmark.OPERATIONS)
+    assert all(s['count'] and not s['errors']
+               for s in result['operations'].values())
+    assert sorted(cluster.connected[1:5]) == sorted(endpoints * 2)
+    assert cluster.keys == {}
+    assert cluster.closed == len(cluster.connected)
+
+
+def test_failed_operations_are_counted():
+    """Test an operation that fails is counted rather than timed."""
+    cluster = FakeCluster(fail=('kv/range',))
+    result = etcd_benchmark.run(['http://127.0.0.1:4001'], cluster.connect,
+                                mix={'put': 1, 'range': 1}, keys=5,
+                                concurrency=1, duration=0.1)
+    assert result['operations']['range']['count'] == 0
+    assert result['operations']['range']['errors'] > 0
+    assert result['operations']['put']['errors'] == 0
+
+
+def test_runs_are_recorded_with_revisions(kv):
+    """Test runs are kept with the revisions and compared by workload."""
+    with patch.object(etcd_benchmark, 'charm_revision', return_value='42'), \
+            patch.object(etcd_benchmark, 'snap_revision',
+                         return_value='233'):
+        etcd_benchmark.record({'keys': 10}, {'ops-per-sec': 100.0}, '3.4.22')
+        etcd_benchmark.record({'keys': 20}, {'ops-per-sec': 50.0}, '3.4.22')
+    previous = etcd_benchmark.baseline({'keys': 10})
+    assert previous['result'] == {'ops-per-sec': 100.0}
+    assert previous['charm-revision'] == '42'
+    assert previous['snap-revision'] == '233'
+    assert etcd_benchmark.baseline({'keys': 30}) is None
+
+    for _ in range(etcd_benchmark.HISTORY):
+        etcd_benchmark.record({'keys': 20}, {})
+    assert len(etcd_benchmark.runs()) == etcd_benchmark.HISTORY
+    assert etcd_benchmark.baseline({'keys': 10}) is None
@@ -0,0 +1,60 @@
+import os
+from unittest.mock import patch
+
+import pytest
+
+import etcd_disk
+
+
+@pytest.fixture
+def kv():
+    kv = {}
+    with patch('etcd_disk.unitdata') as unitdata:
+        unitdata.kv.return_value.get.side_effect = kv.get
+        unitdata.kv.return_value.set.side_effect = kv.__setitem__
+        yield kv
+
+
+def test_fsync_benchmark_appends_synced_records(tmpdir):
+    """Test records are synced one by one and the test file removed."""
+    path = str(tmpdir.join('data'))
+    with patch('etcd_disk.os.fdatasync') as fdatasync:
+        result = etcd_disk.fsync_benchmark(path, seconds=5,
+                                           max_bytes=10 * 2300)
+    assert result['writes'] == 10
+    assert fdatasync.call_count == 10
+    assert result['write-size'] == 2300
+    assert result['p50'] <= result['p99'] <= result['max']
+    assert os.listdir(path) == []
+
+
+@pytest.mark.parametrize('p99, level', [
+    (5.0, None),
+    (20.0, 'warning'),
+    (150.0, 'blocked'),
+])
+def test_verdict(p99, level):
+    """Test the p99 is compared with the warning and blocked thresholds."""
+    result = {'path': '/var/snap/etcd/current', 'p99': p99}
+    found, message = etcd_disk.verdict(result, 10, 100)
+    assert found == level
+    if level:
+        assert message == ('Disk fsync p99 {}ms above {}ms on '
+                           '/var/snap/etcd/current'.format(
+                               p99, 100 if level == 'blocked' else 10))
+    assert etcd_disk.verdict(result, 0, 0) == (None, None)
+
+
+def test_preflight_measures_once_per_path(kv):
+    """Test a kept measurement is reused until it is replaced."""
+    with patch('etcd_disk.fsync_benchmark') as benchmark:
+        benchmark.side_effect = lambda path, seconds: {'path': path,
+                                                       'p99': 1.0}
+        etcd_disk.preflight('/data', 10)
+        etcd_disk.preflight('/data', 10)
+        assert benchmark.call_count == 1
+        etcd_disk.preflight('/media/etcd-wal/wal', 10)
+        assert benchmark.call_count == 2
+
+    etcd_disk.remember({'path': '/data', 'p99': 2.0})
+    assert etcd_disk.preflight('/data')['p99'] == 2.0
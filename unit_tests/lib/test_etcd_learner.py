@@ -0,0 +1,83 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import etcd_learner
+from etcdctl import EtcdCtl, Member, parse_status
+
+LEADER_URL = 'https://10.0.0.2:2379'
+
+
+@pytest.fixture
+def etcdctl():
+    etcdctl = MagicMock()
+    etcdctl.member_list.return_value = {
+        'etcd1': Member('1', 'etcd1', '', 'https://10.0.0.1:2379', True),
+        'etcd2': Member('2', 'etcd2', '', LEADER_URL, False)}
+    etcdctl.leader = parse_status(LEADER_URL, {
+        'header': {'member_id': 2}, 'leader': 2, 'raftIndex': 50000})
+    etcdctl.local = parse_status('https://127.0.0.1:4001', {
+        'header': {'member_id': 1}, 'leader': 2, 'isLearner': True,
+        'raftIndex': 49990, 'raftAppliedIndex': 10000})
+    etcdctl.endpoint_status.side_effect = lambda url=None: [
+        etcdctl.leader if url == LEADER_URL else etcdctl.local]
+    # A learner refuses MemberList
+    etcdctl.member_list.side_effect = EtcdCtl.CommandFailed(
+        'etcdserver: rpc not supported for learner')
+    with patch('etcd_learner.config') as config, \
+            patch('etcd_learner.leader_get') as leader_get, \
+            patch('etcd_learner.known_endpoints') as known_endpoints, \
+            patch('etcd_learner.time.sleep'):
+        config.return_value = 1000
+        leader_get.return_value = 'https://10.0.0.1:2379'
+        known_endpoints.return_value = ['https://10.0.0.1:2379', LEADER_URL]
+        yield etcdctl
+
+
+def test_lag_is_measured_from_the_applied_index(etcdctl):
+    """Test lag compares the learner's applied index to the leader's."""
+    assert etcd_learner.learner_lag(etcdctl) == (True, 40000)
+    etcdctl.local = etcdctl.local._replace(leader='0')
+    assert etcd_learner.learner_lag(etcdctl) == (True, None)
+
+
+def test_learner_is_promoted_once_caught_up(etcdctl):
+    """Test promotion waits for the lag to fall under the threshold."""
+    assert not etcd_learner.promote(timeout=0, etcdctl=etcdctl)
+    etcdctl.member_promote.assert_not_called()
+
+    etcdctl.local = etcdctl.local._replace(raft_applied_index=49500)
+    assert etcd_learner.promote(timeout=0, etcdctl=etcdctl)
+    etcdctl.member_promote.assert_called_once_with('1', LEADER_URL)
+
+
+def test_refused_promotion_is_retried(etcdctl):
+    """Test a promotion etcd refuses leaves the member a learner."""
+    etcdctl.local = etcdctl.local._replace(raft_applied_index=49500)
+    etcdctl.member_promote.side_effect = EtcdCtl.CommandFailed('not ready')
+    assert not etcd_learner.promote(timeout=0, etcdctl=etcdctl)
+
+
+def test_voting_member_needs_no_promotion(etcdctl):
+    """Test a member that already votes is left alone."""
+    etcdctl.local = etcdctl.local._replace(is_learner=False)
+    assert etcd_learner.promote(timeout=0, etcdctl=etcdctl)
+    etcdctl.member_promote.assert_not_called()
+
+
+def test_leader_is_found_without_asking_the_learner(etcdctl):
+    """Test the lag is read from the leader when the leadership data points
+    at another member and the local member refuses MemberList."""
+    etcdctl.local = etcdctl.local._replace(raft_applied_index=49500)
+    assert etcd_learner.learner_lag(etcdctl) == (True, 500)
+    assert etcd_learner.promote(timeout=0, etcdctl=etcdctl)
+    etcdctl.member_list.assert_not_called()
+    etcdctl.member_promote.assert_called_once_with('1', LEADER_URL)
+
+
+def test_unknown_leader_is_not_promoted(etcdctl):
+    """Test no promotion is attempted while the leader cannot be read."""
+    with patch('etcd_learner.known_endpoints', return_value=[]):
+        assert etcd_learner.learner_lag(etcdctl) == (True, None)
+        assert not etcd_learner.promote(timeout=0, etcdctl=etcdctl)
+    etcdctl.member_promote.assert_not_called()
@@ -1,6 +1,14 @@
+from unittest.mock import patch
+
+import grp
+import os
+import pwd
+
 from charmhelpers.contrib.templating import jinja
 
+import etcd_lib
 from etcd_lib import render_grafana_dashboard
+from etcd_lib import write_if_changed
 
 
 def test_render_grafana_dashboard():
@@ -17,3 +25,41 @@ def test_render_grafana_dashboard():
     rendered_dashboard = render_grafana_dashboard(datasource)
 
     assert rendered_dashboard == expected_dashboard
+
+
+def test_network_get_is_memoized():
+    """Test network-get is only called once per endpoint."""
+    etcd_lib.cached_network_get.cache_clear()
+    with patch('etcd_lib.network_get') as network_get:
+        network_get.return_value = {'ingress-addresses': ['10.0.0.1'],
+                                    'bind-addresses': []}
+        assert etcd_lib.get_ingress_address('db') == '10.0.0.1'
+        assert etcd_lib.get_ingress_addresses('db') == ['10.0.0.1']
+        etcd_lib.get_bind_address('db')
+        network_get.assert_called_once_with('db')
+    etcd_lib.cached_network_get.cache_clear()
+
+
+def test_write_if_changed(tmpdir):
+    """Test a file is only replaced when its content changes."""
+    path = str(tmpdir.join('etcd.conf.yml'))
+    owner = pwd.getpwuid(os.getuid()).pw_name
+    group = grp.getgrgid(os.getgid()).gr_name
+
+    assert write_if_changed(path, 'name: etcd0\n', owner, group)
+    inode = os.stat(path).st_ino
+    assert not write_if_changed(path, 'name: etcd0\n', owner, group)
+    assert os.stat(path).st_ino == inode
+
+    assert write_if_changed(path, 'name: etcd1\n', owner, group, 0o600)
+    with open(path) as fp:
+        assert fp.read() == 'name: etcd1\n'
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert tmpdir.listdir() == [tmpdir.join('etcd.conf.yml')]
+
+
+def test_systemd_quote():
+    """Test values are escaped for a double quoted unit argument."""
+    assert etcd_lib.systemd_quote('/srv/etcd backups') == '/srv/etcd backups'
+    assert etcd_lib.systemd_quote('/srv/"100%"\\x') == \
+        '/srv/\\"100%%\\"\\\\x'
@@ -0,0 +1,224 @@
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import etcd_maintenance
+from etcdctl import Alarm, EtcdCtl, Member, parse_status
+
+
+class FakeCluster:
+    """Three members whose statuses change as they are defragmented."""
+
+    def __init__(self):
+        self.members = {}
+        self.status = {}
+        for number in (1, 2, 3):
+            name = 'etcd{}'.format(number)
+            url = 'https://10.0.0.{}:2379'.format(number)
+            self.members[name] = Member(str(number), name, '', url, False)
+            self.status[url] = parse_status(url, {
+                'header': {'member_id': number}, 'leader': 2,
+                'raftIndex': 5000, 'dbSize': 1000, 'dbSizeInUse': 400})
+        self.defragged = []
+        self.etcdctl = MagicMock()
+        self.etcdctl.member_list.side_effect = lambda: self.members
+        self.etcdctl.endpoint_status.side_effect = \
+            lambda url: [self.status[url]]
+        self.etcdctl.defrag.side_effect = self.defrag
+
+    def defrag(self, url):
+        self.defragged.append(url)
+        status = self.status[url]
+        self.status[url] = status._replace(db_size=status.db_size_in_use)
+
+
+@pytest.fixture
+def cluster():
+    with patch('etcd_maintenance.time.sleep'), \
+            patch('etcd_maintenance.invalidate_snapshots'):
+        yield FakeCluster()
+
+
+def test_followers_are_defragmented_before_the_leader(cluster):
+    """Test members are defragmented one by one with the leader last."""
+    results = etcd_maintenance.rolling_defrag(cluster.etcdctl)
+    assert cluster.defragged == ['https://10.0.0.1:2379',
+                                 'https://10.0.0.3:2379',
+                                 'https://10.0.0.2:2379']
+    assert [r['name'] for r in results] == ['etcd1', 'etcd3', 'etcd2']
+    assert all(r['reclaimed'] == 600 for r in results)
+
+
+def test_members_mostly_in_use_are_skipped(cluster):
+    """Test a member above the in-use ratio is left alone."""
+    url = 'https://10.0.0.3:2379'
+    cluster.status[url] = cluster.status[url]._replace(db_size_in_use=900)
+    results = etcd_maintenance.rolling_defrag(cluster.etcdctl)
+    assert url not in cluster.defragged
+    assert results[1] == {'name': 'etcd3', 'endpoint': url, 'db_size': 1000,
+                          'db_size_in_use': 900, 'skipped': '90% in use'}
+
+
+def test_unhealthy_cluster_stops_the_rollout(cluster):
+    """Test the rollout stops when a member lags after its defrag."""
+    def defrag(url):
+        cluster.defragged.append(url)
+        cluster.status[url] = cluster.status[url]._replace(raft_index=0)
+    cluster.etcdctl.defrag.side_effect = defrag
+
+    with pytest.raises(etcd_maintenance.MaintenanceFailed) as e:
+        etcd_maintenance.rolling_defrag(cluster.etcdctl, timeout=0)
+    assert 'etcd1 trails the leader by 5000 entries' in str(e.value)
+    assert cluster.defragged == ['https://10.0.0.1:2379']
+    assert [r['name'] for r in e.value.results] == ['etcd1']
+
+
+def test_health_problems():
+    """Test unreachable, leaderless and lagging members are reported."""
+    leader = parse_status('a', {'header': {'member_id': 2}, 'leader': 2,
+                                'raftIndex': 5000})
+    lagging = parse_status('b', {'header': {'member_id': 1}, 'leader': 2,
+                                 'raftIndex': 1000})
+    assert etcd_maintenance.health_problems(
+        {'etcd1': ('b', lagging), 'etcd2': ('a', leader)}) == [
+        'etcd1 trails the leader by 4000 entries']
+    assert etcd_maintenance.health_problems(
+        {'etcd1': ('b', None), 'etcd2': ('a', leader)}) == [
+        'etcd1 is unreachable']
+    assert etcd_maintenance.health_problems(
+        {'etcd1': ('b', lagging._replace(leader='0'))}) == [
+        'etcd1 has no leader']
+
+
+def test_failed_defrag_is_reported(cluster):
+    """Test a failing defrag raises with the progress made."""
+    cluster.etcdctl.defrag.side_effect = EtcdCtl.CommandFailed('boom')
+    with pytest.raises(etcd_maintenance.MaintenanceFailed) as e:
+        etcd_maintenance.rolling_defrag(cluster.etcdctl)
+    assert 'Defrag of etcd1 failed: boom' == str(e.value)
+
+
+@pytest.mark.parametrize('mode,retention,expected', [
+    ('periodic', '', {}),
+    ('periodic', '0', {}),
+    ('periodic', '30m', {'auto-compaction-mode': 'periodic',
+                         'auto-compaction-retention': '30m'}),
+    ('revision', '10000', {'auto-compaction-mode': 'revision',
+                           'auto-compaction-retention': '10000'}),
+])
+def test_compaction(mode, retention, expected):
+    """Test auto compaction settings are derived from the config."""
+    assert etcd_maintenance.compaction(mode, retention) == expected
+
+
+@pytest.mark.parametrize('mode,retention', [
+    ('hourly', '1h'), ('revision', '1h'), ('periodic', 'soon')])
+def test_invalid_compaction(mode, retention):
+    """Test unknown modes and malformed retentions are refused."""
+    with pytest.raises(ValueError):
+        etcd_maintenance.compaction(mode, retention)
+
+
+@pytest.fixture
+def kv():
+    data = {}
+    kv = MagicMock()
+    kv.get.side_effect = data.get
+    kv.set.side_effect = data.__setitem__
+    kv.unset.side_effect = lambda key: data.pop(key, None)
+    with patch('etcd_maintenance.unitdata.kv', return_value=kv):
+        yield data
+
+
+def raise_nospace(cluster):
+    cluster.alarms = [Alarm('2', 'NOSPACE')]
+    cluster.etcdctl.alarm_list.side_effect = lambda: cluster.alarms
+    cluster.etcdctl.alarm_disarm.side_effect = cluster.disarm
+    for url, status in cluster.status.items():
+        cluster.status[url] = status._replace(
+            errors=['memberID:2 alarm:NOSPACE '], revision=7)
+
+
+def maintain_until_done(cluster, quota):
+    """Run maintain() once per hook until the remediation finishes and
+    return the steps of every hook."""
+    hooks = [etcd_maintenance.maintain(quota, 0.8, cluster.etcdctl)]
+    while etcd_maintenance.remediation():
+        hooks.append(etcd_maintenance.maintain(quota, 0.8, cluster.etcdctl))
+    return hooks
+
+
+def test_nospace_is_compacted_defragmented_and_disarmed(cluster, kv):
+    """Test a NOSPACE alarm runs the whole remediation in order, one step
+    per hook."""
+    def disarm():
+        disarmed, cluster.alarms = cluster.alarms, []
+        return disarmed
+    cluster.disarm = disarm
+    raise_nospace(cluster)
+
+    hooks = maintain_until_done(cluster, 2000)
+    cluster.etcdctl.compact.assert_called_once_with(7, physical=True)
+    assert cluster.defragged == ['https://10.0.0.1:2379',
+                                 'https://10.0.0.3:2379',
+                                 'https://10.0.0.2:2379']
+    assert hooks == [['compacted to revision 7'],
+                     ['defragmented etcd1'],
+                     ['defragmented etcd3'],
+                     ['defragmented etcd2'],
+                     ['defragmented 3 members, reclaiming 1800 bytes',
+                      'disarmed NOSPACE']]
+    assert etcd_maintenance.last_error() is None
+
+
+def test_remediation_waits_for_the_cluster_between_hooks(cluster, kv):
+    """Test an unhealthy member holds the remediation until a later hook,
+    and a cluster that never recovers abandons it."""
+    cluster.disarm = MagicMock()
+    raise_nospace(cluster)
+    assert etcd_maintenance.maintain(2000, 0.8, cluster.etcdctl)
+
+    url = 'https://10.0.0.1:2379'
+    healthy = cluster.status[url]
+    cluster.status[url] = healthy._replace(raft_index=0)
+    assert etcd_maintenance.maintain(2000, 0.8, cluster.etcdctl) == []
+    assert cluster.defragged == []
+    cluster.status[url] = healthy
+    assert etcd_maintenance.maintain(2000, 0.8, cluster.etcdctl) == \
+        ['defragmented etcd1']
+
+    cluster.status[url] = healthy._replace(raft_index=0)
+    later = time.time() + etcd_maintenance.STEP_TIMEOUT
+    with patch('etcd_maintenance.time.time', return_value=later):
+        with pytest.raises(etcd_maintenance.MaintenanceFailed):
+            etcd_maintenance.maintain(2000, 0.8, cluster.etcdctl)
+    assert etcd_maintenance.remediation() is None
+    assert 'trails the leader' in etcd_maintenance.last_error()
+
+
+def test_remediation_stops_when_the_data_does_not_fit(cluster, kv):
+    """Test live data above the quota fails before the alarm is disarmed."""
+    cluster.disarm = MagicMock()
+    raise_nospace(cluster)
+
+    with pytest.raises(etcd_maintenance.MaintenanceFailed):
+        maintain_until_done(cluster, 300)
+    cluster.disarm.assert_not_called()
+    assert etcd_maintenance.remediation() is None
+    assert 'larger quota-backend-bytes' in etcd_maintenance.last_error()
+
+
+def test_growth_towards_the_quota_is_remediated_hourly(cluster, kv):
+    """Test size triggered remediation is rate limited."""
+    cluster.etcdctl.alarm_list.return_value = []
+    cluster.etcdctl.alarm_disarm.return_value = []
+    assert etcd_maintenance.maintain(5000, 0.8, cluster.etcdctl) == []
+    assert kv[etcd_maintenance.USAGE_KEY] == 0.2
+
+    assert all(maintain_until_done(cluster, 1200))
+    assert len(cluster.defragged) == 3
+    for url, status in cluster.status.items():
+        cluster.status[url] = status._replace(db_size=1000)
+    assert etcd_maintenance.maintain(1200, 0.8, cluster.etcdctl) == []
+    assert len(cluster.defragged) == 3
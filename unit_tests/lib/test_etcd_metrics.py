@@ -0,0 +1,75 @@
+import threading
+from subprocess import CalledProcessError
+from unittest.mock import patch
+
+import pytest
+
+import etcd_metrics
+
+
+@pytest.fixture
+def kv():
+    kv = {}
+    with patch('etcd_metrics.unitdata') as unitdata:
+        unitdata.kv.return_value.get.side_effect = kv.get
+        unitdata.kv.return_value.set.side_effect = kv.__setitem__
+        yield kv
+
+
+def test_command_label_and_endpoint():
+    """Test commands are named by their executable and subcommands."""
+    command = ['/snap/bin/etcd.etcdctl', 'member', 'list', '--write-out',
+               'json', '--endpoints', 'https://10.0.0.1:2379']
+    assert etcd_metrics.command_label(command) == 'etcdctl member list'
+    assert etcd_metrics.command_endpoint(command) == 'https://10.0.0.1:2379'
+    assert etcd_metrics.command_label(['df', '-t', 'ext4']) == 'df'
+    assert etcd_metrics.command_endpoint('etcdctl --endpoints=x get') == 'x'
+    assert etcd_metrics.command_endpoint(['systemd', '--version']) == 'local'
+
+
+def test_timed_records_status(kv):
+    """Test successes and failures are both recorded."""
+    with etcd_metrics.timed('etcdctl defrag', 'local'):
+        pass
+    with pytest.raises(CalledProcessError):
+        with etcd_metrics.timed('etcdctl defrag', 'local'):
+            raise CalledProcessError(2, 'etcdctl')
+    statuses = [r[2] for r in kv[etcd_metrics.METRICS_KEY]]
+    assert statuses == [0, 2]
+
+
+def test_ring_buffer_is_bounded(kv):
+    """Test only the most recent records are kept."""
+    with patch('etcd_metrics.RING_SIZE', 10):
+        for i in range(25):
+            etcd_metrics.record('cmd', 'local', 0, i / 1000)
+    records = kv[etcd_metrics.METRICS_KEY]
+    assert len(records) == 10
+    assert records[0][3] == 15.0
+
+
+def test_worker_threads_wait_for_flush(kv):
+    """Test records made off the main thread are buffered."""
+    worker = threading.Thread(target=etcd_metrics.record,
+                              args=('gateway maintenance/status',
+                                    'https://10.0.0.1:2379', 0, 0.01))
+    worker.start()
+    worker.join()
+    assert etcd_metrics.METRICS_KEY not in kv
+    etcd_metrics.flush()
+    assert len(kv[etcd_metrics.METRICS_KEY]) == 1
+
+
+def test_summary_percentiles(kv):
+    """Test percentiles are computed per command."""
+    for ms in range(1, 101):
+        etcd_metrics.record('etcdctl member list', 'local',
+                            0 if ms % 10 else 1, ms / 1000)
+    etcd_metrics.record('df', 'local', 0, 0.005)
+    summary = etcd_metrics.summary()
+    stats = summary['etcdctl member list']
+    assert stats['count'] == 100
+    assert stats['errors'] == 10
+    assert (stats['p50'], stats['p95'], stats['p99']) == (50.0, 95.0, 99.0)
+    assert stats['max'] == 100.0
+    assert summary['df']['p99'] == 5.0
@@ -0,0 +1,35 @@
+import pytest
+
+import etcd_nrpe
+
+
+def test_thresholds_override_the_defaults():
+    """Test overrides replace the defaults of the checks they name."""
+    settings = etcd_nrpe.thresholds('{wal-fsync-p99: [5, 20]}')
+    assert settings['wal-fsync-p99'] == [5, 20]
+    assert settings['db-quota'] == [80, 90]
+    assert 'alarms' not in settings
+
+
+@pytest.mark.parametrize('text', [
+    '[1, 2]',
+    '{fsync: [1, 2]}',
+    '{db-quota: 80}',
+    '{db-quota: [95, 90]}',
+    '{db-quota: [yes, 90]}',
+    '{db-quota: [80',
+])
+def test_invalid_thresholds(text):
+    """Test malformed thresholds are refused."""
+    with pytest.raises(ValueError):
+        etcd_nrpe.thresholds(text)
+
+
+def test_checks_pass_thresholds_and_max_age():
+    """Test every check reads the cache with its own thresholds."""
+    checks = {shortname: command for shortname, _, command in
+              etcd_nrpe.checks(etcd_nrpe.thresholds(), 300)}
+    assert len(checks) == len(etcd_nrpe.CHECKS)
+    assert checks['etcd-db-quota'] == (
+        etcd_nrpe.PLUGIN + ' db-quota --max-age 300 -w 80 -c 90')
+    assert checks['etcd-alarms'] == etcd_nrpe.PLUGIN + ' alarms --max-age 300'
@@ -0,0 +1,97 @@
+from unittest.mock import patch
+
+import pytest
+
+import etcd_rejoin
+
+
+@pytest.fixture
+def cluster(peer_cluster):
+    cluster = peer_cluster('etcd_rejoin',
+                           ['etcd/0', 'etcd/1', 'etcd/2', 'etcd/3'])
+    cluster.leader['force_rejoin'] = 'round1'
+    return cluster
+
+
+def as_unit(cluster, unit, func):
+    cluster.local = unit
+    return func()
+
+
+def lead(cluster):
+    as_unit(cluster, 'etcd/0', etcd_rejoin.coordinate)
+
+
+def admitted(cluster):
+    return [unit for unit in cluster.units
+            if as_unit(cluster, unit, etcd_rejoin.admitted)]
+
+
+def test_units_are_admitted_one_at_a_time(cluster):
+    """Test the next unit is admitted as soon as the previous rejoined."""
+    for unit in ['etcd/3', 'etcd/1', 'etcd/2']:
+        assert as_unit(cluster, unit, etcd_rejoin.request_rejoin) == 'round1'
+    lead(cluster)
+    assert etcd_rejoin.get_schedule()['order'] == [
+        'etcd/1', 'etcd/2', 'etcd/3']
+
+    for unit in ['etcd/1', 'etcd/2', 'etcd/3']:
+        assert admitted(cluster) == [unit]
+        lead(cluster)
+        assert admitted(cluster) == [unit]
+        assert as_unit(cluster, unit, etcd_rejoin.acknowledge)
+        lead(cluster)
+    assert admitted(cluster) == []
+
+
+def test_late_requests_join_the_queue(cluster):
+    """Test units requesting after the schedule was built are appended."""
+    as_unit(cluster, 'etcd/2', etcd_rejoin.request_rejoin)
+    lead(cluster)
+    as_unit(cluster, 'etcd/1', etcd_rejoin.request_rejoin)
+    lead(cluster)
+    assert etcd_rejoin.get_schedule()['order'] == ['etcd/2', 'etcd/1']
+    assert admitted(cluster) == ['etcd/2']
+
+
+def test_unit_is_not_admitted_until_caught_up(cluster):
+    """Test a rejoined unit holds its admission until it caught up."""
+    as_unit(cluster, 'etcd/1', etcd_rejoin.request_rejoin)
+    as_unit(cluster, 'etcd/2', etcd_rejoin.request_rejoin)
+    lead(cluster)
+    cluster.caught_up.return_value = False
+    assert not as_unit(cluster, 'etcd/1', etcd_rejoin.acknowledge)
+    cluster.relation['etcd/1']['rejoin-done'] = 'round1'
+    lead(cluster)
+    assert admitted(cluster) == ['etcd/1']
+    cluster.caught_up.return_value = True
+    lead(cluster)
+    assert admitted(cluster) == ['etcd/2']
+
+
+def test_stalled_and_departed_units_are_skipped(cluster):
+    """Test units that left or timed out do not block the schedule."""
+    for unit in ['etcd/1', 'etcd/2', 'etcd/3']:
+        as_unit(cluster, unit, etcd_rejoin.request_rejoin)
+    lead(cluster)
+    cluster.units.remove('etcd/1')
+    lead(cluster)
+    assert admitted(cluster) == ['etcd/2']
+
+    with patch('etcd_rejoin.time.time') as now:
+        now.return_value = (etcd_rejoin.get_schedule()['since'] +
+                            etcd_rejoin.ADMISSION_TIMEOUT + 1)
+        lead(cluster)
+    assert admitted(cluster) == ['etcd/3']
+
+
+def test_new_round_resets_the_schedule(cluster):
+    """Test a new restore starts an empty schedule."""
+    as_unit(cluster, 'etcd/1', etcd_rejoin.request_rejoin)
+    lead(cluster)
+    cluster.leader['force_rejoin'] = 'round2'
+    assert admitted(cluster) == []
+    lead(cluster)
+    assert etcd_rejoin.get_schedule() == {
+        'request': 'round2', 'order': [], 'position': 0,
+        'since': etcd_rejoin.get_schedule()['since']}
@@ -0,0 +1,156 @@
+import json
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import etcd_restart
+from etcdctl import Member, parse_status
+
+
+@pytest.fixture
+def cluster(peer_cluster):
+    return peer_cluster('etcd_restart', ['etcd/0', 'etcd/1', 'etcd/2'])
+
+
+def request(cluster, unit):
+    cluster.local = unit
+    return etcd_restart.request_restart()
+
+
+def token_holder(cluster):
+    token = etcd_restart.get_token()
+    return token and token['unit']
+
+
+def test_restart_order_puts_leader_last():
+    """Test units restart by number, deferred units and the leader last."""
+    units = ['etcd/10', 'etcd/2', 'etcd/0', 'etcd/1']
+    assert etcd_restart.restart_order(units, 'etcd/1') == [
+        'etcd/0', 'etcd/2', 'etcd/10', 'etcd/1']
+    assert etcd_restart.restart_order(units, 'etcd/1', 'etcd/0') == [
+        'etcd/2', 'etcd/10', 'etcd/0', 'etcd/1']
+
+
+def test_request_restart_is_reused_until_served(cluster):
+    """Test repeated requests coalesce into one restart."""
+    nonce = request(cluster, 'etcd/1')
+    assert request(cluster, 'etcd/1') == nonce
+    cluster.relation['etcd/1']['restart-done'] = nonce
+    assert request(cluster, 'etcd/1') != nonce
+
+
+def test_request_restart_without_peers(cluster):
+    """Test a lone unit is told to restart straight away."""
+    cluster.units = ['etcd/0']
+    assert request(cluster, 'etcd/0') is None
+
+
+def test_rolling_restart_one_unit_at_a_time(cluster):
+    """Test tokens are granted one at a time with the leader last."""
+    for unit in cluster.units:
+        request(cluster, unit)
+    leader_restart = MagicMock()
+
+    def coordinate():
+        cluster.local = 'etcd/0'
+        etcd_restart.coordinate(leader_restart)
+
+    def restart(unit):
+        cluster.local = unit
+        nonce = etcd_restart.granted()
+        assert nonce
+        etcd_restart.acknowledge(nonce)
+
+    coordinate()
+    assert token_holder(cluster) == 'etcd/1'
+    # Nothing more is granted until the holder has restarted.
+    coordinate()
+    assert token_holder(cluster) == 'etcd/1'
+    cluster.local = 'etcd/2'
+    assert etcd_restart.granted() is None
+
+    restart('etcd/1')
+    coordinate()
+    cluster.caught_up.assert_called_with('etcd/1')
+    assert token_holder(cluster) == 'etcd/2'
+
+    # A member that has not caught up holds back the rollout.
+    restart('etcd/2')
+    cluster.caught_up.return_value = False
+    coordinate()
+    assert token_holder(cluster) == 'etcd/2'
+    leader_restart.assert_not_called()
+
+    cluster.caught_up.return_value = True
+    with patch('etcd_restart.time') as clock:
+        clock.time.return_value = time.time()
+        coordinate()
+        assert etcd_restart.get_token() is None
+        clock.time.return_value += etcd_restart.LEADER_GRACE
+        coordinate()
+    leader_restart.assert_called_once_with()
+    assert token_holder(cluster) == 'etcd/0'
+    assert etcd_restart.pending_restarts() == {}
+    # The leader's token is retired by its next hook, once it caught up
+    coordinate()
+    cluster.caught_up.assert_called_with('etcd/0')
+    assert etcd_restart.get_token() is None
+
+
+def test_leader_asking_first_waits_for_the_peers(cluster):
+    """Test the leader's own request waits for the peers of the rollout."""
+    leader_restart = MagicMock()
+    request(cluster, 'etcd/0')
+    with patch('etcd_restart.time') as clock:
+        clock.time.return_value = time.time()
+        etcd_restart.coordinate(leader_restart)
+        assert etcd_restart.get_token() is None
+
+        request(cluster, 'etcd/2')
+        cluster.local = 'etcd/0'
+        clock.time.return_value += etcd_restart.LEADER_GRACE
+        etcd_restart.coordinate(leader_restart)
+    assert token_holder(cluster) == 'etcd/2'
+    leader_restart.assert_not_called()
+
+
+def test_expired_token_is_revoked(cluster):
+    """Test a holder that never restarts does not block the others."""
+    request(cluster, 'etcd/1')
+    request(cluster, 'etcd/2')
+    cluster.local = 'etcd/0'
+    etcd_restart.coordinate(MagicMock())
+    assert token_holder(cluster) == 'etcd/1'
+
+    token = etcd_restart.get_token()
+    token['granted'] -= etcd_restart.TOKEN_TIMEOUT + 1
+    cluster.leader['restart-token'] = json.dumps(token)
+    etcd_restart.coordinate(MagicMock())
+    assert token_holder(cluster) == 'etcd/2'
+
+
+def test_member_caught_up_compares_raft_index():
+    """Test a member is caught up once it is close to the leader."""
+    etcdctl = MagicMock()
+    etcdctl.member_list.return_value = {
+        'etcd1': Member('1', 'etcd1', '', 'https://10.0.0.1:2379', False),
+        'etcd2': Member('2', 'etcd2', '', 'https://10.0.0.2:2379', False)}
+    member = parse_status('https://10.0.0.1:2379', {
+        'header': {'member_id': 1}, 'leader': 2, 'raftIndex': 5000})
+    leader = parse_status('https://10.0.0.2:2379', {
+        'header': {'member_id': 2}, 'leader': 2, 'raftIndex': 5500})
+    etcdctl.endpoint_status.side_effect = lambda url: {
+        'https://10.0.0.1:2379': [member],
+        'https://10.0.0.2:2379': [leader]}[url]
+    assert etcd_restart.member_caught_up('etcd/1', etcdctl)
+
+    lagging = member._replace(raft_index=1000)
+    etcdctl.endpoint_status.side_effect = lambda url: {
+        'https://10.0.0.1:2379': [lagging],
+        'https://10.0.0.2:2379': [leader]}[url]
+    assert not etcd_restart.member_caught_up('etcd/1', etcdctl)
+
+    leaderless = member._replace(leader='0')
+    etcdctl.endpoint_status.side_effect = lambda url: [leaderless]
+    assert not etcd_restart.member_caught_up('etcd/1', etcdctl)
@@ -0,0 +1,119 @@
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+
+import pytest
+
+from etcd_restore import V2, V3, stage_archive, swap_member
+
+
+def make_archive(path, files, compression='gz'):
+    """Write a tar archive of {name: content}, None content for a dir."""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        for name, content in files:
+            info = tarfile.TarInfo(name)
+            if content is None:
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            else:
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+    data = buffer.getvalue()
+    if compression == 'gz':
+        import gzip
+        data = gzip.compress(data)
+    elif compression == 'zst':
+        data = subprocess.check_output(['zstd', '-q', '-c'], input=data)
+    with open(path, 'wb') as fp:
+        fp.write(data)
+    return path
+
+
+@pytest.mark.parametrize('compression', [
+    'gz',
+    pytest.param('zst', marks=pytest.mark.skipif(
+        not shutil.which('zstd'), reason='zstd is not installed')),
+])
+def test_stage_v3_snapshot(tmp_path, compression):
+    """Test a v3 snapshot is detected from ./db and streamed to staging."""
+    archive = make_archive(str(tmp_path / 'snapshot.tar'),
+                           [('.', None), ('./db', b'bbolt' * 1000)],
+                           compression)
+    staging = str(tmp_path / 'staging')
+    assert stage_archive(archive, staging) == V3
+    with open(os.path.join(staging, 'db'), 'rb') as fp:
+        assert fp.read() == b'bbolt' * 1000
+
+
+def test_stage_v2_backup(tmp_path):
+    """Test a v2 backup tree is extracted under staging/v2."""
+    archive = make_archive(str(tmp_path / 'backup.tar.gz'), [
+        ('.', None), ('./member', None), ('./member/snap', None),
+        ('./member/snap/0001.snap', b'snap'),
+        ('./member/wal/0000.wal', b'wal')])
+    staging = str(tmp_path / 'staging')
+    assert stage_archive(archive, staging) == V2
+    member = os.path.join(staging, V2, 'member')
+    with open(os.path.join(member, 'wal', '0000.wal'), 'rb') as fp:
+        assert fp.read() == b'wal'
+    assert os.path.isfile(os.path.join(member, 'snap', '0001.snap'))
+
+
+def test_stage_refuses_unsafe_entries(tmp_path):
+    archive = make_archive(str(tmp_path / 'evil.tar.gz'), [
+        ('./member/x', b'x'), ('../../etc/passwd', b'x')])
+    with pytest.raises(ValueError):
+        stage_archive(archive, str(tmp_path / 'staging'))
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as fp:
+        fp.write(content)
+
+
+def read(path):
+    with open(path) as fp:
+        return fp.read()
+
+
+def test_swap_member_keeps_a_rollback(tmp_path):
+    """Test the restored member is renamed in, the old one kept aside."""
+    data = str(tmp_path / 'data')
+    write(os.path.join(data, 'member', 'snap', 'db'), 'old')
+    write(os.path.join(data, 'member.pre-restore-1', 'snap', 'db'), 'older')
+    staging = str(tmp_path / 'data' / '.restore-staging' / 'etcd')
+    write(os.path.join(staging, 'member', 'snap', 'db'), 'new')
+
+    rollback = swap_member(staging, data, stamp='2')
+    assert rollback == os.path.join(data, 'member.pre-restore-2')
+    assert read(os.path.join(data, 'member', 'snap', 'db')) == 'new'
+    assert read(os.path.join(rollback, 'snap', 'db')) == 'old'
+    assert not os.path.exists(os.path.join(data, 'member.pre-restore-1'))
+
+
+def test_swap_member_moves_the_wal(tmp_path):
+    """Test the restored wal replaces the one in a dedicated wal dir."""
+    data = str(tmp_path / 'data')
+    wal_dir = str(tmp_path / 'wal-mount' / 'wal')
+    write(os.path.join(wal_dir, '0.wal'), 'old')
+    staging = str(tmp_path / 'staging')
+    write(os.path.join(staging, 'member', 'wal', '0.wal'), 'new')
+    write(os.path.join(staging, 'member', 'snap', 'db'), 'db')
+
+    assert swap_member(staging, data, wal_dir, stamp='1') is None
+    assert read(os.path.join(wal_dir, '0.wal')) == 'new'
+    assert read(wal_dir + '.pre-restore-1/0.wal') == 'old'
+    assert not os.path.exists(os.path.join(data, 'member', 'wal'))
+
+
+def test_swap_member_rolls_back_on_failure(tmp_path):
+    """Test the live member is put back when the swap fails."""
+    data = str(tmp_path / 'data')
+    write(os.path.join(data, 'member', 'snap', 'db'), 'old')
+    with pytest.raises(OSError):
+        swap_member(str(tmp_path / 'missing'), data, stamp='1')
+    assert read(os.path.join(data, 'member', 'snap', 'db')) == 'old'
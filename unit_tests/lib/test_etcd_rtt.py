@@ -0,0 +1,75 @@
+import socket
+from unittest.mock import patch
+
+import etcd_rtt
+from etcd_tuning import tuning
+
+
+def test_derive_timeouts_from_rtt():
+    """Test the heartbeat is 1.5 RTT in 10ms steps, election 10 beats."""
+    assert etcd_rtt.derive(0.3) == (10, 100)
+    assert etcd_rtt.derive(40) == (60, 600)
+    assert etcd_rtt.derive(201) == (310, 3100)
+    # etcd refuses election timeouts above 50s
+    assert etcd_rtt.derive(10000) == (5000, 50000)
+
+
+def test_should_publish_has_hysteresis():
+    """Test rises always publish, small drops never do."""
+    assert etcd_rtt.should_publish(None, 100)
+    assert etcd_rtt.should_publish(100, 110)
+    assert not etcd_rtt.should_publish(100, 100)
+    assert not etcd_rtt.should_publish(100, 80)
+    assert etcd_rtt.should_publish(100, 70)
+
+
+def test_cluster_rtt_takes_worst_unit():
+    """Test the leader derives from the worst p99 and skips bad values."""
+    data = {'etcd/0': '1.50', 'etcd/1': '12.25', 'etcd/2': 'garbage'}
+    with patch('etcd_rtt.get_peer_data', return_value=data):
+        assert etcd_rtt.cluster_rtt() == 12.25
+    with patch('etcd_rtt.get_peer_data', return_value={}):
+        assert etcd_rtt.cluster_rtt() is None
+
+
+def test_measure_times_connects():
+    """Test reachable peers are sampled and unreachable ones skipped."""
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(16)
+    closed = socket.socket()
+    closed.bind(('127.0.0.1', 0))
+    try:
+        samples = etcd_rtt.measure(['127.0.0.1'], server.getsockname()[1],
+                                   samples=5)
+        assert len(samples) == 5
+        assert samples == sorted(samples)
+        assert etcd_rtt.measure(['127.0.0.1'], closed.getsockname()[1],
+                                samples=5) == []
+    finally:
+        server.close()
+        closed.close()
+
+
+def test_published_timeouts():
+    """Test published() ignores missing or partial leader data."""
+    leader = {}
+    with patch('etcd_rtt.leader_get', leader.get):
+        assert etcd_rtt.published() is None
+        leader[etcd_rtt.HEARTBEAT_KEY] = '150'
+        assert etcd_rtt.published() is None
+        leader[etcd_rtt.ELECTION_KEY] = '1500'
+        assert etcd_rtt.published() == (150, 1500)
+
+
+def test_measured_timeouts_only_raise_profile():
+    """Test RTT derived timeouts raise the profile but not overrides."""
+    settings = tuning('default', '', (60, 600))
+    assert settings['heartbeat-interval'] == 100
+    assert settings['election-timeout'] == 1000
+    settings = tuning('low-latency', '', (200, 2000))
+    assert settings['heartbeat-interval'] == 200
+    assert settings['election-timeout'] == 2000
+    settings = tuning('default', 'election-timeout: 700', (200, 2000))
+    assert settings['heartbeat-interval'] == 100
+    assert settings['election-timeout'] == 700
@@ -0,0 +1,95 @@
+import json
+from unittest.mock import patch
+
+import pytest
+
+import etcd_scrape
+from etcd_gateway import EtcdGateway
+
+METRICS = '''
+# HELP etcd_disk_wal_fsync_duration_seconds The latency of fsync.
+# TYPE etcd_disk_wal_fsync_duration_seconds histogram
+etcd_disk_wal_fsync_duration_seconds_bucket{{le="0.001"}} {fsync[0]}
+etcd_disk_wal_fsync_duration_seconds_bucket{{le="0.002"}} {fsync[1]}
+etcd_disk_wal_fsync_duration_seconds_bucket{{le="0.004"}} {fsync[2]}
+etcd_disk_wal_fsync_duration_seconds_bucket{{le="+Inf"}} {fsync[2]}
+etcd_disk_wal_fsync_duration_seconds_sum 0.5
+etcd_disk_wal_fsync_duration_seconds_count {fsync[2]}
+etcd_server_leader_changes_seen_total {leader_changes}
+etcd_server_proposals_pending 2
+etcd_server_quota_backend_bytes 1e+09
+etcd_mvcc_db_total_size_in_bytes 2.5e+08
+'''
+
+
+def metrics(fsync=(0, 0, 0), leader_changes=1):
+    return etcd_scrape.parse(METRICS.format(fsync=fsync,
+                                            leader_changes=leader_changes))
+
+
+def test_parse_reads_labels_and_values():
+    """Test samples are grouped by name with their labels."""
+    parsed = metrics((10, 20, 30))
+    assert parsed['etcd_server_quota_backend_bytes'] == [({}, 1e9)]
+    assert parsed['etcd_disk_wal_fsync_duration_seconds_bucket'][1] == (
+        {'le': '0.002'}, 20)
+
+
+def test_quantile_interpolates_within_the_bucket():
+    """Test quantiles are estimated the way Prometheus does."""
+    buckets = [[0.001, 50], [0.002, 90], [0.004, 100], [float('inf'), 100]]
+    assert etcd_scrape.quantile(0.5, buckets) == 0.001
+    assert etcd_scrape.quantile(0.99, buckets) == pytest.approx(0.0038)
+    assert etcd_scrape.quantile(0.99, [[float('inf'), 0]]) is None
+    assert etcd_scrape.quantile(0.99, [[0.001, 5], [float('inf'), 10]]) == \
+        0.001
+
+
+def test_latency_covers_the_recent_window_only():
+    """Test p99 only reflects the observations since the oldest sample."""
+    values, history = etcd_scrape.summarise(
+        metrics((1000, 1000, 1000)), set(), [], 1000)
+    assert values['wal-fsync-p99'] is None
+
+    values, history = etcd_scrape.summarise(
+        metrics((1000, 1000, 1100), leader_changes=4), set(), history, 1060)
+    assert values['wal-fsync-p99'] == pytest.approx(3.98)
+    assert values['leader-changes'] == 3
+    assert values['proposals-pending'] == 2
+    assert values['db-quota'] == 25.0
+
+    # Samples older than an hour no longer count towards leader changes
+    values, history = etcd_scrape.summarise(
+        metrics((1000, 1000, 1100), leader_changes=4), set(), history, 4680)
+    assert values['leader-changes'] == 0
+    assert values['wal-fsync-p99'] is None
+
+
+def test_counter_reset_discards_history():
+    """Test a restarted etcd does not produce negative counts."""
+    _, history = etcd_scrape.summarise(metrics((50, 80, 100), 5), set(),
+                                       [], 1000)
+    values, _ = etcd_scrape.summarise(metrics((10, 10, 10), 1), set(),
+                                      history, 1060)
+    assert values['wal-fsync-p99'] == 0.99
+    assert values['leader-changes'] == 1
+
+
+def test_collect_keeps_last_values_on_failure(tmpdir):
+    """Test a failed scrape records the error but keeps the values."""
+    path = str(tmpdir.join('metrics.json'))
+    with patch.object(EtcdGateway, 'metrics') as scrape, \
+            patch.object(EtcdGateway, 'call') as call:
+        scrape.return_value = METRICS.format(fsync=(1, 1, 1),
+                                             leader_changes=1)
+        call.return_value = {'alarms': [{'memberID': '1',
+                                         'alarm': 'NOSPACE'}]}
+        etcd_scrape.collect(path, now=1000)
+        scrape.side_effect = EtcdGateway.Unavailable('refused')
+        etcd_scrape.collect(path, now=1060)
+
+    with open(path) as fp:
+        cache = json.load(fp)
+    assert cache['scraped'] == 1000
+    assert cache['error'] == 'refused'
+    assert cache['values']['alarms'] == ['NOSPACE']
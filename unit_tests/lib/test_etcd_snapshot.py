@@ -0,0 +1,245 @@
+import base64
+import hashlib
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import etcd_snapshot
+import etcd_snapshot_store
+from etcd_gateway import EtcdGateway
+
+
+def snapshot_messages(db, chunk_size=1000):
+    """The gateway messages streaming db as etcd frames them: remaining_bytes
+    counts the database only, and the hash follows in a final message."""
+    messages = []
+    for offset in range(0, len(db), chunk_size):
+        blob = db[offset:offset + chunk_size]
+        messages.append({
+            'remaining_bytes': str(len(db) - offset - len(blob)),
+            'blob': base64.b64encode(blob).decode('ascii')})
+    messages.append({
+        'remaining_bytes': '0',
+        'blob': base64.b64encode(hashlib.sha256(db).digest()).decode('ascii')})
+    return messages
+
+
+def fake_gateway(messages):
+    gateway = MagicMock(endpoint='http://127.0.0.1:4001')
+    gateway.stream.return_value = iter(messages)
+    return gateway
+
+
+def read_archive(path):
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    if path.endswith('.zst'):
+        data = subprocess.check_output(['zstd', '-d', '-q', '-c'], input=data)
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        members = {os.path.normpath(m.name): m for m in tar.getmembers()
+                   if m.isfile()}
+        return {name: tar.extractfile(m).read()
+                for name, m in members.items()}, data
+
+
+@pytest.mark.parametrize('compression', [
+    'gzip',
+    pytest.param('zstd', marks=pytest.mark.skipif(
+        not shutil.which('zstd'), reason='zstd is not installed')),
+])
+def test_save_streams_gateway_snapshot(tmp_path, compression):
+    """Test the stream lands in the archive as db, hashed in one pass."""
+    db = os.urandom(5000) * 3
+    gateway = fake_gateway(snapshot_messages(db))
+    with patch('etcd_snapshot.get_gateway', return_value=gateway):
+        result = etcd_snapshot.save(str(tmp_path), compression,
+                                    etcdctl=MagicMock())
+    assert result['source'] == 'gateway'
+    assert result['path'].endswith('.tar.' +
+                                   etcd_snapshot.COMPRESSIONS[compression])
+    with open(result['path'], 'rb') as fp:
+        raw = fp.read()
+    assert result['size'] == len(raw)
+    assert result['sha256'] == hashlib.sha256(raw).hexdigest()
+    files, _ = read_archive(result['path'])
+    assert files == {'db': db + hashlib.sha256(db).digest()}
+    assert os.listdir(str(tmp_path)) == [os.path.basename(result['path'])]
+
+
+def test_corrupt_stream_leaves_no_archive(tmp_path):
+    """Test a stream failing etcd's hash check fails without output."""
+    messages = snapshot_messages(b'a' * 3000)
+    messages[1]['blob'] = base64.b64encode(b'b' * 1000).decode('ascii')
+    with patch('etcd_snapshot.get_gateway',
+               return_value=fake_gateway(messages)):
+        with pytest.raises(ValueError):
+            etcd_snapshot.save(str(tmp_path), etcdctl=MagicMock())
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_save_falls_back_to_etcdctl(tmp_path):
+    """Test etcdctl snapshot save is used when the gateway is down."""
+    gateway = MagicMock()
+    gateway.stream.side_effect = EtcdGateway.Unavailable('refused')
+    etcdctl = MagicMock()
+
+    def snapshot_save(path):
+        with open(path, 'wb') as fp:
+            fp.write(b'database')
+    etcdctl.snapshot_save.side_effect = snapshot_save
+
+    with patch('etcd_snapshot.get_gateway', return_value=gateway):
+        result = etcd_snapshot.save(str(tmp_path), etcdctl=etcdctl)
+    assert result['source'] == 'etcdctl snapshot save'
+    files, _ = read_archive(result['path'])
+    assert files == {'db': b'database'}
+    assert os.listdir(str(tmp_path)) == [os.path.basename(result['path'])]
+
+
+def test_save_rejects_unknown_options(tmp_path):
+    with pytest.raises(ValueError):
+        etcd_snapshot.save(str(tmp_path), 'bzip2')
+    with pytest.raises(ValueError):
+        etcd_snapshot.save(str(tmp_path), keys_version='v4')
+
+
+def test_human_size():
+    assert etcd_snapshot.human_size(512) == '512'
+    assert etcd_snapshot.human_size(1536) == '1.5K'
+    assert etcd_snapshot.human_size(3 * 1024 ** 3) == '3.0G'
+
+
+def test_token_bucket_sleeps_off_debt():
+    """Test consuming beyond the rate sleeps for the excess."""
+    now = [0.0]
+    slept = []
+
+    def sleep(seconds):
+        slept.append(seconds)
+        now[0] += seconds
+
+    bucket = etcd_snapshot.TokenBucket(1000, clock=lambda: now[0],
+                                       sleep=sleep)
+    bucket.consume(1000)
+    assert slept == []
+    bucket.consume(500)
+    assert slept == [0.5]
+    # the sleep paid the debt, a full second refills a full burst
+    now[0] += 1
+    bucket.consume(1000)
+    assert slept == [0.5]
+
+
+def test_save_from_disk_is_throttled(tmp_path):
+    """Test the bandwidth limit applies to the archived bytes."""
+    etcdctl = MagicMock()
+
+    def snapshot_save(path):
+        with open(path, 'wb') as fp:
+            fp.write(b'x' * 3000)
+    etcdctl.snapshot_save.side_effect = snapshot_save
+    gateway = MagicMock()
+    gateway.stream.side_effect = EtcdGateway.Unavailable('refused')
+
+    with patch('etcd_snapshot.get_gateway', return_value=gateway), \
+            patch('etcd_snapshot.TokenBucket') as bucket:
+        result = etcd_snapshot.save(str(tmp_path), etcdctl=etcdctl,
+                                    bandwidth=1000)
+    bucket.assert_called_once_with(1000)
+    consumed = [c[0][0] for c in bucket.return_value.consume.call_args_list]
+    assert sum(consumed) == 3000
+    files, _ = read_archive(result['path'])
+    assert files == {'db': b'x' * 3000}
+
+
+def test_prune_applies_retention(tmp_path):
+    """Test archives beyond count or age go, the newest always stays."""
+    now = 1000000
+    paths = []
+    for age in range(5):
+        path = tmp_path / 'etcd-snapshot-{}.tar.gz'.format(age)
+        path.write_bytes(b'')
+        os.utime(str(path), (now - age * 86400, now - age * 86400))
+        paths.append(str(path))
+    other = tmp_path / 'notes.txt'
+    other.write_bytes(b'')
+    partial = tmp_path / 'etcd-snapshot-new.tar.gz.part'
+    partial.write_bytes(b'')
+    os.utime(str(partial), (now - 2 * 86400, now - 2 * 86400))
+    os.utime(str(other), (now - 9 * 86400, now - 9 * 86400))
+
+    removed = etcd_snapshot.prune(str(tmp_path), keep=3, now=now)
+    assert sorted(removed) == sorted(paths[3:] + [str(partial)])
+    removed = etcd_snapshot.prune(str(tmp_path), max_age=0.5 * 86400,
+                                  now=now)
+    assert sorted(removed) == sorted(paths[1:3])
+    # the newest archive survives even when it is too old
+    assert etcd_snapshot.prune(str(tmp_path), keep=1, max_age=1,
+                               now=now + 10 * 86400) == []
+    assert other.exists()
+
+
+@pytest.mark.parametrize('options, error', [
+    ({'snapshot_interval': ''}, None),
+    ({'snapshot_interval': 'often'}, 'not a time span'),
+    ({'snapshot_interval': '1' * 64 + '!'}, 'not a time span'),
+    ({'snapshot_compression': 'bzip2'}, 'snapshot_compression'),
+    ({'snapshot_format': 'zip'}, 'snapshot_format'),
+    ({'snapshot_target': 'backups'}, 'absolute path'),
+    ({'snapshot_bandwidth_limit': 'fast'}, 'not a size'),
+])
+def test_config_schedule_errors(options, error):
+    values = {'snapshot_interval': '6h',
+              'snapshot_target': '/srv/etcd-snapshots',
+              'snapshot_compression': 'gzip',
+              'snapshot_retention_count': 7,
+              'snapshot_retention_days': 0,
+              'snapshot_bandwidth_limit': ''}
+    values.update(options)
+    with patch('etcd_snapshot.config', values.get):
+        schedule, message = etcd_snapshot.config_schedule()
+    assert schedule is None
+    if error is None:
+        assert message is None
+    else:
+        assert error in message
+
+
+def test_config_schedule():
+    values = {'snapshot_interval': '6h 30min',
+              'snapshot_target': '/srv/etcd-snapshots',
+              'snapshot_compression': 'zstd',
+              'snapshot_format': 'repository',
+              'snapshot_retention_count': 7,
+              'snapshot_retention_days': 30,
+              'snapshot_bandwidth_limit': '50MiB'}
+    with patch('etcd_snapshot.config', values.get):
+        schedule, error = etcd_snapshot.config_schedule()
+    assert error is None
+    assert schedule == {'interval': '6h 30min', 'target': '/srv/etcd-snapshots',
+                        'format': 'repository', 'compression': 'zstd', 'keep': 7, 'max_age_days': 30,
+                        'bandwidth': 50 * 1024 ** 2}
+
+
+def test_save_to_store_deduplicates_streams(tmp_path):
+    """Test snapshots streamed into a repository share their chunks."""
+    db = os.urandom(etcd_snapshot_store.CHUNK_SIZE * 4)
+    repository = str(tmp_path / 'repository')
+    results = []
+    for name in ('etcd-snapshot-1', 'etcd-snapshot-2'):
+        gateway = fake_gateway(snapshot_messages(db, chunk_size=30000))
+        with patch('etcd_snapshot.get_gateway', return_value=gateway), \
+                patch('etcd_snapshot_store.datetime') as now:
+            now.now.return_value.strftime.return_value = name[14:]
+            results.append(etcd_snapshot.save_to_store(repository,
+                                                       MagicMock()))
+    assert results[0]['source'] == 'gateway'
+    assert results[0]['new_chunks'] == results[0]['chunks'] == 5
+    assert results[1]['new_chunks'] == 0
+    stream = b''.join(etcd_snapshot_store.chunks_of(results[1]['manifest']))
+    assert stream == db + hashlib.sha256(db).digest()
@@ -0,0 +1,75 @@
+import hashlib
+import os
+import zlib
+
+import pytest
+
+from etcd_snapshot_store import (
+    SnapshotStore,
+    chunks_of,
+    load_manifest,
+    reassemble,
+)
+
+
+def pages(count, seed=0):
+    """count 4KiB pages of distinct content."""
+    return b''.join(hashlib.sha256(b'%d-%d' % (seed, i)).digest() * 128
+                    for i in range(count))
+
+
+def split(data, size=5000):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SnapshotStore(str(tmp_path / 'repository'), chunk_size=16384)
+
+
+def test_unchanged_pages_are_stored_once(store, tmp_path):
+    """Test a second snapshot only stores the chunks that changed."""
+    db = pages(64)
+    first = store.save(split(db), 'gateway', name='etcd-snapshot-1')
+    assert first['chunks'] == 16
+    assert first['new_chunks'] == 16
+    assert first['sha256'] == hashlib.sha256(db).hexdigest()
+
+    changed = bytearray(db)
+    changed[5 * 4096:6 * 4096] = pages(1, seed=1)
+    second = store.save(split(bytes(changed)), name='etcd-snapshot-2')
+    assert second['chunks'] == 16
+    assert second['new_chunks'] == 1
+
+    output = str(tmp_path / 'db')
+    assert reassemble(first['manifest'], output) == len(db)
+    with open(output, 'rb') as fp:
+        assert fp.read() == db
+    assert b''.join(chunks_of(second['manifest'])) == bytes(changed)
+    assert load_manifest(second['manifest'])['source'] == ''
+
+
+def test_gc_removes_unreferenced_chunks(store):
+    """Test chunks survive while any manifest refers to them."""
+    first = store.save([pages(8)], name='etcd-snapshot-1')
+    second = store.save([pages(8, seed=1)], name='etcd-snapshot-2')
+    assert store.gc() == (0, 0)
+    os.remove(first['manifest'])
+    removed, freed = store.gc()
+    assert removed == 2
+    assert freed > 0
+    assert b''.join(chunks_of(second['manifest'])) == pages(8, seed=1)
+    assert store.manifests() == [second['manifest']]
+
+
+def test_corrupt_chunk_is_detected(store, tmp_path):
+    """Test reassembly fails on a damaged chunk and leaves no output."""
+    result = store.save([pages(4)], name='etcd-snapshot-1')
+    digest = load_manifest(result['manifest'])['chunks'][0]
+    with open(store.chunk_path(digest), 'wb') as fp:
+        fp.write(zlib.compress(b'garbage'))
+    output = str(tmp_path / 'db')
+    with pytest.raises(SnapshotStore.Corrupt):
+        reassemble(result['manifest'], output)
+    assert not os.path.exists(output)
+    assert not os.path.exists(output + '.part')
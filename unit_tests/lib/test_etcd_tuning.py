@@ -0,0 +1,113 @@
+from unittest.mock import patch
+
+import jinja2
+import pytest
+import yaml
+
+import etcd_tuning
+from etcd_maintenance import compaction
+from etcd_tuning import GIB, MS, SECOND, tuning
+
+
+def render(settings, **context):
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader('templates'))
+    return yaml.safe_load(env.get_template('etcd3.conf').render(
+        unit_name='etcd0', cluster_bind_address='10.0.0.1',
+        db_bind_address='10.0.0.1', cluster_address='10.0.0.1',
+        db_address='10.0.0.1', port=2379, management_port=2380,
+        etcd_data_dir='/media/etcd/data', tuning=settings, **context))
+
+
+def test_default_profile_keeps_previous_settings():
+    """Test the default profile renders the settings etcd3.conf hardcoded."""
+    conf = render(tuning())
+    assert conf['snapshot-count'] == 10000
+    assert conf['heartbeat-interval'] == 100
+    assert conf['election-timeout'] == 1000
+    assert conf['quota-backend-bytes'] == 0
+    assert conf['max-snapshots'] == 5
+    assert conf['max-wals'] == 5
+    assert 'backend-batch-interval' not in conf
+    assert 'max-txn-ops' not in conf
+
+
+def test_profiles_are_valid():
+    """Test every shipped profile passes validation."""
+    for profile in etcd_tuning.PROFILES:
+        tuning(profile)
+
+
+def test_overrides_apply_on_top_of_profile():
+    """Test overrides are parsed and rendered in etcd's units."""
+    settings = tuning('large-dataset', '''
+        snapshot-count: 20000
+        backend-batch-interval: 10ms
+        grpc-keepalive-interval: 1h30m
+        grpc-keepalive-timeout: 20s
+        max-request-bytes: 3MiB
+        election-timeout: 5s
+    ''')
+    conf = render(settings)
+    assert conf['quota-backend-bytes'] == 8 * GIB
+    assert conf['snapshot-count'] == 20000
+    assert conf['backend-batch-interval'] == 10 * MS
+    assert conf['grpc-keepalive-interval'] == 5400 * SECOND
+    assert conf['grpc-keepalive-timeout'] == 20 * SECOND
+    assert conf['max-request-bytes'] == 3 * 1024 ** 2
+    assert conf['election-timeout'] == 5000
+    assert conf['heartbeat-interval'] == 250
+
+
+@pytest.mark.parametrize('profile,overrides,message', [
+    ('fast', '', 'unknown performance_profile'),
+    ('default', 'snapshot-cnt: 1', 'unknown performance_overrides keys'),
+    ('default', '[1, 2]', 'must be a mapping'),
+    ('default', 'heartbeat-interval: 300', 'at least 5 times'),
+    ('low-latency', 'heartbeat-interval: 200ms', 'at least 5 times'),
+    ('default', 'election-timeout: 1m', 'must not exceed'),
+    ('default', 'backend-batch-interval: soon', 'not a duration'),
+    ('default', 'max-txn-ops: -1', 'whole number'),
+    ('large-dataset', 'max-request-bytes: 9GiB', 'smaller than'),
+    ('default', 'grpc-keepalive-interval: 1s', 'grpc-keepalive-min-time'),
+])
+def test_invalid_tuning(profile, overrides, message):
+    """Test bad profiles, overrides and constraints are rejected."""
+    with pytest.raises(ValueError) as e:
+        tuning(profile, overrides)
+    assert message in str(e.value)
+
+
+def test_config_tuning_falls_back_to_default():
+    """Test invalid config is reported without breaking rendering."""
+    values = {'performance_profile': 'low-latency',
+              'performance_overrides': 'election-timeout: 10'}
+    with patch('etcd_tuning.config', values.get):
+        settings, error = etcd_tuning.config_tuning()
+    assert settings == tuning()
+    assert 'at least 5 times' in error
+
+
+def test_wal_dir_is_rendered_when_wal_storage_is_mounted():
+    """Test wal-dir points at the wal storage, not the data directory."""
+    assert 'wal-dir' not in render(tuning())
+    conf = render(tuning(), wal_path='/media/etcd-wal/wal')
+    assert conf['wal-dir'] == '/media/etcd-wal/wal'
+    assert conf['data-dir'] == '/media/etcd/data'
+
+
+def test_auto_compaction_is_rendered_when_enabled():
+    """Test auto compaction settings are only rendered when configured."""
+    assert 'auto-compaction-mode' not in render(tuning())
+    conf = render(tuning(), compaction=compaction('periodic', '1h'))
+    assert conf['auto-compaction-mode'] == 'periodic'
+    assert conf['auto-compaction-retention'] == '1h'
+    conf = render(tuning(), compaction=compaction('revision', '1000'))
+    assert conf['auto-compaction-retention'] == '1000'
+
+
+def test_metrics_listener_is_rendered_when_a_port_is_set():
+    """Test listen-metrics-urls is only rendered with a metrics port."""
+    assert 'listen-metrics-urls' not in render(tuning(), metrics_port=0)
+    conf = render(tuning(), metrics_port=2381)
+    assert conf['listen-metrics-urls'] == 'http://10.0.0.1:2381'
+    assert conf['listen-client-urls'].endswith(':2379')
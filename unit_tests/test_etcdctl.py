@@ -1,73 +1,172 @@
+import itertools
+import json
 import pytest
+import socket
+import time
+from http.client import RemoteDisconnected
+from subprocess import CalledProcessError, TimeoutExpired
 from unittest.mock import patch, MagicMock
 
 import reactive.etcd
 
 from etcdctl import (
+    Alarm,
+    ClusterSnapshot,
     EtcdCtl,
+    LOCAL_ENDPOINT,
+    Member,
+    RetryPolicy,
+    ROUTE_ANY,
+    ROUTE_LEADER,
+    parse_status,
+    etcd_version,
     etcdctl_command,
     get_connection_string,
+    supports_learners,
 )  # noqa
 
 from etcd_databag import EtcdDatabag
+from etcd_gateway import EtcdGateway
+import etcd_rejoin
 
 from reactive.etcd import (
     clear_flag,
+    disk_preflight,
     endpoint_from_flag,
     force_rejoin_requested,
     force_rejoin,
+    format_and_mount_wal_storage,
     GRAFANA_DASHBOARD_NAME,
     host,
     pre_series_upgrade,
     post_series_upgrade,
     register_grafana_dashboard,
     register_prometheus_jobs,
+    rejoin_when_admitted,
+    rerender_config,
     status,
+    tls_update,
 )
 
 
+def member(unit_id, name, client_urls=''):
+    return Member(unit_id, name, '', client_urls, False)
+
+
 class TestEtcdCtl:
 
+    @pytest.fixture(autouse=True)
+    def kv(self):
+        kv = {}
+        with patch('etcdctl.unitdata') as unitdata:
+            unitdata.kv.return_value.get.side_effect = kv.get
+            unitdata.kv.return_value.set.side_effect = kv.__setitem__
+            yield kv
+
+    @pytest.fixture
+    def policy(self):
+        return RetryPolicy(2, 5, 1, 0, 0)
+
     @pytest.fixture
-    def etcdctl(self):
-        return EtcdCtl()
+    def etcdctl(self, policy):
+        return EtcdCtl(native=False, policy=policy)
+
+    @pytest.fixture
+    def gateway(self):
+        with patch('etcdctl.get_gateway') as get_gateway:
+            yield get_gateway.return_value
 
     def test_register(self, etcdctl):
         with patch('etcdctl.EtcdCtl.run') as spcm:
-            etcdctl.register({'cluster_address': '127.0.0.1',
-                              'unit_name': 'etcd0',
-                              'management_port': '1313',
-                              'leader_address': 'http://127.1.1.1:1212'})
-            spcm.assert_called_with('member add etcd0 https://127.0.0.1:1313', api=2, endpoints='http://127.1.1.1:1212')
+            spcm.return_value = json.dumps({
+                'member': {'ID': 2, 'peerURLs': ['https://127.0.0.1:1313']},
+                'members': [
+                    {'ID': 1, 'name': 'etcd1',
+                     'peerURLs': ['https://127.0.0.2:1313']},
+                    {'ID': 2, 'peerURLs': ['https://127.0.0.1:1313']}]})
+            reg = etcdctl.register({'cluster_address': '127.0.0.1',
+                                    'unit_name': 'etcd0',
+                                    'management_port': '1313',
+                                    'leader_address': 'http://127.1.1.1:1212'})
+            spcm.assert_called_with(['member', 'add', 'etcd0', '--peer-urls', 'https://127.0.0.1:1313',
+                                     '--write-out', 'json'], endpoints='http://127.1.1.1:1212',
+                                    route=ROUTE_LEADER, policy=etcdctl.policy)
+            assert reg['cluster'] == ('etcd1=https://127.0.0.2:1313,'
+                                      'etcd0=https://127.0.0.1:1313')
 
     def test_unregister(self, etcdctl):
         with patch('etcdctl.EtcdCtl.run') as spcm:
-            etcdctl.unregister('br1212121212')
+            spcm.return_value = '{}'
+            etcdctl.unregister('b12121212')
 
-            spcm.assert_called_with(['member', 'remove', 'br1212121212'], api=2, endpoints=None)
+            spcm.assert_called_with(['member', 'remove', 'b12121212', '--write-out', 'json'], endpoints=None,
+                                    route=ROUTE_LEADER, policy=etcdctl.policy)
 
     def test_member_list(self, etcdctl):
         with patch('etcdctl.EtcdCtl.run') as comock:
-            comock.return_value = '7dc8404daa2b8ca0: name=etcd22 peerURLs=https://10.113.96.220:2380 clientURLs=https://10.113.96.220:2379\n'  # noqa
+            comock.return_value = '{"header":{"cluster_id":17237436991929493444,"member_id":9372538179322589801,"raft_term":2},"members":[{"ID":9063564952394763424,"name":"etcd22","peerURLs":["https://10.113.96.220:2380"],"clientURLs":["https://10.113.96.220:2379"]}]}\n'  # noqa
             members = etcdctl.member_list()
-            assert(members['etcd22']['unit_id'] == '7dc8404daa2b8ca0')
-            assert(members['etcd22']['peer_urls'] == 'https://10.113.96.220:2380')
-            assert(members['etcd22']['client_urls'] == 'https://10.113.96.220:2379')
+            comock.assert_called_with(['member', 'list', '--write-out', 'json'], endpoints=None,
+                                      route=ROUTE_ANY, policy=etcdctl.policy)
+            assert(members['etcd22'].unit_id == '7dc8404daa2b8ca0')
+            assert(members['etcd22'].peer_urls == 'https://10.113.96.220:2380')
+            assert(members['etcd22'].client_urls == 'https://10.113.96.220:2379')
+            assert(members['etcd22'].started)
 
     def test_member_list_with_unstarted_member(self, etcdctl):
-        ''' Validate we receive information only about members we can parse
-        from the current status string '''
-        # 57fa5c39949c138e[unstarted]: peerURLs=http://10.113.96.80:2380
-        # bb0f83ebb26386f7: name=etcd9 peerURLs=https://10.113.96.178:2380 clientURLs=https://10.113.96.178:2379
+        ''' Validate every unstarted member is reported, keyed by its ID '''
         with patch('etcdctl.EtcdCtl.run') as comock:
-            comock.return_value = '57fa5c39949c138e[unstarted]: peerURLs=http://10.113.96.80:2380]\nbb0f83ebb26386f7: name=etcd9 peerURLs=https://10.113.96.178:2380 clientURLs=https://10.113.96.178:2379\n'  # noqa
+            comock.return_value = json.dumps({'members': [
+                {'ID': 6339480827853542286,
+                 'peerURLs': ['http://10.113.96.80:2380']},
+                {'ID': 6339480827853542287,
+                 'peerURLs': ['http://10.113.96.81:2380']},
+                {'ID': 0xbb0f83ebb26386f7, 'name': 'etcd9',
+                 'peerURLs': ['https://10.113.96.178:2380'],
+                 'clientURLs': ['https://10.113.96.178:2379']}]})
             members = etcdctl.member_list()
-            assert(members['etcd9']['unit_id'] == 'bb0f83ebb26386f7')
-            assert(members['etcd9']['peer_urls'] == 'https://10.113.96.178:2380')
-            assert(members['etcd9']['client_urls'] == 'https://10.113.96.178:2379')
-            assert('unstarted' in members.keys())
-            assert(members['unstarted']['unit_id'] == '57fa5c39949c138e')
-            assert("10.113.96.80:2380" in members['unstarted']['peer_urls'])
+            assert(members['etcd9'].unit_id == 'bb0f83ebb26386f7')
+            assert(members['etcd9'].peer_urls == 'https://10.113.96.178:2380')
+            assert(members['etcd9'].client_urls == 'https://10.113.96.178:2379')
+            assert(not members['57fa5c39949c138e'].started)
+            assert("10.113.96.80:2380" in members['57fa5c39949c138e'].peer_urls)
+            assert("10.113.96.81:2380" in members['57fa5c39949c138f'].peer_urls)
+
+    def test_endpoint_status(self, etcdctl):
+        ''' Validate several endpoints are queried with one etcdctl call '''
+        with patch('etcdctl.EtcdCtl.run') as comock:
+            comock.return_value = json.dumps([
+                {'Endpoint': 'https://10.0.0.1:2379',
+                 'Status': {'header': {'member_id': 1, 'revision': 42,
+                                       'raft_term': 3},
+                            'version': '3.4.13', 'dbSize': 8192,
+                            'leader': 2, 'raftIndex': 100}},
+                {'Endpoint': 'https://10.0.0.2:2379',
+                 'Status': {'header': {'member_id': 2, 'revision': 42,
+                                       'raft_term': 3},
+                            'version': '3.4.13', 'dbSize': 4096,
+                            'leader': 2, 'raftIndex': 100}}])
+            statuses = etcdctl.endpoint_status(['https://10.0.0.1:2379',
+                                                'https://10.0.0.2:2379'])
+            comock.assert_called_once_with(
+                ['endpoint', 'status', '--write-out', 'json'],
+                endpoints='https://10.0.0.1:2379,https://10.0.0.2:2379')
+        assert [s.member_id for s in statuses] == ['1', '2']
+        assert statuses[0].leader == '2'
+        assert statuses[0].revision == 42
+        assert statuses[0].raft_term == 3
+        assert statuses[1].db_size == 4096
+
+    def test_alarm_list(self, etcdctl, gateway, policy):
+        ''' Validate alarms parse from both etcdctl and the gateway '''
+        with patch('etcdctl.EtcdCtl.run') as comock:
+            comock.return_value = json.dumps(
+                {'alarms': [{'memberID': 10, 'alarm': 1}]})
+            assert etcdctl.alarm_list() == [Alarm('a', 'NOSPACE')]
+
+        gateway.call.return_value = {
+            'alarms': [{'memberID': '10', 'alarm': 'NOSPACE'}]}
+        assert EtcdCtl(policy=policy).alarm_list() == [Alarm('a', 'NOSPACE')]
 
     def test_etcd_v2_version(self, etcdctl):
         ''' Validate that etcdctl can parse versions for both etcd v2 and
@@ -87,6 +186,27 @@ class TestEtcdCtl:
             ver = etcdctl.version()
             assert(ver == '3.0.17')
 
+    def test_etcd_version_from_snap_metadata(self, tmpdir, kv):
+        ''' Validate the version is read from the snap and cached by the
+        snap revision '''
+        tmpdir.mkdir('meta').join('snap.yaml').write('version: 3.4.13\n')
+        with patch('etcdctl.SNAP_PATH', str(tmpdir)), \
+                patch('etcdctl.snap_revision') as snap_revision, \
+                patch('etcdctl.check_output') as comock:
+            snap_revision.return_value = '233'
+            assert etcd_version() == '3.4.13'
+            assert kv['etcd.version'] == {'revision': '233',
+                                          'version': '3.4.13'}
+
+            # A cache hit does not read the snap metadata again
+            tmpdir.join('meta', 'snap.yaml').write('version: 3.4.14\n')
+            assert etcd_version() == '3.4.13'
+
+            # A refresh to a new revision does
+            snap_revision.return_value = '234'
+            assert etcd_version() == '3.4.14'
+            comock.assert_not_called()
+
     def test_etcdctl_command(self):
         ''' Validate sane results from etcdctl_command '''
         assert(isinstance(etcdctl_command(), str))
@@ -107,6 +227,307 @@ class TestEtcdCtl:
             api_version = comock.call_args[1].get('env').get('ETCDCTL_API')
             assert(api_version == '3')
 
+    def test_native_member_list(self, gateway, policy):
+        ''' Validate member IDs are converted to hex and unstarted members
+        are reported as before '''
+        gateway.call.return_value = {'members': [
+            {'ID': '9063564952394763424', 'name': 'etcd22',
+             'peerURLs': ['https://10.113.96.220:2380'],
+             'clientURLs': ['https://10.113.96.220:2379']},
+            {'ID': '6339480827853542286',
+             'peerURLs': ['http://10.113.96.80:2380']}]}
+        members = EtcdCtl(policy=policy).member_list()
+        gateway.call.assert_called_with('cluster/member/list', {},
+                                        policy.command_timeout)
+        assert members['etcd22'].unit_id == '7dc8404daa2b8ca0'
+        assert members['etcd22'].peer_urls == 'https://10.113.96.220:2380'
+        assert members['etcd22'].client_urls == 'https://10.113.96.220:2379'
+        assert members['57fa5c39949c138e'].peer_urls == 'http://10.113.96.80:2380'
+
+    def test_native_register(self, gateway, policy):
+        ''' Validate the initial cluster string is assembled from the
+        member add response '''
+        gateway.call.return_value = {
+            'member': {'ID': '2', 'peerURLs': ['https://127.0.0.1:1313']},
+            'members': [
+                {'ID': '1', 'name': 'etcd1',
+                 'peerURLs': ['https://127.0.0.2:1313']},
+                {'ID': '2', 'peerURLs': ['https://127.0.0.1:1313']}]}
+        reg = EtcdCtl(policy=policy).register({
+            'cluster_address': '127.0.0.1',
+            'unit_name': 'etcd0',
+            'management_port': '1313',
+            'leader_address': 'https://127.1.1.1:1212'})
+        gateway.call.assert_called_with(
+            'cluster/member/add', {'peerURLs': ['https://127.0.0.1:1313']},
+            policy.command_timeout)
+        assert reg['cluster'] == ('etcd1=https://127.0.0.2:1313,'
+                                  'etcd0=https://127.0.0.1:1313')
+
+    def test_native_register_learner(self, gateway, policy):
+        ''' Validate learners are added as such and promoted by ID '''
+        gateway.call.return_value = {
+            'member': {'ID': '2', 'peerURLs': ['https://127.0.0.1:1313']},
+            'members': [{'ID': '2', 'peerURLs': ['https://127.0.0.1:1313'],
+                         'isLearner': True}]}
+        etcdctl = EtcdCtl(policy=policy)
+        etcdctl.register({'cluster_address': '127.0.0.1',
+                          'unit_name': 'etcd0',
+                          'management_port': '1313',
+                          'leader_address': 'https://127.1.1.1:1212'},
+                         learner=True)
+        gateway.call.assert_called_with(
+            'cluster/member/add', {'peerURLs': ['https://127.0.0.1:1313'],
+                                   'isLearner': True},
+            policy.command_timeout)
+        etcdctl.member_promote('7dc8404daa2b8ca0')
+        gateway.call.assert_called_with(
+            'cluster/member/promote', {'ID': '9063564952394763424'},
+            policy.command_timeout)
+
+    def test_supports_learners(self):
+        assert supports_learners('3.4.0')
+        assert supports_learners('3.10.1')
+        assert not supports_learners('3.3.27')
+        assert not supports_learners('n/a')
+
+    def test_native_unregister(self, gateway, policy):
+        EtcdCtl(policy=policy).unregister('7dc8404daa2b8ca0')
+        gateway.call.assert_called_with(
+            'cluster/member/remove', {'ID': '9063564952394763424'},
+            policy.command_timeout)
+
+    def test_native_falls_back_to_etcdctl(self, gateway, policy):
+        ''' Validate the subprocess path is used when the gateway cannot be
+        reached '''
+        gateway.call.side_effect = EtcdGateway.Unavailable('refused')
+        with patch('etcdctl.EtcdCtl.run') as spcm:
+            spcm.return_value = '{}'
+            EtcdCtl(policy=policy).unregister('57fa5c39949c138e')
+            spcm.assert_called_with(['member', 'remove', '57fa5c39949c138e',
+                                     '--write-out', 'json'],
+                                    endpoints=LOCAL_ENDPOINT, route=ROUTE_ANY,
+                                    policy=policy)
+
+    def test_gateway_reports_the_grpc_code(self):
+        ''' Validate failures carry the gRPC code of the gateway JSON '''
+        gateway = EtcdGateway('https://10.0.0.1:2379')
+        body = json.dumps({'code': 14, 'message':
+                           'etcdserver: rpc not supported for learner'})
+        with pytest.raises(EtcdGateway.RequestFailed) as e:
+            gateway._decode('/v3/cluster/member/list', 503, body.encode())
+        assert e.value.code == 14
+        assert e.value.endpoint_specific
+
+        body = json.dumps({'error': {'grpc_code': 3, 'http_code': 400,
+                                     'message': 'invalid'}})
+        with pytest.raises(EtcdGateway.RequestFailed) as e:
+            gateway._decode('/v3/watch', 200, body.encode())
+        assert e.value.code == 3
+        assert not e.value.endpoint_specific
+        assert EtcdGateway.RequestFailed('bad gateway',
+                                         status=502).endpoint_specific
+
+    def test_gateway_only_resends_requests_never_delivered(self):
+        ''' Validate a request is resent when an idle keep-alive connection
+        was closed under it, but never once it may have been applied '''
+        def connection(error=None):
+            conn = MagicMock()
+            conn.getresponse.return_value.status = 200
+            conn.getresponse.return_value.read.return_value = b'{}'
+            if error:
+                conn.getresponse.side_effect = error
+            return conn
+
+        gateway = EtcdGateway('https://10.0.0.1:2379')
+        stale, fresh = connection(RemoteDisconnected('closed')), connection()
+        gateway._conn = stale
+        with patch.object(gateway, '_connect', return_value=fresh):
+            assert gateway._request('POST', '/v3/kv/put', {}) == (200, b'{}')
+        assert stale.request.call_count == fresh.request.call_count == 1
+
+        for reused, error in ((True, socket.timeout('timed out')),
+                              (False, RemoteDisconnected('closed')),
+                              (False, BrokenPipeError())):
+            conn, retry = connection(error), connection()
+            gateway._conn = conn if reused else None
+            with patch.object(gateway, '_connect',
+                              side_effect=[conn, retry]):
+                with pytest.raises(EtcdGateway.Unavailable):
+                    gateway._request('POST', '/v3/cluster/member/add', {})
+            assert conn.request.call_count == 1
+            retry.request.assert_not_called()
+
+    def test_gateway_timeout_applies_to_one_request(self):
+        ''' Validate a long timeout for one request does not stay on the
+        shared connection for the requests after it '''
+        conn = MagicMock()
+        conn.getresponse.return_value.status = 200
+        conn.getresponse.return_value.read.return_value = b'{}'
+        gateway = EtcdGateway('https://10.0.0.1:2379', timeout=5)
+        with patch.object(gateway, '_connect', return_value=conn) as connect:
+            gateway._request('POST', '/v3/maintenance/defragment', {}, 60)
+            gateway._request('POST', '/v3/maintenance/status', {})
+        connect.assert_called_once_with(60)
+        conn.sock.settimeout.assert_called_once_with(5)
+        assert gateway.timeout == 5
+
+    def test_native_call_fails_over_on_endpoint_errors(self, gateway, policy,
+                                                       kv):
+        ''' Validate an error specific to one member moves on to the next
+        known member, whatever its message, and others are raised '''
+        kv['etcd.endpoints'] = ['https://10.0.0.2:2379']
+        gateway.call.side_effect = [
+            EtcdGateway.RequestFailed('etcdserver: not capable', 14),
+            {'members': []}]
+        assert EtcdCtl(policy=policy).member_list() == {}
+        assert gateway.call.call_count == 2
+
+        gateway.call.reset_mock()
+        gateway.call.side_effect = EtcdGateway.RequestFailed(
+            'etcdserver: member not found', 5)
+        with pytest.raises(EtcdCtl.CommandFailed):
+            EtcdCtl(policy=policy).member_list()
+        assert gateway.call.call_count == 1
+
+    def test_run_fails_over_to_known_members(self, etcdctl, kv):
+        ''' Validate a transient failure moves on to the next endpoint '''
+        kv['etcd.endpoints'] = ['https://10.0.0.2:2379']
+        refused = CalledProcessError(1, 'etcdctl', stderr=b'dial tcp '
+                                     b'127.0.0.1:4001: connection refused')
+        with patch('etcdctl.check_output') as comock:
+            comock.side_effect = [refused, b'{}']
+            assert etcdctl.run(['member', 'list'], route=ROUTE_ANY) == '{}'
+        first, second = [c[0][0] for c in comock.call_args_list]
+        assert first[-2:] == ['--endpoints', 'http://127.0.0.1:4001']
+        assert second[-2:] == ['--endpoints', 'https://10.0.0.2:2379']
+        assert '--dial-timeout' in first and '2s' in first
+        assert comock.call_args[1]['timeout'] == etcdctl.policy.deadline
+
+    def test_run_does_not_retry_permanent_errors(self, etcdctl, kv):
+        ''' Validate a rejected command is not retried elsewhere '''
+        kv['etcd.endpoints'] = ['https://10.0.0.2:2379']
+        missing = CalledProcessError(1, 'etcdctl',
+                                     stderr=b'etcdserver: member not found')
+        with patch('etcdctl.check_output') as comock:
+            comock.side_effect = missing
+            with pytest.raises(EtcdCtl.CommandFailed) as e:
+                etcdctl.run(['member', 'remove', 'a'], route=ROUTE_ANY)
+        assert not isinstance(e.value, EtcdCtl.Transient)
+        assert comock.call_count == 1
+
+    def test_retry_policy_defaults_match_config(self):
+        ''' Validate unset options fall back to the config.yaml defaults '''
+        with patch('etcdctl.config', return_value={}):
+            policy = RetryPolicy.from_config()
+        assert (policy.dial_timeout, policy.command_timeout,
+                policy.attempts) == (2, 5, 3)
+
+    def test_run_retries_with_backoff(self, kv):
+        ''' Validate every endpoint is retried after a jittered delay '''
+        etcdctl = EtcdCtl(native=False,
+                          policy=RetryPolicy(2, 5, 3, 0.5, 4))
+        timeout = TimeoutExpired('etcdctl', 12)
+        with patch('etcdctl.check_output') as comock, \
+                patch('etcdctl.time.sleep') as sleep:
+            comock.side_effect = timeout
+            with pytest.raises(EtcdCtl.Transient):
+                etcdctl.run(['alarm', 'list'])
+        assert comock.call_count == 3
+        assert sleep.call_count == 2
+        assert all(0 <= c[0][0] <= 1 for c in sleep.call_args_list)
+
+    def test_membership_changes_prefer_the_leader(self, etcdctl, kv):
+        ''' Validate the raft leader is tried first '''
+        kv['etcd.endpoints'] = ['https://10.0.0.1:2379',
+                                'https://10.0.0.2:2379']
+        leader = parse_status('https://10.0.0.1:2379', {'leader': 2})
+        members = {'members': [
+            {'ID': 1, 'name': 'etcd1', 'clientURLs': ['https://10.0.0.1:2379']},
+            {'ID': 2, 'name': 'etcd2', 'clientURLs': ['https://10.0.0.2:2379']}]}
+        with patch('etcdctl.EtcdCtl.endpoint_status') as endpoint_status, \
+                patch('etcdctl.EtcdCtl.call') as call:
+            endpoint_status.return_value = [leader]
+            call.return_value = members
+            targets = etcdctl._route(None, ROUTE_LEADER)
+        assert targets == ['https://10.0.0.2:2379', 'http://127.0.0.1:4001',
+                           'https://10.0.0.1:2379']
+
+    def test_cluster_snapshot_is_loaded_once(self, policy):
+        ''' Validate the snapshot memoizes the member list and forgets it
+        after a membership change '''
+        snapshot = ClusterSnapshot()
+        with patch('etcdctl.EtcdCtl.member_list') as member_list, \
+                patch('etcdctl._snapshots', {None: snapshot}), \
+                patch('etcdctl.EtcdCtl.run', return_value='{}'):
+            member_list.return_value = {'etcd0': member('1', 'etcd0')}
+            assert snapshot.members == {'etcd0': member('1', 'etcd0')}
+            assert snapshot.members == {'etcd0': member('1', 'etcd0')}
+            assert member_list.call_count == 1
+
+            EtcdCtl(native=False, policy=policy).unregister('1')
+            snapshot.members
+            assert member_list.call_count == 2
+
+    def test_cluster_snapshot_health_reuses_the_members(self):
+        ''' Validate the health probes the members the snapshot listed '''
+        snapshot = ClusterSnapshot()
+        with patch('etcdctl.EtcdCtl.member_list') as member_list, \
+                patch('etcdctl.EtcdCtl.member_health') as member_health:
+            member_list.return_value = {'etcd0': member('1', 'etcd0')}
+            member_health.return_value = []
+            snapshot.members
+            snapshot.health
+            assert member_list.call_count == 1
+            assert member_health.call_args[0][0] == snapshot.members
+
+            member_list.side_effect = EtcdCtl.CommandFailed('down')
+            snapshot.invalidate()
+            assert snapshot.health['status'].startswith(
+                'cluster is unhealthy')
+
+    def test_cluster_snapshot_leader(self):
+        ''' Validate the leader id is resolved to a member name '''
+        snapshot = ClusterSnapshot()
+        with patch('etcdctl.EtcdCtl.member_list') as member_list, \
+                patch('etcdctl.EtcdCtl.endpoint_status') as endpoint_status:
+            member_list.return_value = {'etcd0': member('1', 'etcd0'),
+                                        'etcd1': member('a', 'etcd1')}
+            endpoint_status.return_value = [
+                parse_status('http://127.0.0.1:4001', {'leader': '10'})]
+            assert snapshot.leader == 'etcd1'
+
+    def test_cluster_health_probes_members_concurrently(self, etcdctl):
+        ''' Validate a member that never answers costs a single timeout and
+        is reported as unhealthy '''
+        members = {
+            'etcd0': member('1', 'etcd0', 'https://10.0.0.1:2379'),
+            'etcd1': member('2', 'etcd1', 'https://10.0.0.2:2379'),
+            'etcd2': member('3', 'etcd2', 'https://10.0.0.3:2379')}
+
+        def probe(url, timeout):
+            if url.startswith('https://10.0.0.3'):
+                time.sleep(timeout * 2)
+            return parse_status(url, {'leader': '1', 'raftTerm': '7',
+                                      'dbSize': '4096'})
+
+        with patch('etcdctl.EtcdCtl.member_list') as member_list, \
+                patch('etcdctl.EtcdCtl._probe_status') as probe_status:
+            member_list.return_value = members
+            probe_status.side_effect = probe
+            start = time.time()
+            health = etcdctl.cluster_health(timeout=0.2)
+            assert time.time() - start < 0.4
+
+        assert health['status'] == 'cluster is degraded'
+        etcd0, etcd1, etcd2 = health['members']
+        assert etcd0.healthy and etcd1.healthy
+        assert etcd0.raft_term == 7
+        assert etcd0.db_size == 4096
+        assert etcd0.leader == '1'
+        assert not etcd2.healthy
+        assert 'timed out' in etcd2.error
+
     def test_get_connection_string(self):
         ''' Validate the get_connection_string function
         gives a sane return.
@@ -133,20 +554,24 @@ class TestEtcdCtl:
 
     def test_register_prometheus_job(self, mocker):
         """Test successful registration of prometheus job."""
-        ingress_address = '10.0.0.1'
-        port = '2379'
-        targets = ['{}:{}'.format(ingress_address, port)]
         prometheus_mock = MagicMock()
         etcd_cluster_mock = MagicMock()
-        job_data = {'scheme': 'https',
-                    'static_configs': [{'targets': targets}]
-                    }
-
-        etcd_cluster_mock.get_db_ingress_addresses.return_value = []
         endpoint_from_flag.side_effect = [prometheus_mock, etcd_cluster_mock]
         mocker.patch.object(reactive.etcd, 'get_ingress_address',
-                            return_value=ingress_address)
-        reactive.etcd.config.return_value = port
+                            return_value='10.0.0.1')
+        mocker.patch.object(reactive.etcd, 'get_peer_data',
+                            return_value={'etcd/1': '10.0.0.2'})
+        mocker.patch.object(reactive.etcd.hookenv, 'local_unit',
+                            return_value='etcd/0')
+        reactive.etcd.config.side_effect = {'port': 2379,
+                                            'metrics_port': 0}.get
+        job_data = {'scheme': 'https',
+                    'static_configs': [
+                        {'targets': ['10.0.0.1:2379'],
+                         'labels': {'instance': 'etcd/0'}},
+                        {'targets': ['10.0.0.2:2379'],
+                         'labels': {'instance': 'etcd/1'}},
+                    ]}
 
         register_prometheus_jobs()
 
@@ -154,6 +579,16 @@ class TestEtcdCtl:
                                                         job_data=job_data)
         reactive.etcd.set_flag.assert_called_with('prometheus.configured')
 
+        # A dedicated metrics listener is scraped over plain HTTP
+        endpoint_from_flag.side_effect = [prometheus_mock, etcd_cluster_mock]
+        reactive.etcd.config.side_effect = {'port': 2379,
+                                            'metrics_port': 2381}.get
+        register_prometheus_jobs()
+        job_data = prometheus_mock.register_job.call_args[1]['job_data']
+        assert job_data['scheme'] == 'http'
+        assert job_data['static_configs'][1]['targets'] == ['10.0.0.2:2381']
+        reactive.etcd.config.side_effect = None
+
     def test_series_upgrade(self):
         assert host.service_pause.call_count == 0
         assert host.service_resume.call_count == 0
@@ -177,20 +612,242 @@ class TestEtcdCtl:
         rejoin_mock.assert_called_once()
         cluster_health_mock.assert_called_once()
 
-    @patch('reactive.etcd.register_node_with_leader')
+    @patch('reactive.etcd.rejoin_when_admitted')
+    @patch('reactive.etcd.etcd_rejoin')
     @patch('os.path.exists')
     @patch('shutil.rmtree')
     @patch('os.path.join')
-    @patch('time.sleep')
-    def test_force_rejoin(self, sleep, path_join, rmtree, path_exists,
-                          register_node):
+    def test_force_rejoin(self, path_join, rmtree, path_exists, etcd_rejoin,
+                          rejoin_when_admitted):
         """Test that force_rejoin performs required steps."""
         data_dir = '/foo/bar'
         path_exists.return_value = True
         path_join.return_value = data_dir
+        etcd_rejoin.request_rejoin.return_value = 'abc'
         force_rejoin()
 
         host.service_stop.assert_called_with(EtcdDatabag().etcd_daemon)
         clear_flag.assert_called_with('etcd.registered')
         rmtree.assert_called_with(data_dir)
-        register_node.assert_called()
+        reactive.etcd.set_flag.assert_called_with('etcd.rejoin.requested')
+        rejoin_when_admitted.assert_called_once_with()
+
+    def test_learner_rejoins_once_promoted(self, peer_cluster):
+        """Test a rejoining unit registers as a learner when admitted, and
+        only reports done once it was promoted."""
+        cluster = peer_cluster('etcd_rejoin', ['etcd/0', 'etcd/1'])
+        cluster.leader['force_rejoin'] = 'round1'
+        flags = {'etcd.rejoin.requested'}
+
+        def register(_):
+            flags.update(['etcd.registered', 'etcd.learner'])
+
+        leader_url = 'https://10.0.0.1:2379'
+        etcdctl = MagicMock()
+        etcdctl.leader = parse_status(leader_url, {
+            'header': {'member_id': 1}, 'leader': 1, 'raftIndex': 50000})
+        etcdctl.local = parse_status(LOCAL_ENDPOINT, {
+            'header': {'member_id': 2}, 'leader': 1, 'isLearner': True,
+            'raftAppliedIndex': 10000})
+        etcdctl.endpoint_status.side_effect = lambda url=None: [
+            etcdctl.leader if url == leader_url else etcdctl.local]
+        etcdctl.member_list.side_effect = EtcdCtl.CommandFailed(
+            'etcdserver: rpc not supported for learner')
+
+        def promote(unit_id, leader_address):
+            etcdctl.local = etcdctl.local._replace(is_learner=False)
+        etcdctl.member_promote.side_effect = promote
+
+        def hook(unit):
+            cluster.local = unit
+            if unit == 'etcd/0':
+                etcd_rejoin.coordinate()
+            else:
+                rejoin_when_admitted()
+
+        with patch('reactive.etcd.is_flag_set', flags.__contains__), \
+                patch('reactive.etcd.clear_flag', flags.discard), \
+                patch('reactive.etcd.register_node_with_leader',
+                      side_effect=register), \
+                patch('etcd_learner.EtcdCtl', return_value=etcdctl), \
+                patch('etcd_learner.config', return_value=1000), \
+                patch('etcd_learner.leader_get', return_value=leader_url), \
+                patch('etcd_learner.known_endpoints', return_value=[]), \
+                patch('etcd_learner.time') as clock:
+            clock.time.side_effect = itertools.count(0, 30)
+            hook('etcd/1')
+            assert 'etcd.registered' not in flags
+            cluster.relation['etcd/1']['rejoin-request'] = 'round1'
+            hook('etcd/0')
+
+            # Admitted, registered as a learner that is still catching up
+            hook('etcd/1')
+            assert flags == {'etcd.rejoin.requested', 'etcd.registered',
+                             'etcd.learner'}
+            assert 'rejoin-done' not in cluster.relation['etcd/1']
+
+            etcdctl.local = etcdctl.local._replace(raft_applied_index=49900)
+            hook('etcd/1')
+            etcdctl.member_promote.assert_called_once_with('2', leader_url)
+            assert flags == {'etcd.registered'}
+            assert cluster.relation['etcd/1']['rejoin-done'] == 'round1'
+
+            hook('etcd/0')
+        assert etcd_rejoin.get_schedule()['position'] == 1
+
+    @patch('reactive.etcd.set_app_version')
+    @patch('reactive.etcd.render_config')
+    def test_rerender_config_skips_unchanged_restart(self, render_config,
+                                                     set_app_version):
+        """Test etcd is not restarted when its config did not change."""
+        host.service_restart.reset_mock()
+        host.service_running.return_value = True
+        render_config.return_value = False
+        rerender_config()
+        host.service_restart.assert_not_called()
+
+        render_config.return_value = True
+        rerender_config()
+        host.service_restart.assert_called_once_with(
+            EtcdDatabag().etcd_daemon)
+
+    @patch('reactive.etcd.data_changed')
+    @patch('reactive.etcd.file_hash')
+    @patch('reactive.etcd.render_config')
+    def test_tls_update_restarts_on_certificate_change(self, render_config,
+                                                       file_hash,
+                                                       data_changed):
+        """Test new certificates restart etcd even if the config is the
+        same."""
+        host.service_restart.reset_mock()
+        host.service_running.return_value = True
+        render_config.return_value = False
+        file_hash.side_effect = ['ca', 'crt', 'key']
+        data_changed.return_value = False
+        tls_update()
+        host.service_restart.assert_not_called()
+        data_changed.assert_called_once_with('etcd.tls-certificates',
+                                             ['ca', 'crt', 'key'])
+
+        file_hash.side_effect = ['ca', 'crt2', 'key2']
+        data_changed.return_value = True
+        tls_update()
+        host.service_restart.assert_called_once_with(
+            EtcdDatabag().etcd_daemon)
+
+    @patch('reactive.etcd.etcd_disk')
+    def test_disk_preflight_blocks_on_a_slow_disk(self, etcd_disk):
+        """Test a unit does not join when the fsync p99 is too high."""
+        reactive.etcd.set_flag.reset_mock()
+        reactive.etcd.config.return_value = 10
+        etcd_disk.thresholds.return_value = (10, 100)
+        etcd_disk.verdict.return_value = ('blocked', 'Disk fsync p99 too high')
+        with patch.object(EtcdDatabag, 'wal_path', ''), \
+                patch.object(EtcdDatabag, 'etcd_data_dir', '/data'):
+            disk_preflight()
+            etcd_disk.preflight.assert_called_once_with('/data')
+            status.blocked.assert_called_with('Disk fsync p99 too high')
+            reactive.etcd.set_flag.assert_not_called()
+
+            etcd_disk.verdict.return_value = ('warning', 'Disk fsync slow')
+            disk_preflight()
+        reactive.etcd.set_flag.assert_called_once_with('etcd.disk.checked')
+
+    @patch('reactive.etcd.restart_on_change')
+    @patch('reactive.etcd.render_config')
+    @patch('reactive.etcd.persist_mount')
+    @patch('reactive.etcd.mount_volume')
+    @patch('reactive.etcd.format_volume')
+    @patch('reactive.etcd.check_call')
+    @patch('reactive.etcd.volume_is_mounted', return_value=False)
+    @patch('reactive.etcd.storage_get', return_value={'location': '/dev/vdc'})
+    def test_wal_storage_migrates_segments(self, storage_get, is_mounted,
+                                           check_call, format_volume,
+                                           mount_volume, persist_mount,
+                                           render_config, restart_on_change,
+                                           tmp_path):
+        ''' Validate the wal moves off the data directory onto the wal
+        storage and wal-dir is rendered '''
+        wal = tmp_path / 'data' / 'member' / 'wal'
+        wal.mkdir(parents=True)
+        (wal / '0000000000000000-0000000000000000.wal').write_text('x')
+        mount = tmp_path / 'wal-mount'
+        flags = {'snap.installed.etcd', 'etcd.registered'}
+        with patch('reactive.etcd.WAL_MOUNT', str(mount)), \
+                patch('reactive.etcd.WAL_PATH', str(mount / 'wal')), \
+                patch('reactive.etcd.is_flag_set', flags.__contains__), \
+                patch('reactive.etcd.host') as host, \
+                patch.object(EtcdDatabag, 'etcd_data_dir',
+                             str(tmp_path / 'data')):
+            format_and_mount_wal_storage()
+        host.service_stop.assert_called_once_with(EtcdDatabag().etcd_daemon)
+        format_volume.assert_called_once_with('/dev/vdc')
+        mount_volume.assert_called_once_with('/dev/vdc', str(mount))
+        check_call.assert_called_once_with(
+            ['rsync', '-azp', '{}/'.format(wal), '{}/'.format(mount / 'wal')])
+        persist_mount.assert_called_once_with('/dev/vdc', str(mount))
+        assert not wal.exists()
+        bag = render_config.call_args[0][0]
+        assert bag.wal_path == str(mount / 'wal')
+
+    @patch('reactive.etcd.restart_on_change')
+    @patch('reactive.etcd.render_config')
+    @patch('reactive.etcd.persist_mount')
+    @patch('reactive.etcd.mount_volume')
+    @patch('reactive.etcd.format_volume')
+    @patch('reactive.etcd.check_call')
+    @patch('reactive.etcd.volume_is_mounted', return_value=False)
+    @patch('reactive.etcd.storage_get', return_value={'location': '/dev/vdc'})
+    def test_early_wal_storage_leaves_etcd_alone(self, storage_get,
+                                                 is_mounted, check_call,
+                                                 format_volume, mount_volume,
+                                                 persist_mount, render_config,
+                                                 restart_on_change, tmp_path):
+        ''' Validate wal storage attached before etcd is registered is
+        mounted without rendering the config or starting etcd '''
+        mount = tmp_path / 'wal-mount'
+        reactive.etcd.set_state.reset_mock()
+        with patch('reactive.etcd.WAL_MOUNT', str(mount)), \
+                patch('reactive.etcd.WAL_PATH', str(mount / 'wal')), \
+                patch('reactive.etcd.is_flag_set', {'snap.installed.etcd'}
+                      .__contains__), \
+                patch('reactive.etcd.host') as host, \
+                patch.object(EtcdDatabag, 'etcd_data_dir',
+                             str(tmp_path / 'data')):
+            format_and_mount_wal_storage()
+        mount_volume.assert_called_once_with('/dev/vdc', str(mount))
+        persist_mount.assert_called_once_with('/dev/vdc', str(mount))
+        reactive.etcd.set_state.assert_called_with('wal.volume.attached')
+        host.service_stop.assert_not_called()
+        render_config.assert_not_called()
+        restart_on_change.assert_not_called()
+
+
+class TestEtcdDatabag:
+
+    def test_databag_is_lazy(self):
+        ''' Validate no hook tools are called until a datapoint is read '''
+        with patch('etcd_databag.get_ingress_address') as ingress, \
+                patch('etcd_databag.leader_get') as leader_get:
+            ingress.return_value = '10.0.0.1'
+            bag = EtcdDatabag()
+            ingress.assert_not_called()
+            leader_get.assert_not_called()
+
+            assert bag.db_address == '10.0.0.1'
+            assert bag.db_address == '10.0.0.1'
+            ingress.assert_called_once_with('db')
+
+    def test_databag_context(self):
+        ''' Validate context() expands every datapoint, honouring values
+        assigned on the bag '''
+        with patch('etcd_databag.get_ingress_address'), \
+                patch('etcd_databag.leader_get'):
+            bag = EtcdDatabag()
+            bag.cluster_state = 'new'
+            bag.leader_address = 'https://10.0.0.2:2379'
+            context = bag.context()
+        assert context['cluster_state'] == 'new'
+        assert context['leader_address'] == 'https://10.0.0.2:2379'
+        assert 'token' in context
+        assert 'db' not in context